@@ -0,0 +1,210 @@
+# bench.py - 本机回环压测：起 server.py，用纯 host 候选（不走 STUN/TURN）跑 seeder.py -> p2p_get.py
+#
+# 按 文件大小 x 分片大小 x 流控窗口 扫一遍，每组跑 --repeat 次取中位数，记录：
+#   吞吐（MB/s，按接收端从收齐清单到校验完的时间算）、首字节时间（从启动接收端算）、
+#   发送端/接收端各自的 CPU 时间和峰值 RSS
+# 结果写成 JSON；给了 --baseline 就逐组对比，吞吐掉得超过 --tolerance 时退出码为 1。
+# --transport udp 换成 rudp.py 的 UDP 传输，可以用 --loss / --delay-ms 在两端人为加丢包和延迟。
+#
+#   python bench.py --sizes 10,50 --chunks 64,128,512 --windows 0,1024 --out now.json --baseline base.json
+
+import argparse
+import json
+import os
+import socket
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+MB = 1024 * 1024
+
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+def make_file(workdir, size_mb):
+    path = os.path.join(workdir, f"src_{size_mb}mb.bin")
+    if not os.path.exists(path):
+        with open(path, "wb") as f:
+            for _ in range(size_mb):
+                f.write(os.urandom(MB))
+    return path
+
+
+def wait_rusage(proc, deadline):
+    """等子进程退出，返回 (退出码, CPU 秒数, 峰值 RSS 字节)；超时杀掉"""
+    while True:
+        pid, status, ru = os.wait4(proc.pid, os.WNOHANG)
+        if pid:
+            proc.returncode = os.waitstatus_to_exitcode(status)
+            return proc.returncode, ru.ru_utime + ru.ru_stime, ru.ru_maxrss * 1024
+        if time.monotonic() > deadline:
+            proc.kill()
+            deadline = float("inf")
+        time.sleep(0.02)
+
+
+def read_trace(path):
+    first_byte = summary = None
+    with open(path) as f:
+        for line in f:
+            rec = json.loads(line)
+            if rec.get("event") == "first_byte" and first_byte is None:
+                first_byte = rec["wall"]
+            elif rec.get("event") == "summary":
+                summary = rec
+    return first_byte, summary
+
+
+def run_once(args, port, src, chunk_kb, window_kb, workdir, k):
+    room = f"bench-{os.getpid()}-{k}"
+    out = os.path.join(workdir, "out.bin")
+    trace = os.path.join(workdir, "get.trace")
+    for p in (out, out + ".chunks", out + ".part", trace):
+        if os.path.exists(p):
+            os.remove(p)
+    common = ["--signaling", f"ws://127.0.0.1:{port}", "--room", room, "--stun", "",
+              "--quiet", "--log-level", "WARNING"]
+    seed_cmd = [sys.executable, os.path.join(HERE, "seeder.py"), *common, "--file", src,
+                "--chunk-kb", str(chunk_kb), "--window-kb", str(window_kb),
+                "--channels", str(args.channels), "--transport", args.transport]
+    get_cmd = [sys.executable, os.path.join(HERE, "p2p_get.py"), *common, "--output", out,
+               "--trace", trace]
+    if args.transport == "udp":
+        impair = ["--udp-mss", str(args.udp_mss), "--udp-loss", str(args.loss),
+                  "--udp-delay-ms", str(args.delay_ms)]
+        seed_cmd += impair
+        get_cmd += impair
+    logs = open(os.path.join(workdir, "bench.log"), "a")
+    seeder = subprocess.Popen(seed_cmd, stdout=subprocess.DEVNULL, stderr=logs)
+    start = time.time()
+    getter = subprocess.Popen(get_cmd, stdout=subprocess.DEVNULL, stderr=logs)
+    deadline = time.monotonic() + args.timeout
+    get_rc, get_cpu, get_rss = wait_rusage(getter, deadline)
+    wall = time.time() - start
+    seed_rc, seed_cpu, seed_rss = wait_rusage(seeder, deadline + 10)
+    logs.close()
+    first_byte, summary = read_trace(trace) if os.path.exists(trace) else (None, None)
+    ok = get_rc == 0 and seed_rc == 0 and summary is not None and os.path.getsize(out) == os.path.getsize(src)
+    size = os.path.getsize(src)
+    return {
+        "ok": ok,
+        "mbps": round(size / MB / summary["seconds"], 3) if ok and summary["seconds"] else None,
+        "ttfb_s": round(first_byte - start, 4) if first_byte else None,
+        "wall_s": round(wall, 3),
+        "seed_cpu_s": round(seed_cpu, 3),
+        "get_cpu_s": round(get_cpu, 3),
+        "seed_rss_mb": round(seed_rss / MB, 1),
+        "get_rss_mb": round(get_rss / MB, 1),
+    }
+
+
+def median_of(runs):
+    """每个指标取成功的几次的中位数"""
+    good = [r for r in runs if r["ok"]]
+    out = {"ok": len(good), "runs": len(runs)}
+    for key in ("mbps", "ttfb_s", "wall_s", "seed_cpu_s", "get_cpu_s", "seed_rss_mb", "get_rss_mb"):
+        values = [r[key] for r in good if r[key] is not None]
+        out[key] = round(statistics.median(values), 4) if values else None
+    return out
+
+
+def config_key(r):
+    key = f"{r['size_mb']}MB/chunk{r['chunk_kb']}K/window{r['window_kb'] or 'auto'}"
+    if r.get("transport", "webrtc") != "webrtc":
+        key += f"/{r['transport']}"
+    return key
+
+
+def compare(results, baseline, tolerance):
+    """和基线逐组比吞吐，返回变慢超过 tolerance 的组数"""
+    base = {config_key(r): r for r in baseline}
+    regressions = 0
+    print(f"\n{'config':<34} {'MB/s':>8} {'base':>8} {'change':>8}")
+    for r in results:
+        b = base.get(config_key(r))
+        if b is None or not r["mbps"] or not b.get("mbps"):
+            print(f"{config_key(r):<34} {r['mbps'] or '-':>8} {'-':>8}")
+            continue
+        change = r["mbps"] / b["mbps"] - 1
+        flag = ""
+        if change < -tolerance:
+            regressions += 1
+            flag = "  REGRESSION"
+        print(f"{config_key(r):<34} {r['mbps']:>8.2f} {b['mbps']:>8.2f} {change * 100:>+7.1f}%{flag}")
+    return regressions
+
+
+def run(args):
+    workdir = args.workdir or tempfile.mkdtemp(prefix="p2pshare-bench-")
+    os.makedirs(workdir, exist_ok=True)
+    port = free_port()
+    server = subprocess.Popen([sys.executable, os.path.join(HERE, "server.py"),
+                               "--host", "127.0.0.1", "--port", str(port)],
+                              stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    time.sleep(1)
+
+    results = []
+    k = 0
+    try:
+        for size_mb in [int(x) for x in args.sizes.split(",")]:
+            src = make_file(workdir, size_mb)
+            for chunk_kb in [int(x) for x in args.chunks.split(",")]:
+                for window_kb in [int(x) for x in args.windows.split(",")]:
+                    runs = []
+                    for _ in range(args.repeat):
+                        k += 1
+                        runs.append(run_once(args, port, src, chunk_kb, window_kb, workdir, k))
+                    r = {"size_mb": size_mb, "chunk_kb": chunk_kb, "window_kb": window_kb,
+                         "channels": args.channels, "transport": args.transport, **median_of(runs)}
+                    results.append(r)
+                    print(f"{config_key(r):<34} {r['mbps'] or 0:>7.2f} MB/s  ttfb {r['ttfb_s'] or 0:.3f}s  "
+                          f"cpu {r['seed_cpu_s'] or 0:.2f}/{r['get_cpu_s'] or 0:.2f}s  "
+                          f"rss {r['seed_rss_mb'] or 0:.0f}/{r['get_rss_mb'] or 0:.0f}MB  "
+                          f"ok {r['ok']}/{r['runs']}", flush=True)
+    finally:
+        server.terminate()
+        server.wait()
+
+    if args.out:
+        with open(args.out, "w") as f:
+            json.dump({"host": socket.gethostname(), "cpus": os.cpu_count(),
+                       "python": sys.version.split()[0], "results": results}, f, indent=1)
+    failed = sum(r["ok"] < r["runs"] for r in results)
+    regressions = 0
+    if args.baseline:
+        with open(args.baseline) as f:
+            regressions = compare(results, json.load(f)["results"], args.tolerance)
+    if failed or regressions:
+        print(f"\n{failed} configs had failed runs, {regressions} regressions")
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--sizes", default="10,50", help="file sizes in MB, comma separated")
+    parser.add_argument("--chunks", default="64,128,512", help="chunk sizes in KB")
+    parser.add_argument("--windows", default="0,1024",
+                        help="flow-control windows in KB (0 = adaptive)")
+    parser.add_argument("--channels", type=int, default=1)
+    parser.add_argument("--transport", choices=["webrtc", "udp"], default="webrtc")
+    parser.add_argument("--udp-mss", type=int, default=1200)
+    parser.add_argument("--loss", type=float, default=0.0,
+                        help="with --transport udp: fraction of packets each side drops")
+    parser.add_argument("--delay-ms", type=float, default=0.0,
+                        help="with --transport udp: delay each side adds to sent packets")
+    parser.add_argument("--repeat", type=int, default=3)
+    parser.add_argument("--timeout", type=float, default=180, help="seconds per run")
+    parser.add_argument("--workdir", help="where test files go (default: a temp dir)")
+    parser.add_argument("--out", help="write results as JSON")
+    parser.add_argument("--baseline", help="JSON from an earlier --out to compare against")
+    parser.add_argument("--tolerance", type=float, default=0.10,
+                        help="throughput drop that counts as a regression")
+    args = parser.parse_args()
+    run(args)
@@ -0,0 +1,249 @@
+# broker.py - 信令服务器的房间表（谁在哪个房间、缓存的消息），以及多进程时怎么共享它
+#
+# server.py 只管 WebSocket 连接，进房间、转发、离开都交给 broker：
+#   LocalBroker  房间表就在本进程里（单进程模式，也是 broker 进程里真正干活的那个）
+#   UnixBroker   多进程模式下 worker 用的，操作通过 Unix socket 转给 broker 进程，
+#                broker 进程算好该发给谁，再把消息送回连接所在的 worker
+# 换别的后端（比如 Redis）只要实现同样的 join / route / leave。
+#
+# 连接（peer）需要有 id、post(text)（不阻塞地排一条消息）和 kick()（被同角色的新连接挤掉）。
+
+import asyncio
+import json
+import logging
+import time
+from collections import deque
+
+import metrics
+
+logger = logging.getLogger("signal")
+
+ROOM_QUEUE = 100        # 每个房间缓存最近多少条消息（SDP/ICE），给后进来的一方回放
+LINE_LIMIT = 2 ** 23    # Unix socket 上一行的上限，要装得下最大的 WebSocket 消息
+
+
+JOIN_SECONDS = metrics.histogram("signal_join_seconds", "Time to register a join, including replay")
+ROUTE_SECONDS = metrics.histogram("signal_route_seconds", "Time to route one sdp/ice message")
+REPLAYED = metrics.counter("signal_replayed_messages_total", "Cached messages replayed to joining peers")
+ROUTED = metrics.counter("signal_routed_messages_total", "sdp/ice messages by outcome", "outcome")
+
+
+def other_role(role):
+    return "receiver" if role == "sender" else "sender"
+
+
+class Room:
+    # sender/receiver 各是 {peer_id: peer}，以及消息缓存队列
+    # 普通 join 同角色只留一个（挤掉旧的）；带 multi 的 join 可以多个共存（swarm）
+    def __init__(self):
+        self.peers = {"sender": {}, "receiver": {}}
+        self.queue = deque(maxlen=ROOM_QUEUE)
+
+    def empty(self) -> bool:
+        return not self.peers["sender"] and not self.peers["receiver"]
+
+
+class LocalBroker:
+    """房间表放在本进程内存里
+
+    所有方法都不 await，在事件循环里一次做完，别的协程插不进来，所以不需要锁；
+    发消息只是 post 到对方的发送队列，一个读得慢的连接拖不住别的房间。
+    """
+
+    def __init__(self):
+        self.rooms = {}
+        self.closed = None  # 和 UnixBroker 一致；本地的不会断
+        metrics.gauge("signal_rooms", "Rooms with at least one peer", lambda: len(self.rooms))
+        metrics.gauge("signal_room_peers", "Peers in rooms by role", self._peer_counts, "role")
+        metrics.gauge("signal_room_queue_messages", "Messages cached for replay, all rooms",
+                      lambda: sum(len(r.queue) for r in self.rooms.values()))
+        metrics.gauge("signal_room_queue_max", "Deepest replay queue of any room",
+                      lambda: max((len(r.queue) for r in self.rooms.values()), default=0))
+
+    def _peer_counts(self):
+        counts = {"sender": 0, "receiver": 0}
+        for r in self.rooms.values():
+            for role, peers in r.peers.items():
+                counts[role] += len(peers)
+        return counts
+
+    async def start(self):
+        pass
+
+    def join(self, peer, room_name, role, multi, batch=False):
+        t0 = time.perf_counter()
+        r = self.rooms.get(room_name)
+        if r is None:
+            r = self.rooms[room_name] = Room()
+        if not multi:
+            # 如果已有同角色，挤掉旧的
+            for old in r.peers[role].values():
+                old.kick()
+            r.peers[role].clear()
+        r.peers[role][peer.id] = peer
+        other = other_role(role)
+        # 缓存的消息（只给新加入的另一方发过的消息）
+        replay = [m for who, m in r.queue if who != role]
+        # 回确认，带上房间里另一方的 id 列表；batch 的客户端把回放的消息也一起带上，
+        # 一帧就拿到对方早已放好的 offer
+        joined = {
+            "type": "joined",
+            "room": room_name,
+            "role": role,
+            "id": peer.id,
+            "peers": list(r.peers[other]),
+        }
+        if batch:
+            joined["queued"] = replay
+        peer.post(json.dumps(joined))
+        # 通知另一方有人进来了
+        note = json.dumps({"type": "peer", "event": "join", "id": peer.id, "role": role})
+        for p in r.peers[other].values():
+            p.post(note)
+        if not batch:
+            for m in replay:
+                peer.post(m)
+        REPLAYED.inc(len(replay))
+        JOIN_SECONDS.observe(time.perf_counter() - t0)
+
+    def route(self, peer, room_name, role, msg):
+        t0 = time.perf_counter()
+        ROUTED.inc(value=self._route(peer, room_name, role, msg))
+        ROUTE_SECONDS.observe(time.perf_counter() - t0)
+
+    def _route(self, peer, room_name, role, msg):
+        r = self.rooms.get(room_name)
+        if r is None:
+            return "dropped"
+        other = other_role(role)
+        msg["from"] = peer.id
+        to = msg.get("to")
+        msg_str = json.dumps(msg)
+        if to:
+            # 点对点：只发给指定的 peer，不在就丢弃
+            p = r.peers[other].get(to)
+            if p is None:
+                return "dropped"
+            p.post(msg_str)
+            return "direct"
+        if r.peers[other]:
+            for p in r.peers[other].values():
+                p.post(msg_str)
+            return "broadcast"
+        # 对方还没来，先缓存
+        r.queue.append((role, msg_str))
+        return "queued"
+
+    def leave(self, peer, room_name, role):
+        r = self.rooms.get(room_name)
+        if r is None:
+            return
+        if r.peers[role].get(peer.id) is peer:
+            del r.peers[role][peer.id]
+            note = json.dumps({"type": "peer", "event": "leave", "id": peer.id, "role": role})
+            for p in r.peers[other_role(role)].values():
+                p.post(note)
+        if r.empty():
+            del self.rooms[room_name]
+
+
+# ====== 多进程：broker 进程 ======
+
+class RemotePeer:
+    """broker 进程里代表某个 worker 上的一个连接"""
+
+    def __init__(self, writer, peer_id):
+        self.writer = writer
+        self.id = peer_id
+        self.room = None
+        self.role = None
+
+    def _send(self, op):
+        # 本机 Unix socket，worker 收到只是放进连接的发送队列，不单独做背压
+        if not self.writer.is_closing():
+            self.writer.write(json.dumps(op).encode() + b"\n")
+
+    def post(self, text):
+        self._send({"op": "deliver", "id": self.id, "text": text})
+
+    def kick(self):
+        self._send({"op": "kick", "id": self.id})
+
+
+async def serve_broker(path):
+    """在 Unix socket 上跑 broker，房间表只在这一个进程里；返回 asyncio Server"""
+    rooms = LocalBroker()
+
+    async def on_worker(reader, writer):
+        peers = {}  # 这个 worker 上的连接 id -> RemotePeer
+        logger.info("Worker connected to broker (%d rooms)", len(rooms.rooms))
+        try:
+            async for line in reader:
+                j = json.loads(line)
+                op = j["op"]
+                if op == "join":
+                    peer = peers.setdefault(j["id"], RemotePeer(writer, j["id"]))
+                    peer.room, peer.role = j["room"], j["role"]
+                    rooms.join(peer, j["room"], j["role"], j.get("multi"), j.get("batch"))
+                elif op == "route":
+                    peer = peers.get(j["id"])
+                    if peer is not None:
+                        rooms.route(peer, j["room"], j["role"], j["msg"])
+                elif op == "leave":
+                    peer = peers.pop(j["id"], None)
+                    if peer is not None:
+                        rooms.leave(peer, j["room"], j["role"])
+        except (ConnectionError, asyncio.IncompleteReadError, ValueError) as e:
+            logger.warning("Broker link to a worker broke: %s", e)
+        finally:
+            # worker 退出了：它上面的连接都算离开房间
+            for peer in peers.values():
+                rooms.leave(peer, peer.room, peer.role)
+            writer.close()
+            logger.info("Worker disconnected from broker, %d of its peers left", len(peers))
+
+    return await asyncio.start_unix_server(on_worker, path, limit=LINE_LIMIT)
+
+
+# ====== 多进程：worker 这边 ======
+
+class UnixBroker:
+    """worker 用：join / route / leave 转给 broker 进程，broker 让发的消息交给本地连接"""
+
+    def __init__(self, path):
+        self.path = path
+        self.peers = {}   # 本 worker 上的连接 id -> peer
+        self.closed = None
+        self._writer = None
+
+    async def start(self):
+        reader, self._writer = await asyncio.open_unix_connection(self.path, limit=LINE_LIMIT)
+        self.closed = asyncio.ensure_future(self._read(reader))
+        logger.info("Connected to broker at %s", self.path)
+
+    async def _read(self, reader):
+        async for line in reader:
+            j = json.loads(line)
+            peer = self.peers.get(j["id"])
+            if peer is None:
+                continue  # 已经断开的连接
+            if j["op"] == "deliver":
+                peer.post(j["text"])
+            elif j["op"] == "kick":
+                peer.kick()
+        logger.error("Lost connection to broker at %s", self.path)
+
+    def _send(self, op):
+        self._writer.write(json.dumps(op).encode() + b"\n")
+
+    def join(self, peer, room_name, role, multi, batch=False):
+        self.peers[peer.id] = peer
+        self._send({"op": "join", "id": peer.id, "room": room_name, "role": role,
+                    "multi": multi, "batch": batch})
+
+    def route(self, peer, room_name, role, msg):
+        self._send({"op": "route", "id": peer.id, "room": room_name, "role": role, "msg": msg})
+
+    def leave(self, peer, room_name, role):
+        self.peers.pop(peer.id, None)
+        self._send({"op": "leave", "id": peer.id, "room": room_name, "role": role})
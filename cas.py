@@ -0,0 +1,146 @@
+# cas.py - 接收端本地的分片仓库（content-addressed），按分片 sha256 存，跨下载去重
+#
+#   <root>/ab/abcdef...   一个分片一个文件，文件名是分片的 sha256（清单里的叶子）
+#
+# 下载开始时，清单里本地仓库已经有的分片直接算进 have 位图，发送端就不发了；
+# 这些分片从仓库读出来交给落盘流水线，和网络上来的分片走同一条路（照样按清单校验）。
+# 下载校验通过后，把输出里仓库还没有的分片收进来。总大小超过上限时按 LRU 删最久没用的，
+# 最近用过的时间就是文件的 mtime，所以换个进程打开也接得上。
+# 几个进程共用一个仓库也行：文件先写临时名再 rename，读到被别人删掉/写坏的当作没有。
+
+import hashlib
+import logging
+import os
+import threading
+from collections import OrderedDict
+
+from common import human
+
+logger = logging.getLogger("fetch")
+
+STORE_TAG = "<store>"     # 从仓库填的分片交给流水线时的 tag（发送端 id 的位置）
+DEFAULT_CAP = 10 * 1024 * 1024 * 1024
+
+
+class ChunkStore:
+    def __init__(self, root: str, cap: int = DEFAULT_CAP):
+        self.root = root
+        self.cap = cap
+        self.size = 0
+        self._index = OrderedDict()   # sha256 hex -> 字节数，最久没用的在前
+        self._lock = threading.Lock()
+        os.makedirs(root, exist_ok=True)
+        self._scan()
+
+    def _scan(self):
+        found = []
+        for sub in os.scandir(self.root):
+            if not sub.is_dir() or len(sub.name) != 2:
+                continue
+            for entry in os.scandir(sub.path):
+                if len(entry.name) != 64 or not entry.name.startswith(sub.name):
+                    continue  # 临时文件或者别的东西
+                try:
+                    st = entry.stat()
+                except FileNotFoundError:
+                    continue
+                found.append((st.st_mtime_ns, entry.name, st.st_size))
+        for _, name, size in sorted(found):
+            self._index[name] = size
+            self.size += size
+        logger.info("Chunk store %s: %d chunks, %s", self.root, len(self._index), human(self.size))
+
+    def __len__(self):
+        return len(self._index)
+
+    def __contains__(self, leaf: bytes) -> bool:
+        return leaf.hex() in self._index
+
+    def path_of(self, leaf: bytes) -> str:
+        name = leaf.hex()
+        return os.path.join(self.root, name[:2], name)
+
+    def get(self, leaf: bytes):
+        """读一个分片并校验，没有或者坏了返回 None（坏的顺手删掉）"""
+        path = self.path_of(leaf)
+        try:
+            with open(path, "rb") as f:
+                data = f.read()
+        except FileNotFoundError:
+            self._forget(leaf.hex())
+            return None
+        if hashlib.sha256(data).digest() != leaf:
+            logger.warning("Chunk store object %s is corrupt, removing it", path)
+            self._remove(leaf.hex())
+            return None
+        try:
+            os.utime(path)
+        except OSError:
+            pass
+        with self._lock:
+            if leaf.hex() in self._index:
+                self._index.move_to_end(leaf.hex())
+        return data
+
+    def put(self, leaf: bytes, data) -> bool:
+        """存一个分片（调用方已经校验过），已经有了返回 False"""
+        name = leaf.hex()
+        if name in self._index:
+            return False
+        path = self.path_of(leaf)
+        tmp = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(tmp, "wb") as f:
+            f.write(data)
+        os.replace(tmp, path)
+        with self._lock:
+            self._index[name] = len(data)
+            self.size += len(data)
+        return True
+
+    def ingest(self, read_at, leaves, chunk_size: int) -> int:
+        """把一个校验通过的下载结果里仓库还没有的分片收进来，返回收了几个；放到线程里调
+        每存一个先腾地方，仓库任何时候都不超过上限；要删这次刚收的才腾得出来就不再收了"""
+        added = set()
+        evicted = 0
+        for index, leaf in enumerate(leaves):
+            if leaf in self:
+                continue
+            data = read_at(index * chunk_size, chunk_size)
+            if hashlib.sha256(data).digest() != leaf:
+                logger.warning("Chunk %d changed on disk since it was verified, not storing it", index)
+                continue
+            removed = self.evict(len(data), keep=added)
+            if removed is None:
+                logger.info("Chunk store full at %s, stored %d chunks of this download", human(self.cap), len(added))
+                break
+            evicted += removed
+            if self.put(leaf, data):
+                added.add(leaf.hex())
+        if evicted:
+            logger.info("Chunk store over %s, evicted %d chunks", human(self.cap), evicted)
+        return len(added)
+
+    def evict(self, need: int = 0, keep=()):
+        """从最久没用的开始删，直到再放 need 字节也不超过上限，返回删了几个；要删到 keep 里的才够返回 None"""
+        removed = 0
+        while self.size + need > self.cap and self._index:
+            with self._lock:
+                name = next(iter(self._index))
+            if name in keep:
+                return None
+            self._remove(name)
+            removed += 1
+        return removed if self.size + need <= self.cap else None
+
+    def _forget(self, name):
+        with self._lock:
+            self.size -= self._index.pop(name, 0)
+
+    def _remove(self, name):
+        self._forget(name)
+        try:
+            os.remove(os.path.join(self.root, name[:2], name))
+        except FileNotFoundError:
+            pass
+
@@ -1,18 +1,15 @@
+import os
 import socket
-import random
-import struct
 import sys
 
+import stunmsg
+
+
 def stun_request(server, port):
-    # STUN binding request (RFC 5389)
-    # Magic cookie 固定 0x2112A442
+    # STUN binding request (RFC 5389)，编解码见 stunmsg.py
     # Transaction ID 随机 12 bytes
-    tid = bytes(random.getrandbits(8) for _ in range(12))
-    msg_type = 0x0001  # Binding Request
-    msg_len = 0
-    magic_cookie = 0x2112A442
-
-    header = struct.pack("!HHI12s", msg_type, msg_len, magic_cookie, tid)
+    tid = os.urandom(12)
+    header = stunmsg.binding_request(tid)
 
     sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
     sock.settimeout(3)
@@ -28,33 +25,16 @@ def stun_request(server, port):
         return
 
     # 解析 STUN 响应
-    if len(data) < 20:
-        print("[ERROR] Response too short")
-        return
-
-    msg_type, msg_len, magic, rtid = struct.unpack("!HHI12s", data[:20])
-    if magic != magic_cookie or rtid != tid:
+    msg = stunmsg.parse(data)
+    if msg is None or msg[1] != tid:
         print("[ERROR] Invalid STUN response")
         return
 
     print(f"[OK] Got STUN response from {server}:{port}")
-    # 简单解析 XOR-MAPPED-ADDRESS 属性
-    body = data[20:]
-    i = 0
-    while i + 4 <= len(body):
-        attr_type, attr_len = struct.unpack("!HH", body[i:i+4])
-        val = body[i+4:i+4+attr_len]
-        i += 4 + attr_len
-        if attr_type == 0x0020:  # XOR-MAPPED-ADDRESS
-            port = val[2] ^ (magic_cookie >> 24)
-            ip = (
-                (val[4] ^ ((magic_cookie >> 24) & 0xFF)),
-                (val[5] ^ ((magic_cookie >> 16) & 0xFF)),
-                (val[6] ^ ((magic_cookie >> 8) & 0xFF)),
-                (val[7] ^ (magic_cookie & 0xFF))
-            )
-            print(f"[INFO] Your public address via TURN: {'.'.join(map(str, ip))}:{port}")
-            return
+    addr = stunmsg.mapped_address(data, tid)
+    if addr is not None:
+        print(f"[INFO] Your public address via TURN: {addr[0]}:{addr[1]}")
+        return
 
     print("[INFO] No XOR-MAPPED-ADDRESS found (but server responded)")
 
@@ -1,32 +1,186 @@
 # common.py - 公共工具：分片、元数据、一些小配置
 
 import os
+import re
+import json
 import math
+import base64
+import struct
 import hashlib
 
+# 分片是清单、位图、续传的单位，大小由发送端定，写在 meta 里告诉接收端
 CHUNK_SIZE = 128 * 1024  # 调大一些，提升吞吐
+MIN_CHUNK_SIZE = 16 * 1024
+MAX_CHUNK_SIZE = 16 * 1024 * 1024
 
+# 线上发的是"片"（piece）：一个分片按对端允许的 SCTP 消息大小切成一片或几片，
+# 片的大小发送端可以在传输中调整，接收端按片内偏移拼回分片
+MIN_PIECE = 16 * 1024
+DEFAULT_MAX_MESSAGE = 64 * 1024  # SDP 里没有 a=max-message-size 时按 RFC 8841 的默认值
+# 我们的接收端（aiortc）实际能收的消息大小：aiortc 会重组任意长的消息，
+# 但 SDP 里总是写死 65536，所以接收端在 have 里另外报这个值
+RECV_MAX_MESSAGE = 1024 * 1024
 
-def file_meta(path: str, with_hash=False):
+# 二进制帧：4 字节分片序号 + 4 字节片内偏移（大端） + 1 字节编码（0 = 原样，见 compress.py） + 数据
+FRAME_HDR = struct.Struct("!IIB")
+
+
+def human(n):
+    """把字节数转换成人类可读格式"""
+    for unit in ["B", "KB", "MB", "GB", "TB"]:
+        if n < 1024:
+            return f"{n:.2f}{unit}"
+        n /= 1024
+    return f"{n:.2f}PB"
+
+
+def file_meta(path: str, with_hash=False, chunk_size: int = CHUNK_SIZE):
     size = os.path.getsize(path)
     name = os.path.basename(path)
-    chunks = math.ceil(size / CHUNK_SIZE)
+    chunks = math.ceil(size / chunk_size)
     meta = {
         "name": name,
         "size": size,
-        "chunk_size": CHUNK_SIZE,
+        "chunk_size": chunk_size,
         "chunks": chunks,
     }
     if with_hash:
-        h = hashlib.sha256()
-        with open(path, "rb") as f:
-            for b in iter(lambda: f.read(1024 * 1024), b""):
-                h.update(b)
-        meta["sha256"] = h.hexdigest()
+        meta["sha256"] = file_sha256(path)
     return meta
 
 
-def read_chunk(path: str, index: int) -> bytes:
+def file_sha256(path: str) -> str:
+    h = hashlib.sha256()
     with open(path, "rb") as f:
-        f.seek(index * CHUNK_SIZE)
-        return f.read(CHUNK_SIZE)
\ No newline at end of file
+        for b in iter(lambda: f.read(1024 * 1024), b""):
+            h.update(b)
+    return h.hexdigest()
+
+
+def read_chunk(path: str, index: int, chunk_size: int = CHUNK_SIZE) -> bytes:
+    with open(path, "rb") as f:
+        f.seek(index * chunk_size)
+        return f.read(chunk_size)
+
+
+def pack_frame(index: int, data: bytes, offset: int = 0, codec: int = 0) -> bytes:
+    return FRAME_HDR.pack(index, offset, codec) + data
+
+
+def unpack_frame(buf: bytes):
+    """拆出 (分片序号, 片内偏移, 编码, 数据)，数据是 memoryview，避免多拷贝一次"""
+    index, offset, codec = FRAME_HDR.unpack_from(buf)
+    return index, offset, codec, memoryview(buf)[FRAME_HDR.size:]
+
+
+def max_message_size(sdp: str) -> int:
+    """SDP 里 a=max-message-size 的值；0 表示不限，换成最大分片能放下的大小"""
+    m = re.search(r"^a=max-message-size:(\d+)", sdp or "", re.M)
+    if m is None:
+        return DEFAULT_MAX_MESSAGE
+    value = int(m.group(1))
+    return value if value else MAX_CHUNK_SIZE + FRAME_HDR.size
+
+
+def piece_limit(max_message: int) -> int:
+    """对端能收的最大消息里能放多少数据（去掉帧头）"""
+    return max_message - FRAME_HDR.size
+
+
+class OrderedHasher:
+    """按分片序号顺序算整文件 sha256。
+
+    分片可能乱序到达（多条 DataChannel），先到的后面分片已经落盘，
+    等前面的空洞补上后再通过 read_back(index) 从输出文件读回来补算。
+    已经算过的分片再来一次（发送端补发）直接忽略。
+    """
+
+    def __init__(self, read_back):
+        self._sha = hashlib.sha256()
+        self._read_back = read_back
+        self._pending = set()
+        self.next_index = 0
+
+    def feed(self, index: int, data):
+        if index < self.next_index:
+            return
+        if index != self.next_index:
+            self._pending.add(index)
+            return
+        self._sha.update(data)
+        self.next_index += 1
+        while self.next_index in self._pending:
+            self._pending.discard(self.next_index)
+            self._sha.update(self._read_back(self.next_index))
+            self.next_index += 1
+
+    def hexdigest(self) -> str:
+        return self._sha.hexdigest()
+
+
+class ChunkBitmap:
+    """已完成分片的位图，序号和 file_meta 的分片一致。
+
+    可以存成输出文件旁边的 sidecar（<输出>.chunks），断线重连后据此续传。
+    """
+
+    # 分片布局加上内容的哈希：同名同大小、内容换了的文件不能拿旧位图续传。
+    # files_sha256 只有目录模式有；sha256 / root 只在发送端事先算了清单时有（边发边算的 eof 才给）
+    LAYOUT_KEYS = ("name", "size", "chunk_size", "chunks", "files_sha256", "sha256", "root")
+
+    def __init__(self, chunks: int, bits: bytes = None):
+        self.chunks = chunks
+        self.bits = bytearray(bits) if bits else bytearray((chunks + 7) // 8)
+        self.count = sum(bin(b).count("1") for b in self.bits)
+
+    def __contains__(self, index: int) -> bool:
+        return bool(self.bits[index >> 3] & (1 << (index & 7)))
+
+    def __len__(self):
+        return self.chunks
+
+    def add(self, index: int):
+        if index not in self:
+            self.bits[index >> 3] |= 1 << (index & 7)
+            self.count += 1
+
+    def discard(self, index: int):
+        if index in self:
+            self.bits[index >> 3] &= ~(1 << (index & 7)) & 0xFF
+            self.count -= 1
+
+    def complete(self) -> bool:
+        return self.count == self.chunks
+
+    def missing(self):
+        return [i for i in range(self.chunks) if i not in self]
+
+    def encode(self) -> str:
+        return base64.b64encode(bytes(self.bits)).decode()
+
+    @classmethod
+    def decode(cls, chunks: int, text: str):
+        return cls(chunks, base64.b64decode(text))
+
+    def save(self, path: str, meta: dict):
+        """原子写入 sidecar，只有已经 fsync 过的分片才能记进去"""
+        doc = {k: meta.get(k) for k in self.LAYOUT_KEYS}
+        doc["bitmap"] = self.encode()
+        tmp = path + ".tmp"
+        with open(tmp, "w") as f:
+            json.dump(doc, f)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp, path)
+
+    @classmethod
+    def load(cls, path: str, meta: dict):
+        """sidecar 和当前 meta 的分片布局一致才返回位图，否则 None"""
+        try:
+            with open(path) as f:
+                doc = json.load(f)
+        except (OSError, ValueError):
+            return None
+        if any(doc.get(k) != meta.get(k) for k in cls.LAYOUT_KEYS):
+            return None
+        return cls.decode(meta["chunks"], doc["bitmap"])
@@ -0,0 +1,130 @@
+# compress.py - 可选的分片压缩（发送端 --compress 打开，在 meta/have 里协商编码）
+#
+# 每一片单独压缩，帧头里带编码号，接收端不用记状态；压不小的片照原样发。
+# 压缩/解压都丢到线程池里跑（zlib、zstandard 干活时都会放开 GIL），事件循环只负责收发。
+# zstd 需要装 zstandard，没装就只有 zlib。
+
+import os
+import threading
+import zlib
+from concurrent.futures import ThreadPoolExecutor
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+RAW = 0
+CODEC_IDS = {"zlib": 1, "zstd": 2}
+MIN_SAVING = 0.9    # 压完不到原来的 90% 就不值得，照原样发
+SAMPLE_EVERY = 16   # 判定为压不动以后，每 16 片再试一次，数据变了能重新打开
+EWMA = 0.2
+WORKERS = os.cpu_count() or 2
+
+_pool = None
+_pool_lock = threading.Lock()
+
+
+def available():
+    """本机支持的编码，按优先顺序"""
+    return ["zstd", "zlib"] if zstandard is not None else ["zlib"]
+
+
+def pick(offered):
+    """从对方给的列表里挑第一个本机也支持的，没有返回 None"""
+    for name in offered or ():
+        if name in available():
+            return name
+    return None
+
+
+def offer(mode: str):
+    """发送端 --compress 对应在 meta 里给出的编码列表（只列本机有的）"""
+    if mode == "off":
+        return []
+    wanted = available() if mode == "auto" else [mode] + available()
+    return list(dict.fromkeys(n for n in wanted if n in available()))
+
+
+def workers() -> ThreadPoolExecutor:
+    """压缩和解压共用的线程池，按 CPU 个数开"""
+    global _pool
+    with _pool_lock:
+        if _pool is None:
+            _pool = ThreadPoolExecutor(max_workers=WORKERS, thread_name_prefix="codec")
+        return _pool
+
+
+def decompress(codec_id: int, data, limit: int) -> bytes:
+    """解压一片；解出来超过 limit（这一片在分片里最多能占的字节数）抛 ValueError，防解压炸弹"""
+    if limit <= 0:
+        raise ValueError(f"piece limit {limit} leaves no room")  # zlib 的 max_length=0 是不限
+    if codec_id == CODEC_IDS["zlib"]:
+        d = zlib.decompressobj()
+        out = d.decompress(data, limit)
+        if d.unconsumed_tail:
+            raise ValueError(f"zlib piece decodes past {limit} bytes")
+        if not d.eof:
+            raise ValueError("truncated zlib piece")
+        return out
+    if codec_id == CODEC_IDS["zstd"]:
+        if zstandard is None:
+            raise ValueError("zstd frame received but zstandard is not installed")
+        # 不用 decompress()：帧头里写的原始大小是对端说了算的，它会按那个大小先分配
+        with zstandard.ZstdDecompressor().stream_reader(bytes(data)) as reader:
+            out = reader.read(limit + 1)
+        if len(out) > limit:
+            raise ValueError(f"zstd piece decodes past {limit} bytes")
+        return out
+    raise ValueError(f"unknown codec id {codec_id}")
+
+
+class Compressor:
+    """发送端用：按采样到的压缩率决定一片要不要压。可以在多个线程里同时调 encode"""
+
+    def __init__(self, name: str):
+        self.name = name
+        self.codec_id = CODEC_IDS[name]
+        self.ratio = 0.0      # 最近压缩后/压缩前的指数平均
+        self.raw_bytes = 0
+        self.wire_bytes = 0
+        self._skipped = 0
+        self._local = threading.local()  # zstd 的压缩器不能跨线程共用
+
+    def _compress(self, data) -> bytes:
+        if self.name == "zlib":
+            return zlib.compress(data, 6)
+        cctx = getattr(self._local, "cctx", None)
+        if cctx is None:
+            cctx = self._local.cctx = zstandard.ZstdCompressor(level=3)
+        return cctx.compress(data)
+
+    @property
+    def active(self) -> bool:
+        return self.ratio < MIN_SAVING
+
+    def encode(self, data):
+        """返回 (编码号, 数据)；压不动时是 (RAW, 原数据)"""
+        if not self.active:
+            self._skipped += 1
+            if self._skipped % SAMPLE_EVERY:
+                self._count(len(data), len(data))
+                return RAW, data
+        out = self._compress(data)
+        ratio = len(out) / max(len(data), 1)
+        self.ratio = ratio if not self.raw_bytes else (1 - EWMA) * self.ratio + EWMA * ratio
+        if len(out) >= len(data) * MIN_SAVING:
+            self._count(len(data), len(data))
+            return RAW, data
+        self._count(len(data), len(out))
+        return self.codec_id, out
+
+    def _count(self, raw, wire):
+        self.raw_bytes += raw
+        self.wire_bytes += wire
+
+    def stats(self) -> str:
+        saved = 1 - self.wire_bytes / self.raw_bytes if self.raw_bytes else 0.0
+        state = "on" if self.active else "off (incompressible)"
+        return f"{self.name}, saved {saved * 100:.1f}%, currently {state}"
+
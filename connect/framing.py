@@ -0,0 +1,28 @@
+# 信令 TCP 连接上的消息分帧：4 字节长度（大端）+ JSON
+# TCP 是字节流，一次 recv 不一定是一条完整的消息，按长度读才不会拆错/粘包
+import asyncio
+import json
+import struct
+
+LENGTH = struct.Struct("!I")
+MAX_MESSAGE = 64 * 1024
+
+
+async def read_msg(reader):
+    """读一条消息；对端关了返回 None，太长或不是 JSON 对象抛 ValueError"""
+    try:
+        n, = LENGTH.unpack(await reader.readexactly(LENGTH.size))
+        if n > MAX_MESSAGE:
+            raise ValueError(f"message too long: {n} bytes")
+        body = await reader.readexactly(n)
+    except (asyncio.IncompleteReadError, ConnectionError):
+        return None
+    msg = json.loads(body)
+    if not isinstance(msg, dict):
+        raise ValueError("message is not a JSON object")
+    return msg
+
+
+def write_msg(writer, msg):
+    data = json.dumps(msg).encode()
+    writer.write(LENGTH.pack(len(data)) + data)
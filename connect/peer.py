@@ -1,68 +1,179 @@
-import socket
-import threading
+# 打洞测试端：在会合服务器（singal_server.py）上登记，拿到对方的公网地址后两边同时往对方发 UDP 包
+#
+#   python peer.py alice bob      （另一台机器上 python peer.py bob alice）
+#
+# 一个事件循环里跑：TCP 信令（长度前缀 JSON）、UDP 保活（定时发，不是死循环）、打洞。
+# 对称 NAT 每个目的地址换一个端口，服务器看到的端口未必是对方发给我们时用的，
+# 所以除了看到的端口，把附近 --spread 个端口也一起打（同一轮里全发）；
+# 另外收到对方的 punch 就按它实际的源地址回 ack，只要有一边是锥型 NAT 就能通。
+import argparse
+import asyncio
 import json
+import socket
 import sys
+import time
+
+from framing import read_msg, write_msg
 
 SIGNAL_IP = "114.132.234.219"
 SIGNAL_PORT = 2024
 
+KEEPALIVE = 15          # 秒；NAT 映射一般 30 秒以上才过期
+REGISTER_RETRY = 0.5    # 服务器还没回公网地址时 UDP 保活的重发间隔
+PUNCH_INTERVAL = 0.05
+PUNCH_TIMEOUT = 10
+HELLO_COUNT = 10
 
-def listen_udp(sock):
-    while True:
+
+def local_ip(server):
+    """往服务器方向出去用的本机地址（不真的发包）"""
+    with socket.socket(socket.AF_INET, socket.SOCK_DGRAM) as s:
         try:
-            data, addr = sock.recvfrom(2048)
-            print("got from", addr, ":", data.decode())
-        except Exception:
-            break
+            s.connect(server)
+            return s.getsockname()[0]
+        except OSError:
+            return "127.0.0.1"
 
-def main(peer_id, target_id):
-    # 1. UDP socket
-    udp_sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
-    udp_sock.bind(("", 0))
-    local_port = udp_sock.getsockname()[1]
 
-    # 2. TCP 连接信令服务器
-    tcp_sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-    tcp_sock.connect((SIGNAL_IP, SIGNAL_PORT))
-    tcp_sock.sendall(peer_id.encode() + b"\n")
+class Puncher(asyncio.DatagramProtocol):
+    def __init__(self, peer_id, server):
+        self.peer_id = peer_id
+        self.server = server
+        self.transport = None
+        self.target = None
+        self.observed = asyncio.get_event_loop().create_future()  # 服务器看到的我们的公网地址
+        self.punched = asyncio.get_event_loop().create_future()   # 打通的对方地址
+
+    def connection_made(self, transport):
+        self.transport = transport
+
+    def send(self, msg, addr):
+        self.transport.sendto(json.dumps(msg).encode(), addr)
+
+    def datagram_received(self, data, addr):
+        try:
+            msg = json.loads(data)
+        except ValueError:
+            return
+        if addr == self.server:
+            if not self.observed.done() and "addr" in msg:
+                self.observed.set_result(tuple(msg["addr"]))
+            return
+        if msg.get("from") != self.target:
+            return
+        kind = msg.get("t")
+        if kind == "punch":
+            self.send({"t": "ack", "from": self.peer_id}, addr)
+        elif kind == "ack":
+            if not self.punched.done():
+                self.punched.set_result(addr)
+        else:
+            print("got from", addr, ":", msg.get("text", kind))
 
-    # 3. 把自己的公网地址发给对方（由信令转发）
-    msg = {"to": target_id, "host": SIGNAL_IP, "port": local_port}
-    tcp_sock.sendall(json.dumps(msg).encode())
+    def error_received(self, exc):
+        pass  # 打没开的端口会收到 ICMP 不可达，正常
 
-    # 4. 接收对方的地址
-    def tcp_listener():
+    async def keepalive(self, token):
+        # 先勤快点发，拿到公网地址后按 KEEPALIVE 间隔保住映射
         while True:
+            self.send({"token": token}, self.server)
+            if not self.observed.done():
+                try:
+                    await asyncio.wait_for(asyncio.shield(self.observed), REGISTER_RETRY)
+                except asyncio.TimeoutError:
+                    pass
+                continue
+            if self.punched.done():
+                self.send({"t": "keepalive", "from": self.peer_id}, self.punched.result())
+            await asyncio.sleep(KEEPALIVE)
+
+    async def punch(self, info, spread, timeout):
+        """按服务器给的地址 + 附近端口 + 内网地址一起打，返回打通的地址，超时返回 None"""
+        ip, port = info["addr"]
+        offsets = sorted(range(-spread, spread + 1), key=abs)
+        cands = [(ip, port + k) for k in offsets if 0 < port + k < 65536]
+        if info.get("local"):
+            cands.append(tuple(info["local"]))
+        print(f"peer addr: {ip}:{port}, punching {len(cands)} addresses")
+        msg = {"t": "punch", "from": self.peer_id}
+        start = time.monotonic()
+        rounds = 0
+        while not self.punched.done() and time.monotonic() - start < timeout:
+            for addr in cands:
+                self.send(msg, addr)
+            rounds += 1
             try:
-                data = tcp_sock.recv(1024)
-                if not data:
-                    break
-                msg = json.loads(data.decode())
-                peer_host = msg["host"]
-                peer_port = msg["port"]
-                print("peer addr:", peer_host, peer_port)
-                # 5. 尝试打洞（不停发包）
-                def punch():
-                    for i in range(10):
-                        udp_sock.sendto(f"hello {i} from {peer_id}".encode(),
-                                        (peer_host, peer_port))
-                threading.Thread(target=punch).start()
-            except Exception:
-                break
-
-    threading.Thread(target=tcp_listener, daemon=True).start()
-    threading.Thread(target=listen_udp, args=(udp_sock,), daemon=True).start()
-
-    # 保持运行
+                await asyncio.wait_for(asyncio.shield(self.punched), PUNCH_INTERVAL)
+            except asyncio.TimeoutError:
+                pass
+        if not self.punched.done():
+            print(f"[FAIL] no answer after {timeout}s ({rounds} rounds)")
+            return None
+        addr = self.punched.result()
+        how = "local" if info.get("local") and addr == tuple(info["local"]) else f"port offset {addr[1] - port:+d}"
+        print(f"[OK] punched {addr[0]}:{addr[1]} in {(time.monotonic() - start) * 1000:.0f}ms, "
+              f"{rounds} rounds ({how})")
+        for i in range(HELLO_COUNT):
+            self.send({"t": "hello", "from": self.peer_id, "text": f"hello {i} from {self.peer_id}"}, addr)
+        return addr
+
+
+async def main(args):
+    loop = asyncio.get_running_loop()
+    host, _, port = args.server.rpartition(":")
+    server = (socket.gethostbyname(host), int(port))
+
+    # 1. UDP socket
+    transport, puncher = await loop.create_datagram_endpoint(
+        lambda: Puncher(args.peer_id, server), local_addr=("0.0.0.0", args.port))
+    local = [local_ip(server), transport.get_extra_info("sockname")[1]]
+    puncher.target = args.target_id
+
+    # 2. TCP 连接信令服务器，登记
+    reader, writer = await asyncio.open_connection(*server)
+    write_msg(writer, {"type": "register", "id": args.peer_id, "local": local})
+    reg = await read_msg(reader)
+    if not reg or reg.get("type") != "registered":
+        print("[ERROR] register failed:", reg)
+        return 1
+    asyncio.ensure_future(puncher.keepalive(reg["token"]))
+
+    # 3. 请服务器把双方的公网地址互相告诉对方（对方还没上线就等着）
+    write_msg(writer, {"type": "connect", "to": args.target_id})
+    punching = None
     while True:
-        try:
-            udp_sock.sendto(f"keepalive from {peer_id}".encode(),
-                            (SIGNAL_IP, SIGNAL_PORT))
-        except Exception:
-            break
+        msg = await read_msg(reader)
+        if msg is None:
+            print("signal server closed the connection")
+            return 1
+        kind = msg.get("type")
+        if kind == "observed":
+            print("my public addr:", *msg["addr"])
+        elif kind == "waiting":
+            print(f"waiting for {msg['to']} to come online")
+        elif kind == "peer" and msg.get("id") == args.target_id and punching is None:
+            # 4. 打洞
+            punching = asyncio.ensure_future(puncher.punch(msg, args.spread, args.timeout))
+            if args.once:
+                ok = await punching
+                await asyncio.sleep(1)  # 对方可能还在等我们回 ack
+                return 0 if ok else 1
+        elif kind == "error":
+            print("[ERROR]", msg)
+
 
 if __name__ == "__main__":
-    if len(sys.argv) != 3:
-        print("Usage: python peer.py <peer_id> <target_id>")
-        sys.exit(1)
-    main(sys.argv[1], sys.argv[2])
+    parser = argparse.ArgumentParser()
+    parser.add_argument("peer_id")
+    parser.add_argument("target_id")
+    parser.add_argument("--server", default=f"{SIGNAL_IP}:{SIGNAL_PORT}", help="rendezvous host:port")
+    parser.add_argument("--port", type=int, default=0, help="local UDP port (default: any)")
+    parser.add_argument("--spread", type=int, default=8,
+                        help="also punch this many ports on each side of the observed one (symmetric NAT)")
+    parser.add_argument("--timeout", type=float, default=PUNCH_TIMEOUT)
+    parser.add_argument("--once", action="store_true", help="exit after the punch result")
+    args = parser.parse_args()
+    try:
+        sys.exit(asyncio.run(main(args)))
+    except KeyboardInterrupt:
+        pass
@@ -1,44 +1,177 @@
-# 简单信令服务器，用 TCP 转发两端的公网地址
-import socket
-import threading
+# 打洞用的会合（rendezvous）服务器：TCP 上转发消息，UDP 上看两端的公网地址
+#
+# 同一个端口开 TCP 和 UDP：
+#   TCP   长度前缀 + JSON（framing.py）。先 register 拿一个 token；connect 请求把双方介绍给对方；
+#         带 to 的其它消息原样转发（加上 from）
+#   UDP   peer 定时发 {"token"} 保活，服务器记下看到的源地址（NAT 映射后的公网 IP:端口）并回给它
+# 全部跑在一个事件循环里，不开线程；发得慢的 peer 写缓冲超过上限直接断开，不拖累别人
+import argparse
+import asyncio
 import json
+import logging
+import os
+
+from framing import read_msg, write_msg
 
 HOST = "0.0.0.0"
 PORT = 2024
+REGISTER_TIMEOUT = 10
+MAX_WRITE_BUFFER = 256 * 1024
+STATS_INTERVAL = 60
+
+logging.basicConfig(
+    level=logging.INFO,
+    format="%(asctime)s [%(levelname)s] %(message)s",
+    handlers=[logging.StreamHandler()]
+)
+logger = logging.getLogger("rendezvous")
+
+
+class Peer:
+    __slots__ = ("id", "writer", "token", "addr", "local")
+
+    def __init__(self, peer_id, writer, local):
+        self.id = peer_id
+        self.writer = writer
+        self.token = os.urandom(8).hex()
+        self.addr = None      # UDP 保活包的源地址
+        self.local = local    # peer 自己报的内网地址，同一个 NAT 后面的两端用
 
-clients = {}
 
-def handle_client(conn, addr):
-    print("connected", addr)
-    peer_id = conn.recv(1024).decode().strip()
-    clients[peer_id] = conn
-    print(peer_id, "registered")
+class Rendezvous(asyncio.DatagramProtocol):
+    def __init__(self):
+        self.peers = {}       # id -> Peer
+        self.tokens = {}      # token -> Peer
+        self.pending = {}     # 要连、但有一方公网地址还不知道的：id -> {对方 id}，两个方向都记
+        self.udp = None
+        self.relayed = 0
+        self.introduced = 0
 
-    while True:
+    # ========== UDP：记公网地址 ==========
+    def connection_made(self, transport):
+        self.udp = transport
+
+    def datagram_received(self, data, addr):
         try:
-            data = conn.recv(1024)
-            if not data:
-                break
-            msg = json.loads(data.decode())
-            target = msg.get("to")
-            if target in clients:
-                clients[target].send(data)
-        except Exception:
-            break
-
-    conn.close()
-    if peer_id in clients:
-        clients.pop(peer_id)
-    print(peer_id, "closed")
-
-def main():
-    s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-    s.bind((HOST, PORT))
-    s.listen()
-    print("signal server on", (HOST, PORT))
-    while True:
-        conn, addr = s.accept()
-        threading.Thread(target=handle_client, args=(conn, addr)).start()
+            peer = self.tokens.get(json.loads(data).get("token"))
+        except (ValueError, AttributeError):
+            return
+        if peer is None:
+            return
+        first = peer.addr is None
+        if peer.addr != addr:
+            if not first:
+                logger.info("%s mapping changed %s:%d -> %s:%d", peer.id, *peer.addr, *addr)
+            peer.addr = addr
+            self.send(peer, {"type": "observed", "addr": list(addr)})
+        self.udp.sendto(json.dumps({"addr": list(addr)}).encode(), addr)
+        if first:
+            for other_id in self.pending.pop(peer.id, ()):
+                other = self.peers.get(other_id)
+                if other is not None and other.addr is not None:
+                    self.pending.get(other_id, set()).discard(peer.id)
+                    self.introduce(peer, other)
+
+    # ========== TCP ==========
+    def send(self, peer, msg):
+        transport = peer.writer.transport
+        if transport.is_closing():
+            return
+        if transport.get_write_buffer_size() > MAX_WRITE_BUFFER:
+            logger.warning("%s is not reading, dropping it", peer.id)
+            transport.abort()
+            return
+        write_msg(peer.writer, msg)
+
+    def introduce(self, a, b):
+        """把两端的地址互相告诉对方，两边同时开始打洞"""
+        for me, other in ((a, b), (b, a)):
+            self.send(me, {"type": "peer", "id": other.id, "addr": list(other.addr),
+                           "local": other.local})
+        self.introduced += 1
+        logger.debug("Introduced %s (%s:%d) and %s (%s:%d)", a.id, *a.addr, b.id, *b.addr)
+
+    def connect(self, peer, target_id):
+        target = self.peers.get(target_id)
+        if peer.addr is None or target is None or target.addr is None:
+            # 有一方还没上线或者 UDP 保活还没到：后到的那个报上地址时再介绍
+            self.pending.setdefault(peer.id, set()).add(target_id)
+            self.pending.setdefault(target_id, set()).add(peer.id)
+            self.send(peer, {"type": "waiting", "to": target_id})
+            return
+        self.introduce(peer, target)
+
+    async def handle(self, reader, writer):
+        peer = None
+        try:
+            msg = await asyncio.wait_for(read_msg(reader), REGISTER_TIMEOUT)
+            if not msg or msg.get("type") != "register" or not msg.get("id"):
+                write_msg(writer, {"type": "error", "error": "register_first"})
+                return
+            old = self.peers.get(msg["id"])
+            if old is not None:
+                logger.info("%s registered again, closing the old connection", old.id)
+                old.writer.transport.abort()
+                self.drop(old)
+            peer = Peer(str(msg["id"]), writer, msg.get("local"))
+            self.peers[peer.id] = peer
+            self.tokens[peer.token] = peer
+            self.send(peer, {"type": "registered", "token": peer.token,
+                             "tcp_addr": list(writer.get_extra_info("peername")[:2])})
+            logger.debug("%s registered from %s", peer.id, writer.get_extra_info("peername"))
+
+            while True:
+                msg = await read_msg(reader)
+                if msg is None:
+                    break
+                if msg.get("type") == "connect":
+                    self.connect(peer, str(msg.get("to")))
+                elif msg.get("to"):
+                    target = self.peers.get(str(msg["to"]))
+                    if target is None:
+                        self.send(peer, {"type": "error", "error": "unknown_peer", "to": msg["to"]})
+                        continue
+                    msg["from"] = peer.id
+                    self.send(target, msg)
+                    self.relayed += 1
+        except (asyncio.TimeoutError, ValueError) as e:
+            logger.debug("Dropping client %s: %s", writer.get_extra_info("peername"), e or "timeout")
+        finally:
+            if peer is not None:
+                self.drop(peer)
+            writer.close()
+
+    def drop(self, peer):
+        if self.peers.get(peer.id) is peer:
+            del self.peers[peer.id]
+            self.pending.pop(peer.id, None)
+        self.tokens.pop(peer.token, None)
+
+    async def stats_loop(self):
+        while True:
+            await asyncio.sleep(STATS_INTERVAL)
+            logger.info("%d peers, %d introductions, %d messages relayed",
+                        len(self.peers), self.introduced, self.relayed)
+
+
+async def main(args):
+    rv = Rendezvous()
+    loop = asyncio.get_running_loop()
+    await loop.create_datagram_endpoint(lambda: rv, local_addr=(args.host, args.port))
+    server = await asyncio.start_server(rv.handle, args.host, args.port, backlog=args.backlog)
+    logger.info("Rendezvous server on %s:%d (tcp + udp)", args.host, args.port)
+    asyncio.ensure_future(rv.stats_loop())
+    async with server:
+        await server.serve_forever()
+
 
 if __name__ == "__main__":
-    main()
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--host", default=HOST)
+    parser.add_argument("--port", type=int, default=PORT)
+    parser.add_argument("--backlog", type=int, default=4096,
+                        help="listen backlog; raise ulimit -n too for thousands of peers")
+    parser.add_argument("--log-level", default="INFO")
+    args = parser.parse_args()
+    logging.getLogger().setLevel(args.log_level)
+    asyncio.run(main(args))
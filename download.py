@@ -0,0 +1,390 @@
+# download.py - 接收端的落盘状态：输出文件、分片位图、清单校验、进度
+# 一个 Download 可以被多条 PeerConnection 共用（swarm 模式下每个发送端一条）
+# 收的时候写在 <输出>.part 里，整文件校验通过后才 rename 成输出，别人不会看到写了一半的文件
+
+import asyncio
+import logging
+import os
+import shutil
+import time
+
+import cas
+import tree
+from common import ChunkBitmap, OrderedHasher, human
+from manifest import Manifest, decode_hashes
+from telemetry import Progress
+from writer import SYNC_BYTES, SYNC_INTERVAL, DiskFile, WritePipeline, sync_dir
+
+PART_SUFFIX = ".part"
+DEFAULT_MAX_BUFFER = 64 * 1024 * 1024     # 还没落盘的分片最多占这么多内存
+
+logger = logging.getLogger("fetch")
+
+
+class Download:
+    def __init__(self, output=None, overwrite=False, resume=True, quiet=False,
+                 max_buffer=DEFAULT_MAX_BUFFER, durability="periodic",
+                 sync_bytes=SYNC_BYTES, sync_interval=SYNC_INTERVAL):
+        self.output = output
+        self.overwrite = overwrite
+        self.resume = resume
+        self.quiet = quiet
+        self.max_buffer = max_buffer
+        self.durability = durability   # 见 writer.py 开头
+        self.sync_bytes = sync_bytes
+        self.sync_interval = sync_interval
+        self.meta = None
+        self.manifest = None       # 分片哈希清单，全部到齐且根哈希对上才启用
+        self.leaves = []
+        self.entries = None        # 目录模式下的文件列表，收齐并校验后才建输出
+        self.received = None       # ChunkBitmap
+        self.remote_digest = None  # meta 里带了或者收到 eof 后才有
+        self.file = None           # writer.DiskFile 或 tree.TreeFile
+        self.hasher = None         # 续传时为 None，收尾时整文件重算
+        self.out_path = None
+        self.part_path = None      # 收的时候写这里，校验通过后 rename 成 out_path
+        self.sidecar = None
+        self.recv_size = 0
+        self.resumed_size = 0
+        self.start_ts = time.time()
+        self.progress = Progress(quiet)
+        # 落盘流水线：排队字节数在事件循环这边统计，用来做背压
+        self.pipeline = None
+        self.durable = None        # 写线程维护的已 fsync 位图
+        self.pending = set()       # 已经交给流水线、还没出结果的分片
+        self.filling = set()       # 要从本地分片仓库（cas.ChunkStore）填、还没校验落盘的分片
+        self.partial = {}          # (发送端, 分片序号) -> 拼到一半的 bytearray
+        self.queued = 0
+        self.paused = False
+        self.failed = None
+        self.on_result = None      # (index, ok, tag, nbytes)
+        self.on_pressure = None    # (paused)
+        self.on_failed = None      # (exc)
+
+    def read_back(self, index):
+        cs = self.meta["chunk_size"]
+        return self.file.read_at(index * cs, cs)
+
+    def chunk_len(self, index):
+        cs = self.meta["chunk_size"]
+        return min(cs, self.meta["size"] - index * cs)
+
+    def matches(self, meta) -> bool:
+        """另一个发送端的 meta 是不是同一个文件（swarm 模式用）"""
+        keys = ("size", "chunk_size", "chunks", "root", "sha256", "files_sha256")
+        return all(meta.get(k) == self.meta.get(k) for k in keys)
+
+    def pick_output(self, meta):
+        """返回 (输出路径, 可续传的位图或 None)；续传看的是 <输出>.part 和 sidecar"""
+        out_name = self.output if self.output else meta["name"]
+        path = os.path.abspath(out_name)
+        base, ext = os.path.splitext(path)
+        k = 1
+        while True:
+            if self.resume and os.path.exists(path + PART_SUFFIX):
+                bitmap = ChunkBitmap.load(path + ".chunks", meta)
+                if bitmap is not None:
+                    return path, bitmap
+            if self.overwrite or not os.path.exists(path):
+                return path, None
+            path = f"{base}.recv{'' if k==1 else k}{ext}"
+            k += 1
+
+    def start(self, meta):
+        self.meta = meta
+        self.remote_digest = meta.get("sha256")
+        self.leaves = []
+        self.out_path, self.received = self.pick_output(meta)
+        self.part_path = self.out_path + PART_SUFFIX
+        self.sidecar = self.out_path + ".chunks"
+        if "files" in meta:
+            self.entries = []  # 等 files 消息收齐
+        else:
+            self._open()
+
+    def _open(self):
+        meta = self.meta
+        resumed = self.received is not None
+        if self.entries is not None:
+            self.file = tree.TreeFile(self.part_path, self.entries)
+        else:
+            self.file = DiskFile(self.part_path, create=not resumed)
+        if resumed:
+            self.hasher = None
+            self.resumed_size = sum(self.chunk_len(i) for i in range(len(self.received))
+                                    if i in self.received)
+            logger.info("Resuming %s: %d/%d chunks already on disk",
+                        self.out_path, self.received.count, len(self.received))
+        else:
+            self.hasher = OrderedHasher(self.read_back)
+            self.received = ChunkBitmap(int(meta["chunks"]))
+            self.resumed_size = 0
+        # 分片按偏移写入，先把文件撑到目标大小并分配好空间
+        self.file.allocate(int(meta["size"]))
+        self.received.save(self.sidecar, meta)
+        self.durable = ChunkBitmap(len(self.received), self.received.bits)
+        self.recv_size = self.resumed_size
+        self.start_ts = time.time()
+        what = f"directory ({len(self.entries)} entries)" if self.entries is not None else "file"
+        logger.info("Receiving %s: %s (expect %d bytes, %d chunks)",
+                    what, self.out_path, int(meta["size"]), int(meta["chunks"]))
+
+    def add_file_list_part(self, j):
+        if j["start"] != len(self.entries):
+            logger.error("File list part out of order: start=%d, have %d",
+                         j["start"], len(self.entries))
+            return
+        self.entries.extend(tree.decode_file_list(j["data"]))
+
+    def add_manifest_part(self, j):
+        if j["start"] != len(self.leaves):
+            logger.error("Manifest part out of order: start=%d, have %d",
+                         j["start"], len(self.leaves))
+            return
+        self.leaves.extend(decode_hashes(j["hashes"]))
+
+    def ready(self) -> bool:
+        """文件列表、清单（如果有）收齐并校验后才能开始收数据；校验不过抛 ValueError"""
+        if self.pipeline is not None:
+            return True
+        if self.file is None:
+            if len(self.entries) < self.meta["files"]:
+                return False
+            if tree.list_sha256(self.entries) != self.meta["files_sha256"]:
+                raise ValueError("file list does not match files_sha256 in meta")
+            tree.check_entries(self.entries)
+            self._open()
+        if "root" in self.meta:
+            if len(self.leaves) < self.meta["chunks"]:
+                return False
+            m = Manifest(self.meta["chunk_size"], self.leaves)
+            if m.root != self.meta["root"]:
+                raise ValueError(f"merkle root mismatch: got {m.root}, meta says {self.meta['root']}")
+            self.manifest = m
+            logger.info("Chunk manifest verified, merkle root=%s", m.root)
+            if self.resumed_size:
+                self._verify_resumed()
+        self.pipeline = WritePipeline(
+            asyncio.get_event_loop(), self.file, self.meta, self.manifest, self.hasher,
+            self.durable, self.sidecar, self._verified, self._written, self._failed,
+            self.durability, self.sync_bytes, self.sync_interval)
+        return True
+
+    def _verify_resumed(self):
+        """续传下来的分片按清单重新校验一遍，对不上的从位图里去掉重新要（finish 靠位图里的都校验过）"""
+        bad = [i for i in range(len(self.received))
+               if i in self.received and not self.manifest.verify(i, self.read_back(i))]
+        for i in bad:
+            self.received.discard(i)
+            self.durable.discard(i)
+            self.resumed_size -= self.chunk_len(i)
+        self.recv_size = self.resumed_size
+        if bad:
+            logger.warning("%d resumed chunks do not match the manifest, fetching them again", len(bad))
+            self.received.save(self.sidecar, self.meta)
+
+    def assemble(self, index, offset, data, tag=None):
+        """按片内偏移把一片拼进分片：拼齐了返回整个分片的数据，否则 None
+
+        片按发送端分开拼；压缩的片并行解压，拼的时候不一定按顺序。
+        """
+        if index >= len(self.received) or index in self.received:
+            return data  # 交给 accept 当重复处理
+        size = self.chunk_len(index)
+        if offset == 0 and len(data) == size:
+            return data  # 整个分片一片发完，不用拷
+        if offset + len(data) > size:
+            logger.debug("Piece of chunk %d at offset %d overruns the chunk, dropping", index, offset)
+            return None
+        key = (tag, index)
+        entry = self.partial.get(key)
+        if entry is None:
+            entry = self.partial[key] = [bytearray(size), set(), 0]
+        buf, offsets, filled = entry
+        if offset in offsets:
+            return None
+        buf[offset:offset + len(data)] = data
+        offsets.add(offset)
+        entry[2] = filled = filled + len(data)
+        if filled < size:
+            return None
+        del self.partial[key]
+        return buf
+
+    def drop_partial(self, tag, index=None):
+        for key in [k for k in self.partial if k[0] == tag and index in (None, k[1])]:
+            del self.partial[key]
+
+    def accept(self, index, data, tag=None) -> str:
+        """把分片交给落盘流水线，返回 queued / dup / busy（缓冲满了，稍后重新要）
+
+        校验和写盘的结果之后通过 on_result 回调通知。
+        """
+        if (self.pipeline is None or self.failed or index >= len(self.received)
+                or index in self.received or index in self.pending):
+            return "dup"
+        if self.queued + len(data) > self.max_buffer:
+            return "busy"
+        self.pending.add(index)
+        self.queued += len(data)
+        self.pipeline.submit(index, data, tag)
+        if not self.paused and self.queued >= self.max_buffer // 2:
+            self.paused = True
+            logger.debug("Write queue at %s, pausing senders", human(self.queued))
+            if self.on_pressure:
+                self.on_pressure(True)
+        return "queued"
+
+    def _verified(self, index, ok, tag, nbytes):
+        self.pending.discard(index)
+        self.filling.discard(index)
+        if ok:
+            self.received.add(index)
+            self.recv_size += nbytes
+        else:
+            self.queued -= nbytes
+            self._maybe_resume()
+        if self.on_result:
+            self.on_result(index, ok, tag, nbytes)
+
+    def _written(self, nbytes):
+        self.queued -= nbytes
+        self._maybe_resume()
+        self.print_progress()
+
+    def _failed(self, exc):
+        self.failed = exc
+        if self.on_failed:
+            self.on_failed(exc)
+
+    def _maybe_resume(self):
+        if self.paused and self.queued <= self.max_buffer // 4:
+            self.paused = False
+            logger.debug("Write queue drained to %s, resuming senders", human(self.queued))
+            if self.on_pressure:
+                self.on_pressure(False)
+
+    # ====== 本地分片仓库 ======
+    def store_hits(self, store):
+        """还缺的分片里仓库已经有的，记进 filling；没有清单时没法按哈希找，返回空"""
+        if self.manifest is None:
+            return []
+        hits = [i for i in self.received.missing() if self.manifest.leaves[i] in store]
+        self.filling.update(hits)
+        return hits
+
+    def have_bitmap(self) -> str:
+        """回给发送端的 have：已经收到的加上正在从仓库填的"""
+        if not self.filling:
+            return self.received.encode()
+        bits = ChunkBitmap(len(self.received), self.received.bits)
+        for i in self.filling:
+            bits.add(i)
+        return bits.encode()
+
+    async def fill_from_store(self, store, hits):
+        """把仓库里的分片交给落盘流水线，返回仓库里读不到的（要找发送端要）"""
+        lost = []
+        for index in hits:
+            data = await asyncio.to_thread(store.get, self.manifest.leaves[index])
+            if self.file is None or self.failed:
+                return lost
+            if data is None:
+                self.filling.discard(index)
+                lost.append(index)
+                continue
+            while (status := self.accept(index, data, cas.STORE_TAG)) == "busy":
+                await asyncio.sleep(0.05)
+            if status != "queued":
+                self.filling.discard(index)
+        return lost
+
+    async def ingest(self, store):
+        """校验通过的结果收进仓库，下次下载重叠的内容就不用再传"""
+        if self.manifest is None:
+            return
+        if self.entries is not None:
+            reader = tree.TreeFile(self.out_path, self.entries)
+        else:
+            reader = DiskFile(self.out_path, create=False)
+        try:
+            added = await asyncio.to_thread(store.ingest, reader.read_at, self.manifest.leaves,
+                                            self.meta["chunk_size"])
+        finally:
+            reader.close()
+        logger.info("Chunk store: added %d chunks, now %d chunks, %s",
+                    added, len(store), human(store.size))
+
+    def complete(self) -> bool:
+        return (self.file is not None and self.received.complete()
+                and self.remote_digest is not None)
+
+    def print_progress(self, done=False):
+        if not self.meta["size"]:
+            return
+        pct = self.recv_size / self.meta["size"] * 100
+        elapsed = time.time() - self.start_ts
+        speed = (self.recv_size - self.resumed_size) / max(elapsed, 1e-6)
+        self.progress.update(
+            f"Receiving {os.path.basename(self.out_path)}: "
+            f"{human(self.recv_size)}/{human(self.meta['size'])} "
+            f"({pct:.1f}%) avg {human(speed)}/s", done)
+
+    def write_latencies(self):
+        """取走写线程记下的每批写盘耗时（telemetry 用）"""
+        out = []
+        if self.pipeline is not None:
+            q = self.pipeline.latencies
+            while q:
+                out.append(q.popleft())
+        return out
+
+    async def suspend(self):
+        """连接断了：把排队的分片写完、fsync、存好位图，下次续传"""
+        if self.file is None:
+            return
+        file, self.file = self.file, None
+        if self.pipeline is not None:
+            await asyncio.to_thread(self.pipeline.close)
+        file.close()
+
+    async def finish(self) -> bool:
+        """所有分片到齐后收尾，返回整文件校验是否通过"""
+        file, self.file = self.file, None
+        await asyncio.to_thread(self.pipeline.close)
+        file.close()
+        if self.hasher is not None:
+            local_digest = self.hasher.hexdigest()
+        elif self.manifest is not None:
+            # 每个分片都按清单校验过（位图里只记校验通过的），不用再读一遍盘
+            local_digest = self.remote_digest
+            logger.info("All chunks verified against merkle root %s", self.manifest.root)
+        else:
+            # 续传的文件前半段不在这次的数据流里，只能读盘重算
+            local_digest = await asyncio.to_thread(file.digest)
+        self.print_progress(done=True)
+        if not self.quiet:
+            print()  # 换行，避免进度和日志挤一行
+        logger.info("Transfer complete, local sha256=%s", local_digest)
+        if self.remote_digest != local_digest:
+            logger.warning("SHA256 mismatch! remote=%s, data left in %s",
+                           self.remote_digest, self.part_path)
+            return False
+        logger.info("SHA256 verified OK")
+        await asyncio.to_thread(file.finalize)
+        await asyncio.to_thread(self._commit)
+        # 校验通过、rename 完才删位图，中途出错或者没对上还能按位图续传/排查
+        os.remove(self.sidecar)
+        return True
+
+    def _commit(self):
+        """校验通过：<输出>.part 原子地 rename 成输出"""
+        if os.path.lexists(self.out_path) and (os.path.isdir(self.part_path) or os.path.isdir(self.out_path)):
+            # 只有 --overwrite 才会走到这里：目录没法直接 rename 覆盖，先删掉旧的
+            if os.path.isdir(self.out_path) and not os.path.islink(self.out_path):
+                shutil.rmtree(self.out_path)
+            else:
+                os.remove(self.out_path)
+        os.replace(self.part_path, self.out_path)
+        if self.durability != "none":
+            sync_dir(self.out_path)
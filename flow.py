@@ -0,0 +1,224 @@
+# flow.py - 发送端的流量控制：不再定时轮询 bufferedAmount，靠 bufferedamountlow 事件唤醒
+#
+# 窗口（所有通道合计允许堆在发送缓冲里的字节数）≈ 最大吞吐 × 最小 RTT × GAIN，
+# 也就是带宽时延积再留点余量：直连的快路径上窗口跟着放大把管道塞满，
+# 走 TURN 中继时吞吐低、窗口跟着缩小，不会在缓冲里堆一大堆数据。
+#
+# 吞吐 = 单位时间里从 DataChannel 缓冲交给 SCTP 的字节数，取最近几秒的最大值（应用层没数据可发时的样本偏低）；
+# RTT 用控制通道上的 ping/pong 测，aiortc 所有通道共用一个发送队列，ping 前面排着的数据按吞吐折算掉。
+#
+# 片大小（一条消息带多少数据）也在这里调，见 PieceSizer。
+
+import asyncio
+import logging
+import time
+from collections import deque
+
+from common import MIN_PIECE, human
+
+logger = logging.getLogger("seeder")
+
+MIN_WINDOW = 256 * 1024
+MAX_WINDOW = 16 * 1024 * 1024
+INITIAL_WINDOW = 512 * 1024   # 还没测到吞吐时先用这个，和以前的固定值差不多
+DEFAULT_RTT = 0.05            # 还没收到 pong 时按 50ms 算
+GAIN = 2.0
+RATE_INTERVAL = 0.2           # 吞吐采样间隔
+FILTER_SECONDS = 10.0         # 最大吞吐 / 最小 RTT 只看最近 10 秒
+PING_INTERVAL = 1.0
+PIECE_EPOCH = 2.0             # 每个片大小至少跑 2 秒再比吞吐
+PIECE_GAIN = 1.05             # 吞吐高出 5% 才算更好
+PIECE_HOLD = 5                # 一次试探没带来好处，歇几轮再试
+
+
+class WindowedFilter:
+    """最近 FILTER_SECONDS 秒里的最大（或最小）值"""
+
+    def __init__(self, better):
+        self.better = better
+        self._samples = deque()  # (ts, value)
+
+    def update(self, value, now=None):
+        now = time.monotonic() if now is None else now
+        # 新样本比队尾的好，队尾那些以后也不可能再是最值了
+        while self._samples and not self.better(self._samples[-1][1], value):
+            self._samples.pop()
+        self._samples.append((now, value))
+        while self._samples[0][0] < now - FILTER_SECONDS:
+            self._samples.popleft()
+
+    @property
+    def value(self):
+        return self._samples[0][1] if self._samples else None
+
+
+class FlowControl:
+    def __init__(self, channels, fixed_window=None):
+        self.channels = list(channels)
+        self.fixed = fixed_window  # 给了就不自适应（压测时扫窗口大小用）
+        self.window = fixed_window or INITIAL_WINDOW
+        self.max_rate = WindowedFilter(lambda old, new: old > new)
+        self.min_rtt = WindowedFilter(lambda old, new: old < new)
+        self.sent_bytes = 0
+        self.stall_seconds = 0.0  # 各通道等缓冲降下来的时间之和
+        self._mark_ts = time.monotonic()
+        self._mark_drained = 0
+        self._pings = {}      # ping 序号 -> (发出时间, 前面排着的字节数)
+        self._ping_seq = 0
+        self._waiters = {}    # 通道 -> future
+        for ch in self.channels:
+            self._watch(ch)
+        self._set_thresholds()
+
+    def _watch(self, ch):
+        @ch.on("bufferedamountlow")
+        def on_low():
+            self._sample()
+            self._wake(ch)
+
+        @ch.on("close")
+        def on_close():
+            self._wake(ch)
+
+    def _wake(self, ch):
+        fut = self._waiters.pop(ch, None)
+        if fut is not None and not fut.done():
+            fut.set_result(None)
+
+    def _share(self) -> int:
+        return max(MIN_WINDOW // len(self.channels), self.window // len(self.channels))
+
+    def _set_thresholds(self):
+        for ch in self.channels:
+            ch.bufferedAmountLowThreshold = self._share() // 2
+            # 阈值调高以后缓冲可能已经在阈值以下，不会再有事件了，让等着的重新检查
+            self._wake(ch)
+
+    def buffered(self) -> int:
+        return sum(ch.bufferedAmount for ch in self.channels)
+
+    async def wait(self, ch):
+        """等到这条通道的缓冲低于它那份窗口"""
+        if ch.readyState != "open" or ch.bufferedAmount <= self._share():
+            return
+        t0 = time.monotonic()
+        while ch.readyState == "open" and ch.bufferedAmount > self._share():
+            fut = self._waiters.get(ch)
+            if fut is None:
+                fut = self._waiters[ch] = asyncio.get_event_loop().create_future()
+            await fut
+        self.stall_seconds += time.monotonic() - t0
+
+    def sent(self, nbytes):
+        self.sent_bytes += nbytes
+        self._sample()
+
+    def drained(self) -> int:
+        """已经从 DataChannel 缓冲交给 SCTP 的总字节数"""
+        return self.sent_bytes - self.buffered()
+
+    def _sample(self):
+        now = time.monotonic()
+        dt = now - self._mark_ts
+        if dt < RATE_INTERVAL:
+            return
+        drained = self.drained()
+        self.max_rate.update((drained - self._mark_drained) / dt, now)
+        self._mark_ts = now
+        self._mark_drained = drained
+        self._update_window()
+
+    def _update_window(self):
+        rate = self.max_rate.value
+        if not rate or self.fixed:
+            return
+        rtt = self.min_rtt.value or DEFAULT_RTT
+        window = int(rate * rtt * GAIN)
+        self.window = max(MIN_WINDOW, min(MAX_WINDOW, window))
+        self._set_thresholds()
+
+    # ---------- RTT ----------
+    def ping(self) -> dict:
+        self._ping_seq += 1
+        self._pings[self._ping_seq] = (time.monotonic(), self.buffered())
+        # 对端掉线或者不回 pong 时别无限攒
+        while len(self._pings) > 16:
+            self._pings.pop(next(iter(self._pings)))
+        return {"kind": "ping", "seq": self._ping_seq}
+
+    def on_pong(self, j):
+        sent = self._pings.pop(j.get("seq"), None)
+        if sent is None:
+            return
+        ts, queued = sent
+        elapsed = time.monotonic() - ts
+        rate = self.max_rate.value
+        if rate:
+            elapsed -= queued / rate
+        self.min_rtt.update(max(elapsed, 0.001))
+        self._update_window()
+
+    def stats(self) -> str:
+        rate = self.max_rate.value or 0.0
+        rtt = self.min_rtt.value
+        rtt_text = f"{rtt * 1000:.1f}ms" if rtt is not None else "n/a"
+        return f"window {human(self.window)}, max rate {human(rate)}/s, min rtt {rtt_text}"
+
+
+class PieceSizer:
+    """在 [MIN_PIECE, limit] 里爬山找片大小。
+
+    大片省每条消息的固定开销（帧头、SCTP 分块、回调），小片在慢链路上让流控和多通道分配更细；
+    哪个好不好算，直接看吞吐：每轮按当前片大小跑一段，比上一轮好就接着往同一方向走，
+    没变好就退回去、掉头、歇几轮。
+    """
+
+    def __init__(self, flow, limit):
+        self.flow = flow
+        self.low = min(MIN_PIECE, limit)
+        self.high = limit
+        self.size = limit
+        self.direction = -1
+        self.hold = 1      # 第一轮含建连和慢启动，只当基线
+        self._prev = None  # 上一轮的 (片大小, 吞吐)
+        self._mark = (time.monotonic(), flow.drained())
+
+    def current(self) -> int:
+        now = time.monotonic()
+        ts, drained = self._mark
+        if now - ts >= PIECE_EPOCH:
+            self._mark = (now, self.flow.drained())
+            self._step((self._mark[1] - drained) / (now - ts))
+        return self.size
+
+    def _step(self, rate):
+        prev, self._prev = self._prev, (self.size, rate)
+        if self.hold:
+            self.hold -= 1
+            return
+        if prev is not None and prev[0] != self.size:
+            prev_size, prev_rate = prev
+            better = rate > prev_rate * PIECE_GAIN
+            worse = rate * PIECE_GAIN < prev_rate
+            # 变小了却没变快、或者变大了反而变慢：退回去（差不多时宁可用大片）
+            if (self.size < prev_size and not better) or (self.size > prev_size and worse):
+                self._resize(prev_size, rate)
+                self._prev = prev
+                self.direction = -self.direction
+                self.hold = PIECE_HOLD
+                return
+            if not better:
+                self.hold = PIECE_HOLD
+                return
+        size = self.size * 2 if self.direction > 0 else self.size // 2
+        size = max(self.low, min(self.high, size))
+        if size == self.size:
+            self.direction = -self.direction
+            self.hold = PIECE_HOLD
+            return
+        self._resize(size, rate)
+
+    def _resize(self, size, rate):
+        logger.debug("Piece size %s -> %s (throughput %s/s)",
+                     human(self.size), human(size), human(rate))
+        self.size = size
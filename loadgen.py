@@ -0,0 +1,129 @@
+# loadgen.py - 信令服务器压测：同时开很多个模拟房间，统计 join 到收到 answer 的延迟
+#
+# 每个房间一对模拟客户端，流程和 seeder.py / p2p_get.py 一样：
+#   发送端 join -> 发 offer（接收端还没来，服务器先缓存）
+#   接收端 join（开始计时）-> 收到回放的 offer -> 回 answer 和几条 ice -> 发送端收到 answer（停止计时）
+# --stalled 另开几个"卡住"的房间：接收端进房间后不再读，发送端一直往它发 ice，
+# 用来看一个读不动的连接会不会拖慢其它房间。
+
+import argparse
+import asyncio
+import json
+import time
+
+import websockets
+
+FAKE_SDP = "v=0\r\n" + "a=x-loadgen:" + "x" * 1500 + "\r\n"  # 大小和真的 SDP 差不多
+
+
+async def join(ws, room, role):
+    await ws.send(json.dumps({"type": "join", "room": room, "role": role}))
+    while True:
+        msg = json.loads(await ws.recv())
+        if msg.get("type") == "joined":
+            return msg
+
+
+async def one_room(send_url, recv_url, room, ice):
+    """跑一个房间，返回 join 到 answer 的秒数"""
+    async with websockets.connect(send_url) as sender, websockets.connect(recv_url) as receiver:
+        await join(sender, room, "sender")
+        await sender.send(json.dumps({"type": "sdp", "data": {"sdp": FAKE_SDP, "type": "offer"}}))
+        t0 = time.perf_counter()
+        await join(receiver, room, "receiver")
+        while json.loads(await receiver.recv()).get("type") != "sdp":
+            pass
+        await receiver.send(json.dumps({"type": "sdp", "data": {"sdp": FAKE_SDP, "type": "answer"}}))
+        for k in range(ice):
+            await receiver.send(json.dumps({"type": "ice", "data": {"candidate": f"candidate:{k}"}}))
+        while json.loads(await sender.recv()).get("type") != "sdp":
+            pass
+        return time.perf_counter() - t0
+
+
+async def stalled_room(url, room, stop):
+    """接收端不读，发送端不停地发"""
+    # max_queue=1：收到的消息没人取就不再从 socket 读；关掉压缩，不然几 KB 的 ice 压完只剩几十字节，
+    # 服务器那边的发送缓冲要很久才满
+    async with websockets.connect(url, compression=None) as sender, \
+            websockets.connect(url, compression=None, max_queue=1) as receiver:
+        await join(sender, room, "sender")
+        await join(receiver, room, "receiver")
+        blob = json.dumps({"type": "ice", "data": {"candidate": "x" * 4000}})
+        sent = 0
+        while not stop.is_set():
+            try:
+                await sender.send(blob)
+            except websockets.ConnectionClosed:
+                break
+            sent += 1
+            if sent % 64 == 0:
+                await asyncio.sleep(0)
+        return sent
+
+
+def percentile(sorted_values, p):
+    if not sorted_values:
+        return float("nan")
+    k = min(len(sorted_values) - 1, int(round(p / 100 * (len(sorted_values) - 1))))
+    return sorted_values[k]
+
+
+async def run(args):
+    latencies = []
+    errors = 0
+    sem = asyncio.Semaphore(args.concurrency)
+    stop = asyncio.Event()
+    urls = args.url.split(",")
+    stalled = [asyncio.ensure_future(stalled_room(urls[0], f"stalled-{k}", stop))
+               for k in range(args.stalled)]
+    if stalled:
+        await asyncio.sleep(1)  # 先让卡住的连接把服务器那边的缓冲堆满
+
+    async def room(k):
+        nonlocal errors
+        async with sem:
+            try:
+                # 给了几个地址时发送端和接收端连不同的 worker
+                latencies.append(await asyncio.wait_for(
+                    one_room(urls[k % len(urls)], urls[(k + 1) % len(urls)],
+                             f"{args.prefix}-{k}", args.ice), args.timeout))
+            except (OSError, asyncio.TimeoutError, websockets.WebSocketException):
+                errors += 1
+
+    start = time.perf_counter()
+    await asyncio.gather(*(room(k) for k in range(args.rooms)))
+    elapsed = time.perf_counter() - start
+    stop.set()
+    flooded = 0
+    for t in stalled:
+        try:
+            flooded += await asyncio.wait_for(t, 5)
+        except (asyncio.TimeoutError, OSError, websockets.WebSocketException):
+            pass
+
+    latencies.sort()
+    ms = [x * 1000 for x in latencies]
+    print(f"rooms {args.rooms}, concurrency {args.concurrency}, "
+          f"stalled {args.stalled} ({flooded} messages pushed at them)")
+    print(f"completed {len(ms)}, errors {errors}, {elapsed:.2f}s, "
+          f"{len(ms) / max(elapsed, 1e-6):.0f} rooms/s")
+    if ms:
+        print("join->answer ms: " + ", ".join(
+            f"p{p} {percentile(ms, p):.1f}" for p in (50, 90, 99)) + f", max {ms[-1]:.1f}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--url", default="ws://127.0.0.1:8765",
+                        help="signaling server; several comma-separated URLs spread each room across them")
+    parser.add_argument("--rooms", type=int, default=2000)
+    parser.add_argument("--concurrency", type=int, default=500,
+                        help="rooms in flight at once (each room is two connections)")
+    parser.add_argument("--ice", type=int, default=4, help="ice messages sent after each answer")
+    parser.add_argument("--stalled", type=int, default=0,
+                        help="extra rooms whose receiver stops reading")
+    parser.add_argument("--timeout", type=float, default=30)
+    parser.add_argument("--prefix", default="load")
+    args = parser.parse_args()
+    asyncio.run(run(args))
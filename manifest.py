@@ -0,0 +1,165 @@
+# manifest.py - 分片哈希清单：每个分片一个 sha256，外加一棵 Merkle 树的根
+#
+# 建清单要把文件读一遍，大文件很慢：分片哈希按区段分给线程池并行算（hashlib 算的时候不占 GIL），
+# 算好的清单按 (设备, inode, 大小, mtime) 存在 ~/.cache/p2pshare/manifests/，文件没动过下次直接用。
+
+import base64
+import hashlib
+import json
+import logging
+import os
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+MANIFEST_BATCH = 4096  # 每条 manifest 消息带多少个分片哈希（4096 * 32B = 128KB）
+HASH_WORKERS = min(8, os.cpu_count() or 1)
+REGION_CHUNKS = 32     # 一个线程一次算多少个分片
+CACHE_DIR = os.path.join(os.environ.get("XDG_CACHE_HOME") or os.path.expanduser("~/.cache"),
+                         "p2pshare", "manifests")
+CACHE_ENTRIES = 256    # 最多存这么多个文件的清单，多了删最久的
+
+logger = logging.getLogger("manifest")
+
+
+def merkle_root(leaves) -> str:
+    """两两拼接再 sha256，奇数个时最后一个直接升到上一层"""
+    level = list(leaves)
+    if not level:
+        return hashlib.sha256(b"").hexdigest()
+    while len(level) > 1:
+        nxt = [hashlib.sha256(level[i] + level[i + 1]).digest()
+               for i in range(0, len(level) - 1, 2)]
+        if len(level) % 2:
+            nxt.append(level[-1])
+        level = nxt
+    return level[0].hex()
+
+
+class Manifest:
+    def __init__(self, chunk_size: int, leaves, sha256: str = None, root: str = None):
+        self.chunk_size = chunk_size
+        self.leaves = list(leaves)
+        self.sha256 = sha256  # 整文件哈希，接收端拼出来的清单里没有
+        self.root = root or merkle_root(self.leaves)  # 缓存里读出来的直接用，几十万个叶子算一遍要一秒
+
+    def __len__(self):
+        return len(self.leaves)
+
+    @classmethod
+    def build(cls, path: str, chunk_size: int):
+        """读一遍文件，同时得到分片哈希和整文件 sha256"""
+        with open(path, "rb") as f:
+            return cls.from_chunks(iter(lambda: f.read(chunk_size), b""), chunk_size)
+
+    @classmethod
+    def from_chunks(cls, chunks, chunk_size: int):
+        """按顺序给出每个分片的数据（目录模式下分片不对应单个文件）"""
+        whole = hashlib.sha256()
+        leaves = []
+        for chunk in chunks:
+            whole.update(chunk)
+            leaves.append(hashlib.sha256(chunk).digest())
+        return cls(chunk_size, leaves, whole.hexdigest())
+
+    @classmethod
+    def build_parallel(cls, view, chunks: int, chunk_size: int, workers: int = HASH_WORKERS):
+        """view(index) 给出分片数据；分片哈希在线程池里按区段并行算，整文件哈希在当前线程按顺序跟上
+
+        同时在算的区段有上限，读进来的数据不会把内存占满，也不会在页缓存里被挤掉再读一遍。
+        """
+        whole = hashlib.sha256()
+        leaves = []
+        starts = iter(range(0, chunks, REGION_CHUNKS))
+        inflight = deque()
+        with ThreadPoolExecutor(max_workers=workers, thread_name_prefix="manifest-hash") as pool:
+            def submit():
+                start = next(starts, None)
+                if start is not None:
+                    inflight.append(pool.submit(_hash_region, view, start,
+                                                min(start + REGION_CHUNKS, chunks)))
+
+            for _ in range(workers * 2):
+                submit()
+            while inflight:
+                parts, digests = inflight.popleft().result()
+                submit()
+                for part in parts:
+                    whole.update(part)
+                    if isinstance(part, memoryview):
+                        part.release()
+                leaves.extend(digests)
+        return cls(chunk_size, leaves, whole.hexdigest())
+
+    def verify(self, index: int, data) -> bool:
+        return hashlib.sha256(data).digest() == self.leaves[index]
+
+    def messages(self, batch: int = MANIFEST_BATCH):
+        for start in range(0, len(self.leaves), batch):
+            part = b"".join(self.leaves[start:start + batch])
+            yield {"kind": "manifest", "start": start,
+                   "hashes": base64.b64encode(part).decode()}
+
+
+def decode_hashes(text: str):
+    raw = base64.b64decode(text)
+    return [raw[i:i + 32] for i in range(0, len(raw), 32)]
+
+
+def _hash_region(view, start, stop):
+    parts = [view(i) for i in range(start, stop)]
+    return parts, [hashlib.sha256(p).digest() for p in parts]
+
+
+# ====== 缓存 ======
+def _cache_path(key) -> str:
+    name = hashlib.sha256(json.dumps(key).encode()).hexdigest()
+    return os.path.join(CACHE_DIR, name + ".manifest")
+
+
+def load_cached(key):
+    """key 对得上的缓存清单，没有或者读不出来返回 None
+
+    文件格式：一行 JSON 头（key、分片大小、整文件哈希、根哈希、分片数），后面是分片哈希原样拼起来。
+    """
+    try:
+        with open(_cache_path(key), "rb") as f:
+            head = json.loads(f.readline())
+            raw = f.read()
+    except (OSError, ValueError):
+        return None
+    if head.get("key") != key or len(raw) != head.get("chunks", -1) * 32:
+        return None
+    leaves = [raw[i:i + 32] for i in range(0, len(raw), 32)]
+    return Manifest(head["chunk_size"], leaves, head["sha256"], head["root"])
+
+
+def save_cached(key, manifest: Manifest):
+    path = _cache_path(key)
+    head = {"key": key, "chunk_size": manifest.chunk_size, "sha256": manifest.sha256,
+            "root": manifest.root, "chunks": len(manifest.leaves)}
+    try:
+        os.makedirs(CACHE_DIR, exist_ok=True)
+        tmp = f"{path}.{os.getpid()}.tmp"
+        with open(tmp, "wb") as f:
+            f.write(json.dumps(head).encode() + b"\n")
+            f.write(b"".join(manifest.leaves))
+        os.replace(tmp, path)
+        _trim_cache()
+    except OSError as e:
+        logger.debug("Cannot write manifest cache %s: %s", path, e)
+
+
+def _trim_cache():
+    entries = []
+    for e in os.scandir(CACHE_DIR):
+        if e.name.endswith(".manifest"):
+            try:
+                entries.append((e.stat().st_mtime, e.path))
+            except FileNotFoundError:
+                pass
+    entries.sort()
+    for _, path in entries[:max(0, len(entries) - CACHE_ENTRIES)]:
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            pass
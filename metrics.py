@@ -0,0 +1,143 @@
+# metrics.py - 信令服务器的指标，Prometheus 文本格式，单独一个 HTTP 端口
+#
+# 不依赖 prometheus_client。热路径上只有整数加法和一次 bisect：
+# 计数器、直方图在事件发生时累加；房间数、队列深度这类量只在被抓取时现算（Gauge 传函数），
+# 没人来抓就没有额外开销。
+
+import asyncio
+import bisect
+import logging
+
+logger = logging.getLogger("signal")
+
+# 单位秒；房间表操作在微秒级，发送排队可能到秒级
+LATENCY_BUCKETS = (5e-6, 1e-5, 2.5e-5, 5e-5, 1e-4, 2.5e-4, 5e-4, 1e-3, 2.5e-3,
+                   5e-3, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0)
+
+
+def _labels(label, value):
+    return f'{{{label}="{value}"}}' if label else ""
+
+
+class Counter:
+    kind = "counter"
+
+    def __init__(self, name, help, label=None):
+        self.name = name
+        self.help = help
+        self.label = label
+        self.values = {}  # 标签值（没有标签时是 None）-> 数
+
+    def inc(self, n=1, value=None):
+        self.values[value] = self.values.get(value, 0) + n
+
+    def samples(self):
+        for value, n in sorted(self.values.items(), key=lambda kv: str(kv[0])):
+            yield self.name + _labels(self.label, value), n
+
+
+class Gauge:
+    """抓取时调 fn() 取值；fn 返回 dict 时按标签展开"""
+    kind = "gauge"
+
+    def __init__(self, name, help, fn, label=None):
+        self.name = name
+        self.help = help
+        self.fn = fn
+        self.label = label
+
+    def samples(self):
+        value = self.fn()
+        if isinstance(value, dict):
+            for k, v in sorted(value.items()):
+                yield self.name + _labels(self.label, k), v
+        else:
+            yield self.name, value
+
+
+class Histogram:
+    kind = "histogram"
+
+    def __init__(self, name, help, buckets=LATENCY_BUCKETS):
+        self.name = name
+        self.help = help
+        self.buckets = tuple(buckets)
+        self.counts = [0] * (len(self.buckets) + 1)  # 最后一格是 +Inf
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, v):
+        self.counts[bisect.bisect_left(self.buckets, v)] += 1
+        self.sum += v
+        self.count += 1
+
+    def samples(self):
+        total = 0
+        for bound, n in zip(self.buckets, self.counts):
+            total += n
+            yield f'{self.name}_bucket{{le="{bound:g}"}}', total
+        yield f'{self.name}_bucket{{le="+Inf"}}', self.count
+        yield f"{self.name}_sum", self.sum
+        yield f"{self.name}_count", self.count
+
+
+class Registry:
+    def __init__(self):
+        self.metrics = {}
+
+    def add(self, metric):
+        self.metrics[metric.name] = metric  # 同名的后注册的为准
+        return metric
+
+    def render(self) -> str:
+        lines = []
+        for m in self.metrics.values():
+            lines.append(f"# HELP {m.name} {m.help}")
+            lines.append(f"# TYPE {m.name} {m.kind}")
+            for name, value in m.samples():
+                lines.append(f"{name} {value:g}" if isinstance(value, float) else f"{name} {value}")
+        return "\n".join(lines) + "\n"
+
+
+REGISTRY = Registry()
+
+
+def counter(name, help, label=None) -> Counter:
+    return REGISTRY.add(Counter(name, help, label))
+
+
+def gauge(name, help, fn, label=None) -> Gauge:
+    return REGISTRY.add(Gauge(name, help, fn, label))
+
+
+def histogram(name, help, buckets=LATENCY_BUCKETS) -> Histogram:
+    return REGISTRY.add(Histogram(name, help, buckets))
+
+
+async def serve(host, port, registry=REGISTRY):
+    """GET /metrics 返回文本格式的指标，其它路径 404"""
+
+    async def on_client(reader, writer):
+        try:
+            request = await asyncio.wait_for(reader.readline(), 5)
+            # 请求头不关心，读掉就行
+            while (await asyncio.wait_for(reader.readline(), 5)) not in (b"\r\n", b"\n", b""):
+                pass
+            parts = request.decode("latin-1").split()
+            if len(parts) >= 2 and parts[0] == "GET" and parts[1].split("?")[0] == "/metrics":
+                status, body = "200 OK", registry.render().encode()
+            else:
+                status, body = "404 Not Found", b"not found\n"
+            writer.write(f"HTTP/1.1 {status}\r\n"
+                         f"Content-Type: text/plain; version=0.0.4\r\n"
+                         f"Content-Length: {len(body)}\r\n"
+                         f"Connection: close\r\n\r\n".encode() + body)
+            await writer.drain()
+        except (asyncio.TimeoutError, ConnectionError):
+            pass
+        finally:
+            writer.close()
+
+    server = await asyncio.start_server(on_client, host, port)
+    logger.info("Metrics on http://%s:%d/metrics", host, port)
+    return server
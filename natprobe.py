@@ -0,0 +1,332 @@
+# natprobe.py - 并发探 STUN 服务器、判断 NAT 类型、结果带 TTL 缓存，给 --stun auto 选 ICE 配置
+#
+# 一个 UDP socket 同时向所有服务器发 Binding 请求（丢了按 0.15s/0.4s 重发），整体超时默认 0.8 秒，
+# 第一个回应到了之后只再等一小会儿：
+#   都没回              blocked    UDP 出不去，只能走 TURN
+#   映射地址就是本机地址  open       没有 NAT，host 候选就够了，不用 STUN
+#   不同服务器看到的端口不一样  symmetric  srflx 候选对别人没用，有 TURN 就直接 TURN
+#   都一样              cone       支持 RFC 5780 的服务器（带 OTHER-ADDRESS）再用 CHANGE-REQUEST 细分
+#                                  full-cone / restricted-cone / port-restricted-cone
+# 结果缓存在 ~/.cache/p2pshare/nat.json，本机地址变了（换网络）或者过了 TTL 就重新探。
+# seeder.py / p2p_get.py 的 --stun auto 用 resolve_stun()：选最快的 STUN，或者干脆不用 STUN。
+#
+#   python natprobe.py                      探一次并打印
+#   python natprobe.py --serve 127.0.0.1:3479 --shift 7   本地 STUN 替身（报的端口加 7，冒充 NAT）
+#   python natprobe.py --servers stun:127.0.0.1:3479,stun:127.0.0.1:3480 --no-cache
+
+import argparse
+import asyncio
+import json
+import logging
+import os
+import socket
+import struct
+import time
+
+from aioice.ice import get_host_addresses
+
+import stunmsg
+
+logger = logging.getLogger("natprobe")
+
+# 常见 STUN 服务器（和 connect/test.py 里的一样）
+STUN_SERVERS = [
+    "stun:stun.l.google.com:19302",
+    "stun:stun1.l.google.com:19302",
+    "stun:stun2.l.google.com:19302",
+    "stun:stun3.l.google.com:19302",
+    "stun:stun4.l.google.com:19302",
+    "stun:stun.miwifi.com:3478",
+    "stun:stun.sipnet.net:3478",
+    "stun:stun.3cx.com:3478",
+    "stun:stun.sipgate.net:3478",
+]
+
+PROBE_TIMEOUT = 0.8
+GRACE = 0.1                      # 第一个回应之后至少再等多久
+RETRANSMITS = (0, 0.15, 0.4)     # 第几秒发（首发 + 两次重发）
+CACHE_TTL = 600
+CACHE_PATH = os.path.join(os.environ.get("XDG_CACHE_HOME") or os.path.expanduser("~/.cache"),
+                          "p2pshare", "nat.json")
+
+CHANGE_IP, CHANGE_PORT = 0x04, 0x02
+
+
+class _Client(asyncio.DatagramProtocol):
+    def __init__(self):
+        self.waiters = {}    # transaction id -> future
+
+    def datagram_received(self, data, addr):
+        msg = stunmsg.parse(data)
+        fut = self.waiters.get(msg[1]) if msg else None
+        if fut is not None and not fut.done():
+            fut.set_result((data, time.monotonic()))
+
+    def error_received(self, exc):
+        pass
+
+
+def local_ip(addr) -> str:
+    """往 addr 去走的本机地址（UDP connect 不发包）"""
+    with socket.socket(socket.AF_INET, socket.SOCK_DGRAM) as s:
+        try:
+            s.connect(addr)
+            return s.getsockname()[0]
+        except OSError:
+            return "0.0.0.0"
+
+
+async def _resolve(loop, url):
+    host, port = stunmsg.parse_url(url)
+    infos = await loop.getaddrinfo(host, port, family=socket.AF_INET, type=socket.SOCK_DGRAM)
+    return infos[0][4]
+
+
+async def probe(servers=None, timeout=PROBE_TIMEOUT) -> dict:
+    """探一遍，返回 {"nat", "public", "servers": [{"url", "addr", "rtt_ms", "mapped"}...按 RTT 排], ...}"""
+    servers = servers or STUN_SERVERS
+    loop = asyncio.get_running_loop()
+    transport, client = await loop.create_datagram_endpoint(_Client, local_addr=("0.0.0.0", 0))
+    port = transport.get_extra_info("sockname")[1]
+    start = time.monotonic()
+
+    async def answered(fut, seconds):
+        try:
+            await asyncio.wait_for(asyncio.shield(fut), max(seconds, 0))
+            return True
+        except asyncio.TimeoutError:
+            return False
+
+    async def ask(addr, attrs=b""):
+        """发一个 Binding 请求（按 RETRANSMITS 重发），超时前收到返回 (响应, RTT 秒)，否则 None"""
+        tid = os.urandom(12)
+        fut = client.waiters[tid] = loop.create_future()
+        request = stunmsg.binding_request(tid, attrs)
+        sent = time.monotonic()
+        try:
+            for at in RETRANSMITS:
+                if at >= timeout or await answered(fut, at - (time.monotonic() - sent)):
+                    break
+                transport.sendto(request, addr)
+            if fut.done() or await answered(fut, timeout - (time.monotonic() - sent)):
+                data, arrived = fut.result()
+                return data, arrived - sent
+            return None
+        finally:
+            client.waiters.pop(tid, None)
+
+    async def query(url):
+        try:
+            addr = await asyncio.wait_for(_resolve(loop, url), timeout)
+        except (OSError, asyncio.TimeoutError) as e:
+            logger.debug("Cannot resolve %s: %s", url, e or "timeout")
+            return {"url": url, "addr": None, "rtt_ms": None, "mapped": None}
+        got = await ask(addr)
+        if got is None:
+            return {"url": url, "addr": list(addr), "rtt_ms": None, "mapped": None}
+        mapped = stunmsg.mapped_address(got[0])
+        return {"url": url, "addr": list(addr), "rtt_ms": round(got[1] * 1000, 1),
+                "mapped": list(mapped) if mapped else None, "other": stunmsg.other_address(got[0])}
+
+    try:
+        # 有回应之后不等慢的：再给 3 倍 RTT（至少 GRACE）让别的服务器回来，够判断对称 NAT 就行
+        tasks = {asyncio.ensure_future(query(url)): url for url in servers}
+        pending = set(tasks)
+        while pending:
+            done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+            rtts = [t.result()["rtt_ms"] for t in done if t.result()["mapped"]]
+            if rtts:
+                if pending:
+                    _, pending = await asyncio.wait(pending, timeout=max(GRACE, 3 * min(rtts) / 1000))
+                break
+        for t in pending:
+            t.cancel()
+        await asyncio.gather(*pending, return_exceptions=True)
+        results = [t.result() if not t.cancelled() else
+                   {"url": url, "addr": None, "rtt_ms": None, "mapped": None} for t, url in tasks.items()]
+        replied = sorted((r for r in results if r["mapped"]), key=lambda r: r["rtt_ms"])
+        me = local_ip(tuple(replied[0]["addr"])) if replied else None
+        nat = classify(replied, (me, port))
+        if nat == "cone":
+            # 有支持 RFC 5780 的服务器就细分：换 IP+端口回得来是 full cone，只换端口回得来是 restricted
+            rfc5780 = next((r for r in replied if r["other"]), None)
+            if rfc5780 is not None:
+                addr = tuple(rfc5780["addr"])
+                both, port_only = await asyncio.gather(*(
+                    ask(addr, stunmsg.attr(stunmsg.CHANGE_REQUEST, struct.pack("!I", flags)))
+                    for flags in (CHANGE_IP | CHANGE_PORT, CHANGE_PORT)))
+                nat = "full-cone" if both else "restricted-cone" if port_only else "port-restricted-cone"
+    finally:
+        transport.close()
+
+    for r in results:
+        r.pop("other", None)
+    return {
+        "nat": nat,
+        "public": replied[0]["mapped"] if replied else None,
+        "servers": replied + [r for r in results if not r["mapped"]],
+        "probed": list(servers),
+        "local": sorted(get_host_addresses(use_ipv4=True, use_ipv6=False)),
+        "checked": time.time(),
+        "seconds": round(time.monotonic() - start, 3),
+    }
+
+
+def classify(answered, local) -> str:
+    if not answered:
+        return "blocked"
+    mappings = {tuple(r["mapped"]) for r in answered}
+    if mappings == {tuple(local)}:
+        return "open"
+    # 同一个本地端口去不同的服务器，映射出来的端口（或 IP）不一样
+    if len(mappings) > 1:
+        return "symmetric"
+    return "cone"
+
+
+# ========== 缓存 ==========
+def load_cached(servers=None, ttl=CACHE_TTL, path=CACHE_PATH):
+    """没过期、本机地址没变、探的是同一批服务器的缓存结果，否则 None"""
+    try:
+        with open(path) as f:
+            result = json.load(f)
+    except (OSError, ValueError):
+        return None
+    if time.time() - result.get("checked", 0) > ttl:
+        return None
+    if result.get("local") != sorted(get_host_addresses(use_ipv4=True, use_ipv6=False)):
+        return None
+    if result.get("probed") != list(servers or STUN_SERVERS):
+        return None
+    return result
+
+
+def save(result, path=CACHE_PATH):
+    try:
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        tmp = f"{path}.{os.getpid()}.tmp"
+        with open(tmp, "w") as f:
+            json.dump(result, f, indent=1)
+        os.replace(tmp, path)
+    except OSError as e:
+        logger.debug("Cannot write NAT cache %s: %s", path, e)
+
+
+async def detect(servers=None, ttl=CACHE_TTL, path=CACHE_PATH) -> dict:
+    result = load_cached(servers, ttl, path) if ttl > 0 else None
+    if result is None:
+        result = await probe(servers)
+        save(result, path)
+        logger.info("NAT probe: %s in %.2fs, public %s", result["nat"], result["seconds"],
+                    ":".join(map(str, result["public"])) if result["public"] else "-")
+    return result
+
+
+def choose_stun(result, has_turn):
+    """按探测结果决定用哪个 STUN（None = 不用），返回 (url, 原因)"""
+    nat = result["nat"]
+    fastest = next((r for r in result["servers"] if r["mapped"]), None)
+    if nat == "blocked":
+        return None, "UDP to STUN servers is blocked, " + ("TURN only" if has_turn else "LAN peers only without --turn")
+    if nat == "open":
+        return None, "no NAT, host candidates are enough"
+    if nat == "symmetric" and has_turn:
+        return None, "symmetric NAT, server-reflexive candidates would not work; TURN only"
+    return fastest["url"], f"{nat} NAT, fastest STUN {fastest['rtt_ms']:.0f}ms"
+
+
+async def resolve_stun(stun, has_turn=False):
+    """--stun 的值：auto 换成探测/缓存选出的 STUN url（或空 = 不用 STUN），其它原样返回"""
+    if stun != "auto":
+        return stun
+    url, why = choose_stun(await detect(), has_turn)
+    logger.info("STUN auto: %s (%s)", url or "none", why)
+    return url or ""
+
+
+# ========== 本地 STUN 替身 ==========
+class StubServer(asyncio.DatagramProtocol):
+    """只回 Binding 请求的 STUN 服务器，测试用。
+
+    shift 加在报回去的端口上，两个不同 shift 的替身就能冒充对称 NAT；
+    alt 是另一个端口上的 StubServer，给了就在响应里带 OTHER-ADDRESS，换端口的 CHANGE-REQUEST 从它那回
+    （只有一个 IP，换 IP 的请求不回）。
+    """
+
+    def __init__(self, shift=0, alt=None):
+        self.shift = shift
+        self.alt = alt
+        self.transport = None
+
+    def connection_made(self, transport):
+        self.transport = transport
+
+    def datagram_received(self, data, addr):
+        msg = stunmsg.parse(data)
+        if msg is None or msg[0] != stunmsg.BINDING_REQUEST:
+            return
+        kind, tid, attrs = msg
+        flags = struct.unpack("!I", attrs[stunmsg.CHANGE_REQUEST])[0] if stunmsg.CHANGE_REQUEST in attrs else 0
+        if flags & CHANGE_IP:
+            return
+        out = self.transport
+        if flags & CHANGE_PORT:
+            if self.alt is None:
+                return
+            out = self.alt.transport
+        body = stunmsg.address_attr(stunmsg.XOR_MAPPED_ADDRESS, addr[0], (addr[1] + self.shift) % 65536)
+        if self.alt is not None:
+            host, port = self.alt.transport.get_extra_info("sockname")[:2]
+            body += stunmsg.address_attr(stunmsg.OTHER_ADDRESS, host, port)
+        out.sendto(stunmsg.binding_response(tid, body), addr)
+
+
+async def serve_stub(host, port, shift=0, with_alt=False):
+    loop = asyncio.get_running_loop()
+    alt = None
+    if with_alt:
+        _, alt = await loop.create_datagram_endpoint(lambda: StubServer(shift), local_addr=(host, port + 1))
+    await loop.create_datagram_endpoint(lambda: StubServer(shift, alt), local_addr=(host, port))
+    print(f"STUN stand-in on {host}:{port}" + (f" (+{port + 1})" if alt else "") + (f", port shift {shift}" if shift else ""))
+    await asyncio.Event().wait()
+
+
+async def run(args):
+    servers = args.servers.split(",") if args.servers else None
+    if args.no_cache:
+        result = await probe(servers, args.timeout)
+        save(result, args.cache)
+    else:
+        result = await detect(servers, args.ttl, args.cache)
+    if args.json:
+        print(json.dumps(result, indent=1))
+        return
+    for r in result["servers"]:
+        mapped = ":".join(map(str, r["mapped"])) if r["mapped"] else "no answer"
+        rtt = f"{r['rtt_ms']:.0f}ms" if r["rtt_ms"] is not None else "-"
+        print(f"{r['url']:<36} {rtt:>7}  {mapped}")
+    print(f"NAT type: {result['nat']} (probed in {result['seconds']:.2f}s)")
+    url, why = choose_stun(result, bool(args.turn))
+    print(f"--stun auto would use: {url or 'no STUN'} ({why})")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--servers", help="comma separated stun: urls (default: the built-in list)")
+    parser.add_argument("--timeout", type=float, default=PROBE_TIMEOUT)
+    parser.add_argument("--ttl", type=float, default=CACHE_TTL, help="reuse a cached result this young (seconds)")
+    parser.add_argument("--no-cache", action="store_true", help="always probe")
+    parser.add_argument("--cache", default=CACHE_PATH)
+    parser.add_argument("--turn", help="pretend a TURN server is configured when choosing")
+    parser.add_argument("--json", action="store_true")
+    parser.add_argument("--serve", metavar="HOST:PORT", help="run a local STUN stand-in instead")
+    parser.add_argument("--shift", type=int, default=0, help="stand-in: add this to the reported port")
+    parser.add_argument("--alt", action="store_true",
+                        help="stand-in: also listen on PORT+1 and answer change-port requests from it")
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO, format="%(asctime)s [%(levelname)s] %(message)s")
+    if args.serve:
+        host, _, port = args.serve.rpartition(":")
+        asyncio.run(serve_stub(host, int(port), args.shift, args.alt))
+    else:
+        asyncio.run(run(args))
@@ -1,36 +1,36 @@
 import argparse
 import asyncio
-import hashlib
 import json
-import os
 import logging
+import os
 import websockets
-import time
 from aiortc import RTCPeerConnection, RTCSessionDescription, RTCIceServer, RTCConfiguration
 
-CHUNK_LIMIT_FOR_FLUSH = 4 * 1024 * 1024  # 每 4MB flush 一次
+import cas
+import compress
+import delta
+import natprobe
+import rudp
+from common import MAX_CHUNK_SIZE, MIN_CHUNK_SIZE, RECV_MAX_MESSAGE, human, unpack_frame
+from download import Download
+from session import ReceiveSession
+from swarm import SeederPeer, Swarm
+from telemetry import DEFAULT_INTERVAL, Phases, Telemetry, candidate_pair
+from writer import DURABILITY, SYNC_BYTES, SYNC_INTERVAL
 
 # ============ 日志配置 ============
 logging.basicConfig(
-    level=logging.DEBUG,   # 改成 INFO 会少点输出
+    level=logging.INFO,   # --log-level DEBUG 看细节
     format="%(asctime)s [%(levelname)s] %(message)s",
     handlers=[logging.StreamHandler()]
 )
 logger = logging.getLogger("fetch")
 
 
-def human(n):
-    """把字节数转换成人类可读格式"""
-    units = ["B", "KB", "MB", "GB", "TB"]
-    for u in units:
-        if n < 1024:
-            return f"{n:.2f}{u}"
-        n /= 1024
-    return f"{n:.2f}PB"
-
-
 async def run(args):
     ice_servers = []
+    # --stun auto 见 natprobe.resolve_stun
+    args.stun = await natprobe.resolve_stun(args.stun, bool(args.turn and args.turn_user and args.turn_pass))
     if args.stun:
         ice_servers.append(RTCIceServer(urls=[args.stun]))
     if args.turn and args.turn_user and args.turn_pass:
@@ -39,175 +39,512 @@ async def run(args):
                                         credential=args.turn_pass))
     logger.debug("Using ICE servers: %s", ice_servers)
 
-    pc = RTCPeerConnection(RTCConfiguration(iceServers=ice_servers))
-    file = None
-    sha256 = hashlib.sha256()
-    expect_size = None
-    recv_size = 0
-    out_path = None
-    buffered = 0
-    channel_ready = asyncio.Event()
-    sender_channel = None
-    start_ts = time.time()
-
-    @pc.on("datachannel")
-    def on_datachannel(ch):
-        nonlocal sender_channel
-        sender_channel = ch
-        logger.info("DataChannel received: %s", ch.label)
-
-        @ch.on("open")
-        def _open():
-            logger.info("DataChannel opened")
-            channel_ready.set()
-
-        @ch.on("message")
-        def _msg(msg):
-            nonlocal file, expect_size, recv_size, out_path, buffered, start_ts
-            if isinstance(msg, bytes):
-                if file is None:
-                    logger.warning("Received binary data before meta, ignoring")
+    dl = Download(args.output, args.overwrite, not args.no_resume, args.quiet,
+                  args.max_buffer_mb * 1024 * 1024, args.durability, args.sync_mb * 1024 * 1024,
+                  args.sync_interval)
+    swarm = Swarm(dl) if args.swarm else None
+    # --store：本地分片仓库，已有的分片不用再传，下完的收进去
+    store = await asyncio.to_thread(cas.ChunkStore, args.store, int(args.store_gb * 1024 ** 3)) \
+        if args.store else None
+    fill_task = None
+    links = {}      # 发送端 id -> {"pc", "control", "udp"}，普通模式只有一个；udp 的 pc 是 rudp.Connection
+    owner = None    # 第一个发 meta 的发送端，清单以它为准
+    waiting = []    # 清单还没收齐时先到的发送端，清单校验完再回 have
+    deferred = {}   # 写缓冲满时丢掉的分片，发送端 id -> [序号]，恢复后再要
+    done_evt = asyncio.Event()
+    finishing = False
+    verified = False
+    basis = None        # --delta 的旧文件（delta.Basis）
+    sig_msgs = None if args.delta else []  # 旧文件的签名消息，算好之前是 None，不用增量时是 []
+    sig_task = None
+    wire_bytes = 0      # 收到的数据帧字节数（压缩/增量后的）
+    telemetry = Telemetry(args.trace, args.trace_interval)
+    phases = Phases(telemetry, "download")  # 连接建立各阶段耗时，收到第一个数据帧时打出来
+    # --session：一条连接收一串文件，控制消息和数据帧都交给 ReceiveSession，上面的单文件状态不用
+    session = ReceiveSession(args, phases, done_evt) if args.session else None
+
+    async def complete():
+        nonlocal finishing, verified
+        if finishing:
+            return
+        finishing = True
+        verified = await dl.finish()
+        telemetry.finish("download")
+        for link in links.values():
+            if link["control"] and link["control"].readyState == "open":
+                link["control"].send(json.dumps({"kind": "ack"}))
+        if verified and store is not None:
+            await dl.ingest(store)
+        if swarm is not None:
+            for pid, (delivered, rate) in swarm.stats().items():
+                logger.info("Seeder %s delivered %s (last rate %s/s)",
+                            pid, human(delivered), human(rate))
+        done_evt.set()
+
+    def check_ready():
+        nonlocal sig_task, fill_task
+        try:
+            ok = dl.ready()
+        except ValueError as e:
+            logger.error("File list / manifest check failed: %s", e)
+            done_evt.set()
+            return
+        if not ok:
+            return
+        if "download" not in telemetry.sessions and not finishing:
+            telemetry.track("download", counters={
+                "bytes": lambda: dl.recv_size,
+                "wire_bytes": lambda: wire_bytes,
+            }, gauges={
+                "queued": lambda: dl.queued,
+                "paused": lambda: int(dl.paused),
+                "write_latency": dl.write_latencies,
+            }, info={"ice_pair": ice_pairs})
+        if sig_msgs is None:
+            # 旧文件的签名只算一次，算好再回 have
+            if sig_task is None:
+                sig_task = asyncio.ensure_future(prepare_delta())
+            return
+        if store is not None and fill_task is None:
+            hits = dl.store_hits(store)
+            fill_task = asyncio.ensure_future(fill_from_store(hits))
+        for peer_id in waiting:
+            # 告诉发送端哪些分片已经有了；swarm 模式下由接收端按需拉取
+            link = links[peer_id]
+            for part in sig_msgs:
+                link["control"].send(json.dumps(part))
+            link["control"].send(json.dumps({
+                "kind": "have", "bitmap": dl.have_bitmap(), "pull": swarm is not None,
+                "max_message": RECV_MAX_MESSAGE,
+                "compress": compress.pick(dl.meta.get("compress")),
+                **({"delta": {"block": basis.block, "blocks": basis.blocks}} if sig_msgs else {}),
+            }))
+            if swarm is not None:
+                swarm.add(SeederPeer(peer_id, link["control"], dl.meta["chunk_size"]))
+        waiting.clear()
+        if dl.complete():
+            asyncio.ensure_future(complete())
+
+    async def prepare_delta():
+        nonlocal basis, sig_msgs
+        msgs = []
+        if args.delta and dl.entries is not None:
+            logger.warning("--delta only works for single files, ignoring it for a directory")
+        elif args.delta and not dl.complete():
+            try:
+                block = delta.block_size_for(os.path.getsize(args.delta), dl.meta["chunk_size"])
+                sigs = await asyncio.to_thread(delta.signatures, args.delta, block)
+                basis = delta.Basis(args.delta, block)
+                msgs = list(delta.encode_signatures(sigs))
+                logger.info("Delta basis %s: %d blocks of %s, signatures %s",
+                            args.delta, basis.blocks, human(block), human(len(sigs)))
+            except OSError as e:
+                logger.warning("Cannot use %s as delta basis: %s", args.delta, e)
+        sig_msgs = msgs
+        check_ready()
+
+    async def fill_from_store(hits):
+        if not hits:
+            return
+        logger.info("%d of %d missing chunks are in the chunk store, filling them locally",
+                    len(hits), len(dl.received) - dl.received.count)
+        lost = await dl.fill_from_store(store, hits)
+        if lost and owner in links:
+            logger.warning("%d chunks vanished from the chunk store, asking the seeder", len(lost))
+            send_control(links[owner], "need", chunks=lost)
+
+    def ice_pairs():
+        pairs = sorted({p for p in (candidate_pair(l["pc"]) for l in links.values()) if p})
+        return ", ".join(pairs) or None
+
+    def send_control(link, kind, **fields):
+        ch = link["control"]
+        if ch is not None and ch.readyState == "open":
+            ch.send(json.dumps({"kind": kind, **fields}))
+
+    def on_chunk(peer_id, msg):
+        nonlocal wire_bytes
+        if not wire_bytes:
+            phases.mark("first_byte")
+            phases.report()
+        wire_bytes += len(msg)
+        if dl.file is None:
+            if not finishing:
+                logger.warning("Received binary data before meta, ignoring")
+            return
+        index, offset, codec, data = unpack_frame(msg)
+        if codec == compress.RAW:
+            on_piece(peer_id, index, offset, data)
+            return
+        # 压缩的片在线程池里并行解压、增量的片从旧文件里还原，完了回到事件循环再拼；
+        # 解出来最多到分片末尾，多了当坏帧
+        if index >= len(dl.received):
+            logger.debug("Frame for chunk %d beyond the end of the file, ignoring", index)
+            return
+        limit = dl.chunk_len(index) - offset
+        if limit <= 0:
+            logger.debug("Frame for chunk %d at offset %d past the chunk end, ignoring", index, offset)
+            return
+        if codec == delta.DELTA:
+            if basis is None:
+                logger.warning("Delta frame for chunk %d from %s without a basis, ignoring",
+                               index, peer_id)
+                return
+            fut = asyncio.get_event_loop().run_in_executor(
+                compress.workers(), basis.apply, data, limit)
+        else:
+            fut = asyncio.get_event_loop().run_in_executor(
+                compress.workers(), compress.decompress, codec, data, limit)
+        fut.add_done_callback(lambda f: on_decoded(peer_id, index, offset, f))
+
+    def on_decoded(peer_id, index, offset, fut):
+        try:
+            data = fut.result()
+        except Exception as e:
+            logger.warning("Chunk %d from %s failed to decode: %s", index, peer_id, e)
+            dl.drop_partial(peer_id, index)
+            on_result(index, False, peer_id, 0)
+            return
+        if dl.file is not None:
+            on_piece(peer_id, index, offset, data)
+
+    def on_piece(peer_id, index, offset, data):
+        data = dl.assemble(index, offset, data, peer_id)
+        if data is None:
+            return  # 分片还没拼齐
+        status = dl.accept(index, data, peer_id)
+        if status == "dup":
+            logger.debug("Ignoring unexpected/duplicate chunk %d", index)
+        elif status == "busy":
+            logger.debug("Write buffer full, dropping chunk %d for now", index)
+            if swarm is None:
+                deferred.setdefault(peer_id, []).append(index)
+        if swarm is not None and status != "queued":
+            swarm.on_chunk(peer_id, index, status, len(data))
+
+    def on_result(index, ok, peer_id, nbytes):
+        """落盘流水线校验/写完一个分片后回到这里"""
+        if not ok:
+            logger.warning("Chunk %d from %s failed hash check, asking for it again",
+                           index, peer_id)
+            if swarm is None and peer_id in links:
+                send_control(links[peer_id], "need", chunks=[index])
+            elif peer_id == cas.STORE_TAG and owner in links:
+                send_control(links[owner], "need", chunks=[index])
+        if swarm is not None:
+            swarm.on_chunk(peer_id, index, "ok" if ok else "bad", nbytes)
+        if ok and dl.complete():
+            asyncio.ensure_future(complete())
+
+    def on_pressure(paused):
+        # 写盘跟不上时让所有发送端先停一停
+        for link in links.values():
+            send_control(link, "pause" if paused else "resume")
+        if paused:
+            return
+        for peer_id, chunks in deferred.items():
+            if peer_id in links:
+                send_control(links[peer_id], "need", chunks=chunks)
+        deferred.clear()
+        if swarm is not None:
+            swarm.kick()
+
+    def on_failed(exc):
+        logger.error("Writing %s failed: %s", dl.out_path, exc)
+        done_evt.set()
+
+    dl.on_result = on_result
+    dl.on_pressure = on_pressure
+    dl.on_failed = on_failed
+
+    def on_control(peer_id, j):
+        nonlocal owner
+        kind = j.get("kind")
+        if kind == "meta":
+            if not MIN_CHUNK_SIZE <= j.get("chunk_size", 0) <= MAX_CHUNK_SIZE:
+                logger.error("Seeder %s uses unsupported chunk size %s", peer_id, j.get("chunk_size"))
+                if dl.meta is None:
+                    done_evt.set()
+                return
+            if dl.meta is None:
+                owner = peer_id
+                dl.start(j)
+            elif not dl.matches(j):
+                logger.error("Seeder %s offers a different file, ignoring it", peer_id)
+                return
+            phases.mark("meta")
+            waiting.append(peer_id)
+            check_ready()
+        elif kind == "manifest":
+            if peer_id == owner:
+                dl.add_manifest_part(j)
+                check_ready()
+        elif kind == "files":
+            if peer_id == owner:
+                dl.add_file_list_part(j)
+                check_ready()
+        elif kind == "ping":
+            send_control(links[peer_id], "pong", seq=j.get("seq"))
+        elif kind == "eof":
+            dl.remote_digest = j["sha256"]
+            # 其它通道上可能还有分片在路上，到齐了再收尾
+            if dl.complete():
+                asyncio.ensure_future(complete())
+            elif swarm is None:
+                logger.info("EOF received, waiting for %d in-flight chunks",
+                            len(dl.received) - dl.received.count)
+
+    def drop_link(peer_id):
+        dl.drop_partial(peer_id)
+        if swarm is not None:
+            swarm.remove(peer_id)
+        alive = [l for l in links.values()
+                 if l["pc"].iceConnectionState not in ("failed", "closed")]
+        if not alive and not done_evt.is_set() and not finishing:
+            asyncio.ensure_future(suspend())
+
+    async def suspend():
+        if session is not None:
+            await session.suspend()
+            logger.warning("Connection lost with %d files unfinished, rerun to resume",
+                           len(session.transfers))
+        elif dl.file is not None:
+            await dl.suspend()
+            logger.warning("Connection lost at %d/%d chunks, rerun to resume",
+                           dl.received.count, len(dl.received))
+        done_evt.set()
+
+    def new_link(peer_id, pc=None):
+        udp = pc is not None
+        if pc is None:
+            pc = RTCPeerConnection(RTCConfiguration(iceServers=ice_servers))
+        link = {"pc": pc, "control": None, "udp": udp}
+        links[peer_id] = link
+
+        @pc.on("datachannel")
+        def on_datachannel(ch):
+            logger.info("DataChannel received from %s: %s", peer_id, ch.label)
+            if ch.label == "file":
+                phases.mark("channel_open")
+                link["control"] = ch
+            if session is not None:
+                if ch.label != "file":
+                    session.attach_data(ch)
+                    return
+                session.attach(ch)
+                telemetry.track("download", counters={
+                    "bytes": lambda: session.recv_bytes,
+                    "wire_bytes": lambda: session.wire_bytes,
+                }, gauges={
+                    "queued": session.queued,
+                    "paused": lambda: int(bool(session.paused)),
+                }, info={"ice_pair": ice_pairs})
+                return
+
+            @ch.on("message")
+            def _msg(msg):
+                if isinstance(msg, bytes):
+                    on_chunk(peer_id, msg)
                     return
-                file.write(msg)
-                sha256.update(msg)
-                recv_size += len(msg)
-                buffered += len(msg)
-
-                if buffered >= CHUNK_LIMIT_FOR_FLUSH:
-                    file.flush()
-                    os.fsync(file.fileno())
-                    buffered = 0
-
-                if not args.quiet and expect_size:
-                    pct = recv_size / expect_size * 100
-                    elapsed = time.time() - start_ts
-                    speed = recv_size / max(elapsed, 1e-6)
-                    print(
-                        f"\rReceiving {os.path.basename(out_path)}: "
-                        f"{human(recv_size)}/{human(expect_size)} "
-                        f"({pct:.1f}%) avg {human(speed)}/s",
-                        end=""
-                    )
-            else:
                 try:
                     j = json.loads(msg)
                 except Exception:
                     logger.error("Invalid text message: %s", msg)
                     return
+                on_control(peer_id, j)
+
+        @pc.on("iceconnectionstatechange")
+        def on_ice():
+            logger.info("ICE state changed (%s): %s", peer_id, pc.iceConnectionState)
+            if pc.iceConnectionState in ("connected", "completed"):
+                phases.mark("ice_connected")
+            if pc.iceConnectionState in ("failed", "closed"):
+                drop_link(peer_id)
 
-                if j.get("kind") == "meta":
-                    name = j["name"]
-                    expect_size = int(j["size"])
-                    out_name = args.output if args.output else name
-                    out_path = os.path.abspath(out_name)
-                    if os.path.exists(out_path) and not args.overwrite:
-                        base, ext = os.path.splitext(out_path)
-                        k = 1
-                        while os.path.exists(out_path):
-                            out_path = f"{base}.recv{'' if k==1 else k}{ext}"
-                            k += 1
-                    file = open(out_path, "wb")
-                    recv_size = 0
-                    start_ts = time.time()
-                    logger.info("Receiving file: %s (expect %d bytes)", out_path, expect_size)
-                elif j.get("kind") == "eof":
-                    remote_digest = j["sha256"]
-                    if file:
-                        file.flush()
-                        os.fsync(file.fileno())
-                        file.close()
-                        file = None
-                    local_digest = sha256.hexdigest()
-                    print()  # 换行，避免进度和日志挤一行
-                    logger.info("Transfer complete, local sha256=%s", local_digest)
-                    if remote_digest != local_digest:
-                        logger.warning("SHA256 mismatch! remote=%s", remote_digest)
-                    else:
-                        logger.info("SHA256 verified OK")
-                    ch.send(json.dumps({"kind": "ack"}))
-
-    @pc.on("iceconnectionstatechange")
-    def on_ice():
-        logger.info("ICE state changed: %s", pc.iceConnectionState)
-
-    @pc.on("signalingstatechange")
-    def on_sig():
-        logger.debug("Signaling state: %s", pc.signalingState)
-
-    @pc.on("icegatheringstatechange")
-    def on_ice_gather():
-        logger.debug("ICE gathering state: %s", pc.iceGatheringState)
+        @pc.on("signalingstatechange")
+        def on_sig():
+            logger.debug("Signaling state: %s", pc.signalingState)
+
+        @pc.on("icegatheringstatechange")
+        def on_ice_gather():
+            logger.debug("ICE gathering state: %s", pc.iceGatheringState)
+
+        return link
 
     async with websockets.connect(args.signaling) as ws:
+        phases.mark("connected")
         logger.info("Connected to signaling server: %s", args.signaling)
-        await ws.send(json.dumps({"type": "join", "room": args.room, "role": "receiver"}))
+        await ws.send(json.dumps({
+            "type": "join", "room": args.room, "role": "receiver",
+            "multi": args.swarm or args.multi, "batch": True,
+        }))
         logger.debug("Join request sent for room %s", args.room)
 
-        # 等待 joined
+        async def accept_udp(peer_id, remote):
+            """发送端 --transport udp：回自己的候选，一起打洞；打不通就等它接着发的 WebRTC offer"""
+            conn = rudp.Connection(args.udp_mss, args.udp_loss, args.udp_delay_ms / 1000)
+            link = new_link(peer_id, conn)
+            phases.mark("offer")
+            await ws.send(json.dumps({"type": "udp", "to": peer_id, "data": await conn.gather(args.stun)}))
+            phases.mark("answer_sent")
+            logger.info("Sent UDP candidates to %s", peer_id)
+            # 比发送端多等一会儿：它打通了才会发数据，先放弃的应该是它
+            if await conn.connect(remote, rudp.PUNCH_TIMEOUT + 2):
+                return
+            await drop_udp(peer_id, link)
+
+        async def drop_udp(peer_id, link):
+            if links.get(peer_id) is link:
+                links.pop(peer_id)
+            link["pc"].remove_all_listeners()
+            await link["pc"].close()
+
+        async def on_signal(m):
+            logger.debug("Recv signaling: %s", m)
+            peer_id = m.get("from")
+            if m["type"] == "udp":
+                if args.transport != "udp" or swarm is not None or args.multi or links:
+                    logger.debug("Ignoring UDP candidates from %s", peer_id)
+                    return
+                asyncio.ensure_future(accept_udp(peer_id, m["data"]))
+            elif m["type"] == "sdp":
+                if peer_id in links and links[peer_id]["udp"]:
+                    # 发送端那边没打通，退回 WebRTC 了
+                    logger.info("%s fell back to WebRTC", peer_id)
+                    await drop_udp(peer_id, links[peer_id])
+                if peer_id in links or (links and swarm is None):
+                    # 非 swarm 模式只跟一个发送端连（后来的比如 --reseed 的接收端不理）
+                    logger.warning("Extra offer from %s, ignoring", peer_id)
+                    return
+                phases.mark("offer")
+                pc = new_link(peer_id)["pc"]
+                sdp = m["data"]
+                await pc.setRemoteDescription(
+                    RTCSessionDescription(sdp=sdp["sdp"], type=sdp["type"])
+                )
+                # aiortc 收集完候选才返回，answer 里已经带全，不再单独发 ice
+                answer = await pc.createAnswer()
+                await pc.setLocalDescription(answer)
+                await ws.send(json.dumps({
+                    "type": "sdp",
+                    "to": peer_id,
+                    "data": {
+                        "sdp": pc.localDescription.sdp,
+                        "type": pc.localDescription.type
+                    }
+                }))
+                phases.mark("answer_sent")
+                logger.info("Sent SDP answer to %s", peer_id)
+            elif m["type"] == "ice" and peer_id in links:
+                cand = m["data"]
+                await links[peer_id]["pc"].addIceCandidate(cand)
+                logger.debug("Added remote ICE candidate")
+            elif m["type"] == "peer":
+                logger.info("Peer event in room: %s %s (%s)", m["event"], m["id"], m["role"])
+
+        # 等待 joined；batch 的 joined 里直接带着发送端早就放好的 offer，不用再等回放
         while True:
             msg = json.loads(await ws.recv())
             logger.debug("Signaling message: %s", msg)
             if msg.get("type") == "joined":
+                phases.mark("joined")
                 logger.info("Joined room: %s as receiver", args.room)
                 break
+        for raw in msg.get("queued", []):
+            await on_signal(json.loads(raw))
 
         async def recv_task():
             async for raw in ws:
-                m = json.loads(raw)
-                logger.debug("Recv signaling: %s", m)
-                if m["type"] == "sdp":
-                    sdp = m["data"]
-                    await pc.setRemoteDescription(
-                        RTCSessionDescription(sdp=sdp["sdp"], type=sdp["type"])
-                    )
-                    answer = await pc.createAnswer()
-                    await pc.setLocalDescription(answer)
-                    await ws.send(json.dumps({
-                        "type": "sdp",
-                        "data": {
-                            "sdp": pc.localDescription.sdp,
-                            "type": pc.localDescription.type
-                        }
-                    }))
-                    logger.info("Sent SDP answer")
-                elif m["type"] == "ice":
-                    cand = m["data"]
-                    await pc.addIceCandidate(cand)
-                    logger.debug("Added remote ICE candidate")
+                await on_signal(json.loads(raw))
 
         rt = asyncio.create_task(recv_task())
 
-        @pc.on("icecandidate")
-        async def on_candidate(c):
-            if c:
-                await ws.send(json.dumps({
-                    "type": "ice",
-                    "data": {
-                        "candidate": c.to_sdp(),
-                        "sdpMid": c.sdpMid,
-                        "sdpMLineIndex": c.sdpMLineIndex
-                    }
-                }))
-                logger.debug("Sent local ICE candidate")
-
-        await channel_ready.wait()
-        logger.info("Channel ready, waiting for file transfer...")
-
-        await rt
-    await pc.close()
+        await done_evt.wait()
+        # 等 ack 真正送到：发送端收到 ack 后会先关连接，最多等 2 秒
+        deadline = asyncio.get_event_loop().time() + 2
+        while asyncio.get_event_loop().time() < deadline and any(
+                l["control"] and l["control"].readyState == "open" for l in links.values()):
+            await asyncio.sleep(0.05)
+        rt.cancel()
+    for link in links.values():
+        await link["pc"].close()
     logger.info("PeerConnection closed")
+    if basis is not None:
+        basis.close()
+    telemetry.close()
+
+    if args.reseed and verified:
+        # 下完的接收端转身当发送端，帮还没下完的 swarm 接收端分担上行
+        import seeder
+        logger.info("Re-serving %s to the rest of room %s", dl.out_path, args.room)
+        reseed = seeder.build_parser().parse_args([
+            f"--signaling={args.signaling}", f"--room={args.room}", f"--file={dl.out_path}",
+            "--multi", "--until-empty", f"--chunk-kb={dl.meta['chunk_size'] // 1024}",
+        ])
+        reseed.stun, reseed.turn, reseed.turn_user, reseed.turn_pass = (
+            args.stun, args.turn, args.turn_user, args.turn_pass)
+        reseed.trace_interval, reseed.quiet = args.trace_interval, args.quiet
+        await seeder.run(reseed)
 
 
 if __name__ == "__main__":
     parser = argparse.ArgumentParser()
     parser.add_argument("--signaling", required=True, help="ws://your-vps-ip:8765")
     parser.add_argument("--room", required=True)
-    parser.add_argument("--stun", default="stun:stun.l.google.com:19302")
+    parser.add_argument("--stun", default="auto",
+                        help="STUN url, '' for none, or auto: pick from a cached NAT probe (natprobe.py)")
     parser.add_argument("--turn")
     parser.add_argument("--turn-user")
     parser.add_argument("--turn-pass")
-    parser.add_argument("--output", help="save as path (optional)")
+    parser.add_argument("--output", help="save as path (optional); with --session, the directory to save into")
     parser.add_argument("--overwrite", action="store_true")
+    parser.add_argument("--no-resume", action="store_true",
+                        help="ignore <output>.chunks progress left by an interrupted run")
+    parser.add_argument("--swarm", action="store_true",
+                        help="download from every seeder in the room at once")
+    parser.add_argument("--max-buffer-mb", type=int, default=64,
+                        help="cap on received data waiting to be hashed and written")
+    parser.add_argument("--durability", choices=DURABILITY, default="periodic",
+                        help="when to fsync: periodic (every --sync-mb / --sync-interval, default), "
+                             "eof (once at the end; a crash restarts from scratch) or "
+                             "none (never; resume survives a process crash but not power loss)")
+    parser.add_argument("--sync-mb", type=int, default=SYNC_BYTES // (1024 * 1024),
+                        help="with --durability periodic, fsync after this many MB written")
+    parser.add_argument("--sync-interval", type=float, default=SYNC_INTERVAL,
+                        help="with --durability periodic, fsync at least this often (seconds)")
+    parser.add_argument("--multi", action="store_true",
+                        help="share the room with other receivers (for a seeder started with --multi)")
+    parser.add_argument("--session", action="store_true",
+                        help="receive a queue of files from a --session seeder over one connection")
+    parser.add_argument("--transport", choices=["udp", "webrtc"], default="udp",
+                        help="udp (default): take the plain UDP path when the seeder offers one; "
+                             "webrtc: always wait for a WebRTC offer")
+    parser.add_argument("--udp-mss", type=int, default=rudp.DEFAULT_MSS,
+                        help="UDP payload bytes per packet (the smaller of both sides is used)")
+    parser.add_argument("--udp-loss", type=float, default=0.0,
+                        help="drop this fraction of sent UDP packets (testing)")
+    parser.add_argument("--udp-delay-ms", type=float, default=0.0,
+                        help="delay sent UDP packets by this much (testing)")
+    parser.add_argument("--store", metavar="DIR",
+                        help="local chunk store: chunks already in it are not transferred again, "
+                             "finished downloads are added to it")
+    parser.add_argument("--store-gb", type=float, default=cas.DEFAULT_CAP / 1024 ** 3,
+                        help="chunk store size cap, least recently used chunks are evicted (default: 10)")
+    parser.add_argument("--reseed", action="store_true",
+                        help="after a verified download, serve the file to the remaining receivers")
+    parser.add_argument("--delta", metavar="PATH",
+                        help="an older copy of the file; only the changed blocks are transferred")
+    parser.add_argument("--trace", metavar="PATH",
+                        help="write a JSON-lines telemetry trace (throughput, buffers, stalls, ...)")
+    parser.add_argument("--trace-interval", type=float, default=DEFAULT_INTERVAL,
+                        help="seconds between telemetry samples")
+    parser.add_argument("--log-level", default="INFO",
+                        choices=["DEBUG", "INFO", "WARNING", "ERROR"])
     parser.add_argument("--quiet", action="store_true", default=False)
     args = parser.parse_args()
+    logging.getLogger().setLevel(args.log_level)
+    if args.session and (args.swarm or args.multi or args.delta):
+        parser.error("--session cannot be combined with --swarm, --multi or --delta")
+    if args.store and (args.swarm or args.session):
+        parser.error("--store cannot be combined with --swarm or --session")
     asyncio.run(run(args))
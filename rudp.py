@@ -0,0 +1,693 @@
+# rudp.py - 打洞后的可靠 UDP 传输（seeder.py / p2p_get.py --transport udp）
+#
+# aiortc 的 SCTP 是纯 Python 实现，吞吐上不去；这里在一个打通的 UDP socket 上自己做可靠传输：
+#   打洞   两边交换候选地址（本机地址 + STUN 拿到的公网地址）和 token，互相发 PUNCH，
+#          收到对方的 PUNCH_ACK 就算通了（和 connect/peer.py 的思路一样，换成 asyncio）
+#   可靠   段序号 + 累计确认 + SACK；按发送顺序判丢（比它晚发的已经确认了 REORDER 个）、
+#          超时（RTO）兜底，丢了的段原样重传
+#   拥塞   按确认速率估瓶颈带宽、按最小 RTT 估时延（BBR 的简化版），决定发送速率（pacing）和在途上限；
+#          随机丢包不降速
+#   批量   一次可读事件把 socket 里的包收到底、只回一个 ACK；发送按节拍成批发，
+#          Linux 上有 UDP GSO 时一批同样长的包一次 sendmsg 交给内核切（Python 没有 sendmmsg/recvmmsg）
+#
+# 上层拿到的 Channel 和 aiortc 的 DataChannel 用法一样（send / bufferedAmount / bufferedamountlow /
+# message / close），Connection 也提供 seeder / p2p_get 用到的那几个 PeerConnection 属性和事件，
+# 所以 FlowControl、收发逻辑不用改。消息在字节流里按 长度 + 类型 分帧。
+#
+# 压测用的人为丢包 / 延迟（--udp-loss / --udp-delay-ms）加在发送方向上。
+
+import asyncio
+import heapq
+import logging
+import os
+import random
+import socket
+import struct
+import time
+from collections import deque
+
+from aioice.ice import get_host_addresses
+from pyee.asyncio import AsyncIOEventEmitter
+
+import stunmsg
+
+logger = logging.getLogger("rudp")
+
+PUNCH, PUNCH_ACK, DATA, ACK, CLOSE, KEEPALIVE = 0xC1, 0xC2, 0xC3, 0xC4, 0xC5, 0xC6  # 开头两位不是 00，和 STUN 分得开
+HELLO = struct.Struct("!BQQ")     # 类型, 自己的 token, 对方的 token
+DATA_HDR = struct.Struct("!BI")   # 类型, 段序号
+ACK_HDR = struct.Struct("!BIB")   # 类型, 累计确认（下一个要的段）, SACK 区间数
+RANGE = struct.Struct("!II")      # [起, 止)
+MSG_HDR = struct.Struct("!IB")    # 流里一条消息：长度, 0 文本 / 1 二进制
+
+DEFAULT_MSS = 1200           # 段里的数据字节数；公网上再大容易被分片，本机/局域网压测可以调大
+MAX_MSS = 65000
+MAX_SACK = 128             # 一个 ACK 最多带多少段 SACK 区间（约 1KB）
+PUNCH_INTERVAL = 0.05
+PUNCH_TIMEOUT = 5.0
+EXTRA_ACKS = 3             # 打通后再补发几个 PUNCH_ACK
+STUN_TIMEOUT = 1.5
+KEEPALIVE_INTERVAL = 1.0
+DEAD_AFTER = 10.0            # 这么久没收到对方任何包就当断了
+TICK = 0.01
+MIN_RTO = 0.05
+MAX_RTO = 2.0
+REORDER = 3
+INITIAL_CWND = 32            # 段
+MAX_BATCH = 256              # 一次可读事件最多收多少包
+GSO_SEGMENTS = 64
+SOCK_BUF = 8 * 1024 * 1024
+UDP_SEGMENT = getattr(socket, "UDP_SEGMENT", 103)  # Linux 4.18+
+
+STARTUP_GAIN = 2.885         # 2/ln2：每轮翻倍地探带宽
+PROBE_GAINS = (1.25, 0.75, 1, 1, 1, 1, 1, 1)
+CWND_GAIN = 2.0
+BW_WINDOW = 2.0              # 带宽取最近几秒的最大值
+RTT_WINDOW = 10.0
+
+
+class Segment:
+    __slots__ = ("packet", "size", "sent", "tx", "delivered", "delivered_ts", "retx", "lost")
+
+    def __init__(self, packet, size):
+        self.packet = packet
+        self.size = size
+        self.retx = False
+        self.lost = False
+
+
+class RateControl:
+    """按确认速率估带宽、按最小 RTT 估时延，算发送速率和在途上限"""
+
+    def __init__(self, mss):
+        self.mss = mss
+        self.bw = 0.0               # 字节/秒
+        self.bw_samples = deque()   # (时间, 速率)
+        self.min_rtt = None
+        self.min_rtt_ts = 0.0
+        self.srtt = None
+        self.rttvar = 0.0
+        self.delivered = 0
+        self.delivered_ts = time.monotonic()
+        self.mode = "startup"
+        self.gain = STARTUP_GAIN
+        self.round_end = 0          # delivered 过了这个值算过了一轮
+        self.full_bw = 0.0
+        self.full_rounds = 0
+        self.cycle = 0
+        self.cycle_ts = 0.0
+
+    def rto(self) -> float:
+        if self.srtt is None:
+            return 0.5
+        return min(MAX_RTO, max(MIN_RTO, self.srtt + 4 * self.rttvar))
+
+    def bdp(self) -> float:
+        return self.bw * (self.min_rtt or 0.05)
+
+    def pacing_rate(self) -> float:
+        if not self.bw:
+            return STARTUP_GAIN * INITIAL_CWND * self.mss / (self.srtt or 0.05)
+        return self.gain * self.bw
+
+    def cwnd(self) -> float:
+        if not self.bw:
+            return INITIAL_CWND * self.mss
+        gain = STARTUP_GAIN if self.mode == "startup" else CWND_GAIN
+        return max(4 * self.mss, gain * self.bdp())
+
+    def on_send(self, seg, now):
+        seg.sent = now
+        seg.delivered = self.delivered
+        seg.delivered_ts = self.delivered_ts
+
+    def on_rtt(self, rtt, now):
+        if self.srtt is None:
+            self.srtt, self.rttvar = rtt, rtt / 2
+        else:
+            self.rttvar = 0.75 * self.rttvar + 0.25 * abs(self.srtt - rtt)
+            self.srtt = 0.875 * self.srtt + 0.125 * rtt
+        if self.min_rtt is None or rtt <= self.min_rtt or now - self.min_rtt_ts > RTT_WINDOW:
+            self.min_rtt, self.min_rtt_ts = rtt, now
+
+    def on_ack(self, acked, newest, now, inflight):
+        """acked 字节确认了，newest 是其中最晚发的段"""
+        self.delivered += acked
+        self.delivered_ts = now
+        rate = (self.delivered - newest.delivered) / max(now - newest.delivered_ts, 1e-4)
+        samples = self.bw_samples
+        while samples and (samples[0][1] <= rate or now - samples[0][0] > BW_WINDOW):
+            samples.popleft()
+        samples.append((now, rate))
+        # 单调队列：队头就是窗口里的最大值
+        while len(samples) > 1 and samples[-2][1] <= rate:
+            del samples[-2]
+        self.bw = samples[0][1]
+
+        new_round = newest.delivered >= self.round_end
+        if new_round:
+            self.round_end = self.delivered
+        if self.mode == "startup" and new_round:
+            # 连着三轮带宽没涨 25%，管道满了
+            if self.bw >= self.full_bw * 1.25:
+                self.full_bw, self.full_rounds = self.bw, 0
+            else:
+                self.full_rounds += 1
+                if self.full_rounds >= 3:
+                    self.mode, self.gain = "drain", 1 / STARTUP_GAIN
+        if self.mode == "drain" and inflight <= self.bdp():
+            self.mode, self.gain = "probe", PROBE_GAINS[0]
+            self.cycle, self.cycle_ts = random.randrange(2, len(PROBE_GAINS)), now
+        if self.mode == "probe" and now - self.cycle_ts > (self.min_rtt or 0.05):
+            self.cycle = (self.cycle + 1) % len(PROBE_GAINS)
+            self.cycle_ts = now
+            self.gain = PROBE_GAINS[self.cycle]
+
+
+class Channel(AsyncIOEventEmitter):
+    """Connection 上唯一的消息通道，接口和 aiortc 的 RTCDataChannel 一样
+
+    不发 open 事件：Connection.connect() 返回时通道已经是 open。
+    """
+
+    def __init__(self, conn, label="file"):
+        super().__init__()
+        self.conn = conn
+        self.label = label
+        self.readyState = "connecting"
+        self.bufferedAmountLowThreshold = 0
+
+    @property
+    def bufferedAmount(self) -> int:
+        return self.conn.out_bytes
+
+    def send(self, msg):
+        if self.readyState != "open":
+            raise ConnectionError("channel is not open")
+        if isinstance(msg, str):
+            msg = msg.encode()
+            kind = 0
+        else:
+            kind = 1
+        self.conn.write(MSG_HDR.pack(len(msg), kind), msg)
+
+
+class Connection(AsyncIOEventEmitter):
+    """一个打洞打通的 UDP 连接；对 seeder / p2p_get 来说相当于 RTCPeerConnection"""
+
+    def __init__(self, mss=DEFAULT_MSS, loss=0.0, delay=0.0):
+        super().__init__()
+        self.loop = asyncio.get_event_loop()
+        self.sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.sock.setblocking(False)
+        for opt in (socket.SO_SNDBUF, socket.SO_RCVBUF):
+            try:
+                self.sock.setsockopt(socket.SOL_SOCKET, opt, SOCK_BUF)
+            except OSError:
+                pass
+        self.sock.bind(("0.0.0.0", 0))
+        self.loop.add_reader(self.sock.fileno(), self._on_readable)
+        self.token = int.from_bytes(os.urandom(8), "big")
+        self.remote_token = None
+        self.mss = min(mss, MAX_MSS)
+        self.loss = loss
+        self.delay = delay
+        self._delayed = []          # 人为延迟：(到点时间, 序号, 包)
+        self._delay_seq = 0
+        self._delay_timer = None
+        self.gso = hasattr(socket, "SOL_UDP") and os.name == "posix"
+        # 和 RTCPeerConnection 对齐的几个属性
+        self.iceConnectionState = "new"
+        self.signalingState = "stable"
+        self.iceGatheringState = "new"
+        self.remoteDescription = None
+        self.pair = None            # telemetry.candidate_pair 用
+        self.channel = Channel(self)
+        self.addr = None            # 选中的对端地址
+        self.verified = set()       # 验过 token 的对端地址，数据包只收这些地址来的
+        self._remote_types = {}     # 对端候选地址 -> 类型
+        self._stun_waiters = {}
+        self._tasks = []
+        self._connected = None
+        # 发送
+        self.rate = RateControl(self.mss)
+        self.outq = deque()         # 还没切成段的消息字节（memoryview）
+        self.out_off = 0
+        self.out_bytes = 0
+        self.snd_nxt = 0
+        self.snd_una = 0
+        self.unacked = {}           # 段序号 -> Segment（发了、没确认），按序号顺序
+        self.retx = deque()
+        self.inflight = 0
+        self.tx = 0                 # 发送次数（重传也算），判丢看发送顺序
+        self.largest_acked_tx = -1
+        self.tokens = 0.0
+        self.pace_ts = time.monotonic()
+        self.wakeup = asyncio.Event()
+        self.last_progress = time.monotonic()
+        self.rto_backoff = 1
+        self.last_send = 0.0
+        # 接收
+        self.rcv_next = 0
+        self.rcv_ooo = {}           # 乱序到的段
+        self.rcv_buf = bytearray()
+        self.ack_due = False
+        self.last_recv = time.monotonic()
+        # 统计
+        self.sent_packets = 0
+        self.retransmits = 0
+        self.recv_packets = 0
+
+    # ---------- 打洞 ----------
+
+    async def gather(self, stun_url=None) -> dict:
+        """本机候选地址（+ STUN 拿到的公网地址），发给对端的描述"""
+        self.iceGatheringState = "gathering"
+        port = self.sock.getsockname()[1]
+        cands = [[ip, port, "host"] for ip in get_host_addresses(use_ipv4=True, use_ipv6=False)]
+        cands.append(["127.0.0.1", port, "host"])  # 同一台机器上的两端
+        if stun_url:
+            mapped = await self._stun(*stunmsg.parse_url(stun_url))
+            if mapped is not None and list(mapped) not in [c[:2] for c in cands]:
+                cands.append([mapped[0], mapped[1], "srflx"])
+        self.iceGatheringState = "complete"
+        return {"token": f"{self.token:016x}", "candidates": cands, "mss": self.mss}
+
+    async def _stun(self, host, port):
+        try:
+            infos = await self.loop.getaddrinfo(host, port, family=socket.AF_INET, type=socket.SOCK_DGRAM)
+        except OSError as e:
+            logger.warning("Cannot resolve STUN server %s: %s", host, e)
+            return None
+        addr = infos[0][4]
+        tid = os.urandom(12)
+        fut = self._stun_waiters[tid] = self.loop.create_future()
+        try:
+            for _ in range(3):
+                self._sendto(stunmsg.binding_request(tid), addr)
+                try:
+                    return await asyncio.wait_for(asyncio.shield(fut), STUN_TIMEOUT / 3)
+                except asyncio.TimeoutError:
+                    pass
+            logger.warning("No STUN answer from %s:%d", host, port)
+            return None
+        finally:
+            self._stun_waiters.pop(tid, None)
+
+    async def connect(self, remote, timeout=PUNCH_TIMEOUT) -> bool:
+        """拿对端的描述打洞；通了开始收发，返回 True，超时返回 False（不发事件，调用方换 WebRTC）"""
+        self.remote_token = int(remote["token"], 16)
+        self.mss = min(self.mss, int(remote.get("mss", self.mss)))
+        self.rate.mss = self.mss
+        targets = [(c[0], int(c[1])) for c in remote["candidates"]]
+        self._remote_types = {(c[0], int(c[1])): c[2] for c in remote["candidates"]}
+        self.iceConnectionState = "checking"
+        self._connected = self.loop.create_future()
+        deadline = self.loop.time() + timeout
+        hello = HELLO.pack(PUNCH, self.token, self.remote_token)
+        while not self._connected.done() and self.loop.time() < deadline:
+            if self.sock.fileno() < 0:
+                return False  # 被 close() 了
+            for addr in targets:
+                self._sendto(hello, addr)
+            try:
+                await asyncio.wait_for(asyncio.shield(self._connected), PUNCH_INTERVAL)
+            except asyncio.TimeoutError:
+                pass
+        if not self._connected.done():
+            self.iceConnectionState = "failed"
+            logger.warning("UDP hole punching to %s timed out", targets)
+            return False
+        # addr 在这里才设：_on_hello 里就设的话，到这里之前到的数据会交给还没人接的 channel，丢了又已经回过 ACK
+        self.addr = self._connected.result()
+        # 再补几个 PUNCH_ACK：对端可能还没收到我们回的 ACK，不用等它下一轮 PUNCH 就能连上
+        ack = HELLO.pack(PUNCH_ACK, self.token, self.remote_token)
+        for _ in range(EXTRA_ACKS):
+            self._sendto(ack, self.addr)
+        self.iceConnectionState = "completed"
+        self.pair = f"udp->{self._remote_types.get(self.addr, 'peer')}"
+        logger.info("UDP path to %s:%d open (mss %d)", self.addr[0], self.addr[1], self.mss)
+        self.channel.readyState = "open"
+        self._tasks = [asyncio.ensure_future(self._pump()), asyncio.ensure_future(self._ticker())]
+        self.emit("iceconnectionstatechange")
+        self.emit("datachannel", self.channel)
+        return True
+
+    def _on_hello(self, kind, theirs, mine, addr):
+        if mine != self.token or (self.remote_token is not None and theirs != self.remote_token):
+            return
+        self.verified.add(addr)
+        if kind == PUNCH:
+            self._sendto(HELLO.pack(PUNCH_ACK, self.token, theirs), addr)
+        elif self._connected is not None and not self._connected.done():
+            self._connected.set_result(addr)
+
+    # ---------- 收 ----------
+
+    def _on_readable(self):
+        sock = self.sock
+        for _ in range(MAX_BATCH):
+            try:
+                data, addr = sock.recvfrom(65536)
+            except (BlockingIOError, InterruptedError):
+                break
+            except OSError:
+                continue  # 对端还没打开时的 ICMP 端口不可达之类
+            self._handle(data, addr)
+        if self.ack_due:
+            self._send_ack()
+
+    def _handle(self, data, addr):
+        kind = data[0] if data else 0
+        if kind < 0x40:
+            if stunmsg.is_stun(data):
+                self._on_stun(data)
+            return
+        if kind in (PUNCH, PUNCH_ACK) and len(data) >= HELLO.size:
+            _, theirs, mine = HELLO.unpack_from(data)
+            self._on_hello(kind, theirs, mine, addr)
+            self.last_recv = time.monotonic()
+            return
+        if addr not in self.verified or self.addr is None:
+            return  # 自己这边 connect() 还没返回、上层还没接上时的包不收，对端会重传
+        self.last_recv = time.monotonic()
+        self.recv_packets += 1
+        if kind == DATA:
+            self._on_data(DATA_HDR.unpack_from(data)[1], memoryview(data)[DATA_HDR.size:])
+        elif kind == ACK:
+            self._on_ack(data)
+        elif kind == CLOSE:
+            self._closed(remote=True)
+
+    def _on_stun(self, data):
+        msg = stunmsg.parse(data)
+        fut = self._stun_waiters.get(msg[1]) if msg else None
+        if fut is not None and not fut.done():
+            fut.set_result(stunmsg.mapped_address(data, msg[1]))
+
+    def _on_data(self, seq, payload):
+        self.ack_due = True
+        if seq < self.rcv_next or seq in self.rcv_ooo:
+            return
+        if seq != self.rcv_next:
+            self.rcv_ooo[seq] = payload
+            return
+        self.rcv_buf += payload
+        self.rcv_next += 1
+        while self.rcv_next in self.rcv_ooo:
+            self.rcv_buf += self.rcv_ooo.pop(self.rcv_next)
+            self.rcv_next += 1
+        self._deliver()
+
+    def _deliver(self):
+        """把流里收齐的消息交给通道"""
+        buf = self.rcv_buf
+        pos = 0
+        while len(buf) - pos >= MSG_HDR.size:
+            n, kind = MSG_HDR.unpack_from(buf, pos)
+            start = pos + MSG_HDR.size
+            if len(buf) - start < n:
+                break
+            body = bytes(buf[start:start + n])
+            pos = start + n
+            self.channel.emit("message", body.decode() if kind == 0 else body)
+        if pos:
+            del buf[:pos]
+
+    def _send_ack(self):
+        self.ack_due = False
+        ranges = []
+        if self.rcv_ooo:
+            # 从累计确认往上的乱序区间（发送端按这些判丢），放不下时最后一个换成最新的那段
+            for seq in sorted(self.rcv_ooo):
+                if ranges and ranges[-1][1] == seq:
+                    ranges[-1][1] = seq + 1
+                else:
+                    ranges.append([seq, seq + 1])
+            if len(ranges) > MAX_SACK:
+                ranges[MAX_SACK - 1:] = ranges[-1:]
+        packet = ACK_HDR.pack(ACK, self.rcv_next, len(ranges)) + b"".join(RANGE.pack(*r) for r in ranges)
+        self._sendto(packet, self.addr)
+
+    # ---------- 发 ----------
+
+    def write(self, header, body):
+        """上层的一条消息排进发送流"""
+        self.outq.append(memoryview(header))
+        self.outq.append(memoryview(body))
+        self.out_bytes += len(header) + len(body)
+        self.wakeup.set()
+
+    def _take(self, n):
+        parts = []
+        while n and self.outq:
+            buf = self.outq[0]
+            k = min(n, len(buf) - self.out_off)
+            parts.append(buf[self.out_off:self.out_off + k])
+            self.out_off += k
+            n -= k
+            if self.out_off == len(buf):
+                self.outq.popleft()
+                self.out_off = 0
+        return parts
+
+    def _on_ack(self, data):
+        if len(data) < ACK_HDR.size:
+            return
+        _, cum, n = ACK_HDR.unpack_from(data)
+        now = time.monotonic()
+        newest = None
+        acked = 0
+        rtt_seg = None
+
+        def take(seq):
+            nonlocal newest, acked, rtt_seg
+            seg = self.unacked.pop(seq, None)
+            if seg is None:
+                return
+            if not seg.lost:
+                self.inflight -= seg.size
+            acked += seg.size
+            if newest is None or seg.tx > newest.tx:
+                newest = seg
+                rtt_seg = None if seg.retx else seg
+
+        while self.snd_una < cum:
+            take(self.snd_una)
+            self.snd_una += 1
+        for k in range(min(n, (len(data) - ACK_HDR.size) // RANGE.size)):
+            start, end = RANGE.unpack_from(data, ACK_HDR.size + k * RANGE.size)
+            start = max(start, self.snd_una)
+            if end - start > len(self.unacked):
+                for seq in [s for s in self.unacked if start <= s < end]:
+                    take(seq)
+            else:
+                for seq in range(start, end):
+                    take(seq)
+        if newest is None:
+            return
+        self.last_progress = now
+        self.rto_backoff = 1
+        if rtt_seg is not None:
+            self.rate.on_rtt(now - rtt_seg.sent, now)
+        self.largest_acked_tx = max(self.largest_acked_tx, newest.tx)
+        self.rate.on_ack(acked, newest, now, self.inflight)
+        self._detect_loss(now)
+        self.wakeup.set()
+
+    def _detect_loss(self, now):
+        # 比它晚发的段已经确认了 REORDER 个以上，或者晚发的确认了且它已经过了 9/8 个 RTT
+        late = 1.125 * (self.rate.srtt or 0.05)
+        for seq, seg in self.unacked.items():
+            if seg.tx >= self.largest_acked_tx:
+                if not seg.retx:
+                    break  # 新段按序号顺序发，后面的都更晚
+                continue
+            if seg.lost:
+                continue
+            if seg.tx + REORDER < self.largest_acked_tx or now - seg.sent > late:
+                self._lost(seq, seg)
+
+    def _lost(self, seq, seg):
+        seg.lost = True
+        self.inflight -= seg.size
+        self.retx.append(seq)
+
+    def _next_packet(self, now):
+        """下一个要发的包：先重传，再切新段；没有返回 None"""
+        while self.retx:
+            seq = self.retx.popleft()
+            seg = self.unacked.get(seq)
+            if seg is None or not seg.lost:
+                continue
+            seg.lost = False
+            seg.retx = True
+            self.retransmits += 1
+            break
+        else:
+            if not self.out_bytes:
+                return None
+            parts = self._take(self.mss)
+            size = sum(len(p) for p in parts)
+            self.out_bytes -= size
+            seq = self.snd_nxt
+            self.snd_nxt += 1
+            seg = Segment(b"".join([DATA_HDR.pack(DATA, seq), *parts]), size)
+            self.unacked[seq] = seg
+        seg.tx = self.tx
+        self.tx += 1
+        self.inflight += seg.size
+        self.rate.on_send(seg, now)
+        return seg.packet
+
+    async def _pump(self):
+        """按节拍发：每次按 发送速率 x 过去的时间 攒额度，额度和在途上限内的包一批发出去"""
+        ch = self.channel
+        while self.channel.readyState == "open":
+            cwnd = self.rate.cwnd()
+            if (not self.retx and not self.out_bytes) or self.inflight + self.mss > cwnd:
+                self.wakeup.clear()
+                await self.wakeup.wait()
+                continue
+            now = time.monotonic()
+            rate = self.rate.pacing_rate()
+            burst = max(4 * (self.mss + DATA_HDR.size), rate * 0.002)
+            self.tokens = min(self.tokens + rate * (now - self.pace_ts), burst)
+            self.pace_ts = now
+            before = self.out_bytes
+            batch = []
+            while self.tokens > 0 and self.inflight + self.mss <= cwnd:
+                packet = self._next_packet(now)
+                if packet is None:
+                    break
+                self.tokens -= len(packet)
+                batch.append(packet)
+            self._send_batch(batch)
+            if before > ch.bufferedAmountLowThreshold >= self.out_bytes:
+                ch.emit("bufferedamountlow")
+            await asyncio.sleep(max(0.001, -self.tokens / rate) if self.tokens <= 0 else 0)
+
+    def _send_batch(self, batch):
+        if not batch:
+            return
+        self.last_send = time.monotonic()
+        self.sent_packets += len(batch)
+        if self.gso and not self.loss and not self.delay and len(batch) > 1:
+            try:
+                self._send_gso(batch)
+                return
+            except OSError as e:
+                if not isinstance(e, BlockingIOError):
+                    logger.debug("UDP GSO unavailable (%s), sending packets one by one", e)
+                    self.gso = False
+                else:
+                    return  # 发送缓冲满了，当丢了，后面会重传
+        for packet in batch:
+            self._sendto(packet, self.addr)
+
+    def _send_gso(self, batch):
+        # 一组里除最后一个外长度必须一样，由内核按 size 切成多个 UDP 包
+        i = 0
+        while i < len(batch):
+            size = len(batch[i])
+            j = i + 1
+            while j < len(batch) and j - i < GSO_SEGMENTS and (j - i + 1) * size <= 65000:
+                n = len(batch[j])
+                if n > size:
+                    break
+                j += 1
+                if n < size:
+                    break  # 短的只能放在最后一个
+            if j - i == 1:
+                self._sendto(batch[i], self.addr)
+            else:
+                self.sock.sendmsg([b"".join(batch[i:j])],
+                                  [(socket.SOL_UDP, UDP_SEGMENT, struct.pack("=H", size))], 0, self.addr)
+            i = j
+
+    def _sendto(self, packet, addr):
+        if self.loss and random.random() < self.loss:
+            return
+        if self.delay:
+            self._delay_seq += 1
+            heapq.heappush(self._delayed, (time.monotonic() + self.delay, self._delay_seq, packet, addr))
+            if self._delay_timer is None:
+                self._delay_timer = self.loop.call_later(self.delay, self._release)
+            return
+        try:
+            self.sock.sendto(packet, addr)
+        except (BlockingIOError, InterruptedError):
+            pass  # 当丢了
+        except OSError as e:
+            logger.debug("sendto %s failed: %s", addr, e)
+
+    def _release(self):
+        self._delay_timer = None
+        now = time.monotonic()
+        while self._delayed and self._delayed[0][0] <= now:
+            _, _, packet, addr = heapq.heappop(self._delayed)
+            try:
+                self.sock.sendto(packet, addr)
+            except OSError:
+                pass
+        if self._delayed:
+            self._delay_timer = self.loop.call_later(max(0.0, self._delayed[0][0] - now), self._release)
+
+    async def _ticker(self):
+        """超时重传、保活、判断对端是不是没了"""
+        while self.channel.readyState == "open":
+            await asyncio.sleep(TICK)
+            now = time.monotonic()
+            if now - self.last_recv > DEAD_AFTER:
+                logger.warning("No packets from %s:%d for %.0fs", self.addr[0], self.addr[1], DEAD_AFTER)
+                self._closed(remote=True, state="failed")
+                return
+            rto = self.rate.rto() * self.rto_backoff
+            if self.inflight and now - self.last_progress > rto:
+                # 发出去太久没确认的都算丢了（包括尾巴上没有后续确认能判丢的）
+                for seq, seg in self.unacked.items():
+                    if not seg.lost and now - seg.sent > rto:
+                        self._lost(seq, seg)
+                self.rto_backoff = min(self.rto_backoff * 2, 64)
+                self.last_progress = now
+                self.wakeup.set()
+            if now - self.last_send > KEEPALIVE_INTERVAL:
+                self.last_send = now
+                self._sendto(bytes([KEEPALIVE]), self.addr)
+
+    # ---------- 关闭 ----------
+
+    def stats(self) -> str:
+        r = self.rate
+        return (f"{self.sent_packets} packets sent, {self.retransmits} retransmitted, "
+                f"{self.recv_packets} received; bw {r.bw / 1e6:.2f}MB/s, "
+                f"min rtt {(r.min_rtt or 0) * 1000:.1f}ms, mode {r.mode}")
+
+    def _closed(self, remote=False, state="closed"):
+        if self.channel.readyState == "closed":
+            return
+        self.channel.readyState = "closed"
+        self.iceConnectionState = state
+        self.wakeup.set()
+        if remote:
+            logger.info("UDP connection %s: %s", state, self.stats())
+        self.channel.emit("close")
+        self.emit("iceconnectionstatechange")
+
+    async def close(self, linger=1.0):
+        """把发出去的数据等到确认（最多 linger 秒），通知对端，关 socket"""
+        if self.channel.readyState == "open":
+            deadline = time.monotonic() + linger
+            while (self.unacked or self.out_bytes) and time.monotonic() < deadline:
+                await asyncio.sleep(TICK)
+            for _ in range(3):
+                self._sendto(bytes([CLOSE]), self.addr)
+            logger.info("UDP connection closed: %s", self.stats())
+        self._closed()
+        for task in self._tasks:
+            task.cancel()
+        if self._delay_timer is not None:
+            self._delay_timer.cancel()
+        if self.sock.fileno() >= 0:
+            self.loop.remove_reader(self.sock.fileno())
+            self.sock.close()
@@ -1,103 +1,302 @@
 import argparse
 import asyncio
-import hashlib
 import json
 import logging
 import os
 import sys
 import websockets
+from collections import deque
 from aiortc import RTCPeerConnection, RTCIceServer, RTCConfiguration, RTCSessionDescription
-from aiortc.contrib.signaling import BYE
+
+import compress
+import delta
+import natprobe
+import rudp
+from common import (CHUNK_SIZE, MAX_CHUNK_SIZE, MIN_CHUNK_SIZE, ChunkBitmap, OrderedHasher,
+                    human, max_message_size, piece_limit)
+from flow import PING_INTERVAL, FlowControl, PieceSizer
+from session import SendSession, queued_files
+from source import FileSource
+from telemetry import DEFAULT_INTERVAL, Phases, Progress, Telemetry, candidate_pair
+from tree import TreeSource
 
 # ================= 日志配置 =================
 logging.basicConfig(
-    level=logging.DEBUG,   # 调整为 INFO 可以少点输出
+    level=logging.INFO,   # --log-level DEBUG 看细节
     format="%(asctime)s [%(levelname)s] %(message)s",
     handlers=[logging.StreamHandler()]
 )
 logger = logging.getLogger("seeder")
 
-# ================= 常量 =================
-CHUNK_SIZE = 64 * 1024  # 每次发送 64KB
-
-
-def human(n):
-    for unit in ["B", "KB", "MB", "GB", "TB"]:
-        if n < 1024:
-            return f"{n:.2f}{unit}"
-        n /= 1024
-    return f"{n:.2f}PB"
+UDP_ANSWER_TIMEOUT = 5.0  # 接收端进房间后多久没回 UDP 候选就走 WebRTC
 
 
-async def run(args):
-    logger.info("Seeder started, preparing file: %s", args.file)
-
-    # ========= ICE 服务器配置 =========
-    ice_servers = []
-    if args.stun:
-        ice_servers.append(RTCIceServer(urls=[args.stun]))
-    if args.turn and args.turn_user and args.turn_pass:
-        ice_servers.append(RTCIceServer(
-            urls=[args.turn],
-            username=args.turn_user,
-            credential=args.turn_pass
-        ))
-
-    logger.debug("Using ICE servers: %s", ice_servers)
-
+def new_peer(args, ice_servers):
+    """建 PeerConnection 和数据通道；offer 要在通道建好之后生成才带 m=application"""
     pc = RTCPeerConnection(RTCConfiguration(iceServers=ice_servers))
-    channel = pc.createDataChannel("file", ordered=True)
-    logger.info("DataChannel created, label=%s", channel.label)
+    # 第一条通道同时承载控制消息（meta/eof/ack），其余只跑数据
+    channels = [pc.createDataChannel("file", ordered=True)]
+    for k in range(1, args.channels):
+        channels.append(pc.createDataChannel(f"file-{k}", ordered=True))
+    return pc, channels
+
+
+async def gather_offer(pc):
+    # aiortc 在 setLocalDescription 里把候选收集完（连 STUN 的要等一个来回），SDP 里直接带全，不用再 trickle
+    await pc.setLocalDescription(await pc.createOffer())
+
+
+async def send_offer(ws, pc, target):
+    await ws.send(json.dumps({
+        "type": "sdp",
+        "to": target,
+        "data": {
+            "sdp": pc.localDescription.sdp,
+            "type": pc.localDescription.type
+        }
+    }))
+
+
+async def try_udp(conn, answer, receiver_seen, phases):
+    """等接收端回它的 UDP 候选，打洞；接收端没回（--transport webrtc 或者老版本）或打不通返回 None，
+    调用方照常走 WebRTC"""
+    await receiver_seen.wait()
+    try:
+        remote = await asyncio.wait_for(answer, UDP_ANSWER_TIMEOUT)
+    except asyncio.TimeoutError:
+        logger.info("Receiver did not answer the UDP offer, using WebRTC")
+        await conn.close()
+        return None
+    if not await conn.connect(remote):
+        logger.warning("UDP hole punching failed, falling back to WebRTC")
+        await conn.close()
+        return None
+    phases.mark("ice_connected")
+    logger.info("Using the reliable UDP transport (%s)", conn.pair)
+    return conn, [conn.channel]
+
+
+async def serve_receiver(args, source, ice_servers, ws, target, pcs, telemetry, phases, early=None):
+    """给一个接收端建一条 PeerConnection 并把文件发完，收到 ack 返回
+
+    early 是提前建好、offer 已经放进房间的 (pc, channels)，见 run() 里的快速启动。
+    """
+    meta = source.meta
+    pc, channels = early or new_peer(args, ice_servers)
+    pcs[target] = pc
+    channel = channels[0]
+    flow = FlowControl(channels, args.window_kb * 1024 or None)
+    logger.info("DataChannels created, labels=%s", [c.label for c in channels])
 
     done_fut = asyncio.get_event_loop().create_future()
-    file_size = os.path.getsize(args.file)
-    file_name = os.path.basename(args.file)
+    have_fut = asyncio.get_event_loop().create_future()
+    file_size = meta["size"]
+    file_name = meta["name"]
+    todo = deque()           # 待发分片序号，接收端的 need 会往里追加
+    refill = asyncio.Event()
+    flowing = asyncio.Event()  # 接收端写盘跟不上时发 pause 清掉，resume 再置上
+    flowing.set()
+    sig_parts = {}             # 接收端旧文件的签名（--delta），start -> data
+    who = f" to {target}" if target else ""
 
     # ========== 文件发送 ==========
+    sent = 0
+    paused = 0.0               # 接收端让暂停的累计秒数
+    session = target or "receiver"
+    progress = Progress(args.quiet)
+
     async def send_file():
-        sha256 = hashlib.sha256()
-        sent = 0
+        offer = compress.offer(args.compress)
+        channel.send(json.dumps({"kind": "meta", **meta, **({"compress": offer} if offer else {})}))
+        logger.info("Sent file metadata%s: %s", who, meta)
+        for part in source.file_list:
+            channel.send(json.dumps(part))
+        if source.manifest is not None:
+            for part in source.manifest.messages():
+                channel.send(json.dumps(part))
+            logger.info("Sent chunk manifest, %d hashes, root=%s",
+                        len(source.manifest), source.manifest.root)
+        # 等接收端建好文件再发数据，否则别的通道上的分片可能比 meta 先到
+        j = await have_fut
+        have = ChunkBitmap.decode(meta["chunks"], j["bitmap"])
+        # 接收端在 have 里报了自己能收多大的消息就按它的，否则按它 SDP 里写的
+        limit = piece_limit(j.get("max_message") or max_message_size(pc.remoteDescription.sdp))
+        sizer = PieceSizer(flow, min(limit, meta["chunk_size"]))
+        logger.info("Sending pieces of up to %s%s", human(sizer.high), who)
+        compressor = None
+        if j.get("compress") in offer:
+            compressor = compress.Compressor(j["compress"])
+            logger.info("Receiver accepted %s compression", compressor.name)
+        phases.mark("have")
+        blocks = await load_signatures(j.get("delta"))
+        pinger = asyncio.ensure_future(ping_loop())
+        telemetry.track(session, counters={
+            "bytes": lambda: sent,
+            "wire_bytes": lambda: flow.sent_bytes,
+            "stall_seconds": lambda: flow.stall_seconds / len(channels),  # 按每条通道平均
+            "paused_seconds": lambda: paused,
+        }, gauges={
+            "buffered": flow.buffered,
+            "window": lambda: flow.window,
+            "piece": lambda: sizer.size,
+            "rtt_ms": lambda: flow.min_rtt.value and round(flow.min_rtt.value * 1000, 2),
+        }, info={"ice_pair": lambda: candidate_pair(pc)})
+        try:
+            await stream(have, bool(j.get("pull")), sizer, compressor, blocks)
+        finally:
+            pinger.cancel()
+
+    async def load_signatures(spec):
+        """接收端有旧版本时，把它发来的签名建成查找表；对不上就不用增量"""
+        if not spec or "files" in meta:
+            return None
+        block = spec.get("block", 0)
+        if not delta.MIN_BLOCK <= block <= delta.MAX_BLOCK:
+            logger.warning("Receiver asked for delta with block size %s, ignoring", block)
+            return None
+        blocks = await asyncio.to_thread(
+            delta.BlockIndex, block, [sig_parts[k] for k in sorted(sig_parts)])
+        if len(blocks) != spec.get("blocks"):
+            logger.warning("Got %d of %s delta signatures, sending without delta",
+                           len(blocks), spec.get("blocks"))
+            return None
+        logger.info("Receiver has an older copy (%d blocks of %s), sending deltas",
+                    len(blocks), human(block))
+        return blocks
+
+    async def ping_loop():
+        # 测 RTT 用，接收端原样回 pong
+        while channel.readyState == "open":
+            channel.send(json.dumps(flow.ping()))
+            await asyncio.sleep(PING_INTERVAL)
+
+    def chunk_bytes(index):
+        with source.view(index) as v:
+            return bytes(v)
+
+    async def stream(have, pull, sizer, compressor, blocks):
+        # 补发（need）的分片会排到 todo 后面再发一次，按序号去重补齐，不会算两遍
+        hasher = OrderedHasher(chunk_bytes)
         start_ts = asyncio.get_event_loop().time()
-        with open(args.file, "rb") as f:
-            meta = {"kind": "meta", "name": file_name, "size": file_size}
-            channel.send(json.dumps(meta))
-            logger.info("Sent file metadata: %s", meta)
-
+        if not pull:
+            todo.extend(have.missing())
+        # 从头顺序推送时 sha256 边发边算；续传/拉取/多接收端时用源文件共享的结果
+        inline_hash = source.manifest is None and not have.count and not pull and not args.multi
+        digest_task = None if inline_hash else asyncio.ensure_future(source.digest())
+        if pull:
+            logger.info("Receiver pulls chunks on demand (has %d/%d)", have.count, len(have))
+        elif have.count:
+            logger.info("Receiver already has %d/%d chunks, sending %d",
+                        have.count, len(have), len(todo))
+        else:
+            logger.info("Receiver ready, streaming %d chunks", len(todo))
+
+        # 压缩/增量模式下每条通道提前把后面几个分片交给线程池，几个核一起编码
+        pooled = compressor is not None or blocks is not None
+        lookahead = max(2, 2 * compress.WORKERS // len(channels)) if pooled else 1
+        loop = asyncio.get_event_loop()
+
+        def chunk_frames(index, piece):
+            # 一个分片的几片都走同一条有序通道，接收端按偏移拼
+            if blocks is not None:
+                with source.view(index) as v:
+                    frames = blocks.frames(index, v, piece)
+                if frames is not None:
+                    return frames
+            return [source.frame(index, offset, piece, compressor)
+                    for offset in range(0, source.chunk_len(index), piece)]
+
+        def encode(index, piece):
+            if not pooled:
+                return chunk_frames(index, piece)
+            return loop.run_in_executor(compress.workers(), chunk_frames, index, piece)
+
+        async def pump(ch):
+            nonlocal sent, paused
+            ahead = deque()  # 已经开始编码、还没发的分片：(序号, 帧列表或 future)
             while True:
-                while channel.bufferedAmount > 8 * CHUNK_SIZE:
-                    await asyncio.sleep(0.01)
+                if not flowing.is_set():
+                    t0 = loop.time()
+                    await flowing.wait()
+                    paused += loop.time() - t0
+                await flow.wait(ch)
+
+                # sha256 边读边算；补发的分片序号比已经算到的小，OrderedHasher 会跳过
+                while todo and len(ahead) < lookahead:
+                    index = todo.popleft()
+                    if inline_hash:
+                        with source.view(index) as v:
+                            hasher.feed(index, v)
+                    ahead.append((index, encode(index, sizer.current())))
+                if not ahead:
+                    return
+                index, frames = ahead.popleft()
+                if not isinstance(frames, list):
+                    frames = await frames
+                if not sent:
+                    phases.mark("first_byte")
+                    phases.report()
+                for k, frame in enumerate(frames):
+                    if k:
+                        await flow.wait(ch)
+                    ch.send(frame)
+                    flow.sent(len(frame))
+                sent += source.chunk_len(index)
+                show_progress()
+
+        def show_progress(done=False):
+            pct = sent / file_size * 100 if file_size > 0 else 100
+            progress.update(f"Sending {file_name}{who}: {human(sent)}/{human(file_size)} ({pct:.1f}%)",
+                            done)
+
+        # 每条通道各自抢下一个分片，慢的通道自然少分到
+        await asyncio.gather(*(pump(ch) for ch in channels))
+        show_progress(done=True)
+
+        if digest_task is None and hasher.next_index < len(have):
+            # 有分片没按顺序发到（不该发生），边发边算的结果不完整，整文件重算
+            digest_task = asyncio.ensure_future(source.digest())
+        digest = await digest_task if digest_task else hasher.hexdigest()
+        channel.send(json.dumps({"kind": "eof", "sha256": digest}))
+        logger.info("File transfer complete%s, sha256=%s", who, digest)
+        if compressor is not None:
+            logger.info("Compression%s: %s", who, compressor.stats())
+        if blocks is not None:
+            logger.info("Delta%s: %s", who, blocks.stats())
+
+        if not args.quiet:
+            dt = asyncio.get_event_loop().time() - start_ts
+            rate = sent / max(dt, 1e-6)
+            sys.stdout.write(
+                f"\nDone in {dt:.2f}s, avg {human(rate)}/s, sha256={digest}\n"
+            )
+            sys.stdout.flush()
+
+        # 之后只处理接收端要的分片（校验失败补发 / swarm 拉取），直到收到 ack
+        while True:
+            await refill.wait()
+            refill.clear()
+            await asyncio.gather(*(pump(ch) for ch in channels))
 
-                chunk = f.read(CHUNK_SIZE)
-                if not chunk:
-                    break
-                sha256.update(chunk)
-                channel.send(chunk)
-                sent += len(chunk)
-
-                if not args.quiet:
-                    pct = sent / file_size * 100 if file_size > 0 else 100
-                    sys.stdout.write(
-                        f"\rSending {file_name}: {human(sent)}/{human(file_size)} ({pct:.1f}%)"
-                    )
-                    sys.stdout.flush()
+    # ========== DataChannel 回调 ==========
+    opened = set()
 
-            digest = sha256.hexdigest()
-            channel.send(json.dumps({"kind": "eof", "sha256": digest}))
-            logger.info("File transfer complete, sha256=%s", digest)
+    def watch_open(ch):
+        @ch.on("open")
+        def on_open():
+            opened.add(ch.label)
+            logger.info("DataChannel %s opened", ch.label)
+            if len(opened) == len(channels):
+                phases.mark("channels_open")
+                logger.info("All %d DataChannels open, start sending file", len(channels))
+                send_task = asyncio.ensure_future(send_file())
+                done_fut.add_done_callback(lambda _: send_task.cancel())
 
-            if not args.quiet:
-                dt = asyncio.get_event_loop().time() - start_ts
-                rate = sent / max(dt, 1e-6)
-                sys.stdout.write(
-                    f"\nDone in {dt:.2f}s, avg {human(rate)}/s, sha256={digest}\n"
-                )
-                sys.stdout.flush()
+        if ch.readyState == "open":  # rudp 的通道连上就是 open，不发 open 事件
+            asyncio.get_event_loop().call_soon(on_open)
 
-    # ========== DataChannel 回调 ==========
-    @channel.on("open")
-    def on_open():
-        logger.info("DataChannel opened, start sending file")
-        asyncio.ensure_future(send_file())
+    for ch in channels:
+        watch_open(ch)
 
     @channel.on("message")
     def on_message(msg):
@@ -105,7 +304,34 @@ async def run(args):
             j = json.loads(msg) if isinstance(msg, str) else None
         except Exception:
             j = None
-        if isinstance(j, dict) and j.get("kind") == "ack":
+        if isinstance(j, dict) and j.get("kind") == "sigs":
+            sig_parts[j["start"]] = j["data"]
+        elif isinstance(j, dict) and j.get("kind") == "have":
+            if not have_fut.done():
+                have_fut.set_result(j)
+        elif isinstance(j, dict) and j.get("kind") == "need":
+            # swarm 模式下是正常的拉取请求，否则是分片校验没过要补发
+            pull = have_fut.done() and have_fut.result().get("pull")
+            if not pull:
+                logger.warning("Receiver asked to resend chunks %s", j["chunks"][:10])
+            todo.extend(j["chunks"])
+            refill.set()
+        elif isinstance(j, dict) and j.get("kind") == "cancel":
+            # endgame 里别的发送端先送到了
+            for index in j["chunks"]:
+                try:
+                    todo.remove(index)
+                except ValueError:
+                    pass
+        elif isinstance(j, dict) and j.get("kind") == "pong":
+            flow.on_pong(j)
+        elif isinstance(j, dict) and j.get("kind") in ("pause", "resume"):
+            logger.debug("Receiver asked to %s", j["kind"])
+            if j["kind"] == "pause":
+                flowing.clear()
+            else:
+                flowing.set()
+        elif isinstance(j, dict) and j.get("kind") == "ack":
             logger.info("Received ACK from receiver, transfer confirmed")
             if not done_fut.done():
                 done_fut.set_result(True)
@@ -116,6 +342,8 @@ async def run(args):
     @pc.on("iceconnectionstatechange")
     def on_ice():
         logger.info("ICE connection state changed: %s", pc.iceConnectionState)
+        if pc.iceConnectionState in ("connected", "completed"):
+            phases.mark("ice_connected")
         if pc.iceConnectionState in ("failed", "disconnected", "closed"):
             if not done_fut.done():
                 done_fut.set_exception(
@@ -125,85 +353,355 @@ async def run(args):
     @pc.on("signalingstatechange")
     def on_sig():
         logger.debug("Signaling state changed: %s", pc.signalingState)
+        if pc.signalingState == "stable":  # have-local-offer -> stable：answer 设好了
+            phases.mark("answer")
 
     @pc.on("icegatheringstatechange")
     def on_ice_gather():
         logger.debug("ICE gathering state changed: %s", pc.iceGatheringState)
 
+    if early is None:
+        await gather_offer(pc)
+        phases.mark("gathered")
+        await send_offer(ws, pc, target)
+        logger.info("Sent local SDP offer%s", who)
+
+    @pc.on("icecandidate")
+    async def on_candidate(c):
+        if c:
+            await ws.send(json.dumps({
+                "type": "ice",
+                "to": target,
+                "data": {
+                    "candidate": c.to_sdp(),
+                    "sdpMid": c.sdpMid,
+                    "sdpMLineIndex": c.sdpMLineIndex
+                }
+            }))
+            logger.debug("Sent local ICE candidate")
+
+    # 等待传输完成
+    try:
+        await done_fut
+    finally:
+        pcs.pop(target, None)
+        await pc.close()
+        logger.info("PeerConnection%s closed, flow control: %s", who, flow.stats())
+        telemetry.finish(session)
+
+
+async def serve_session(args, ice_servers, ws, pcs, telemetry, phases, early=None):
+    """会话模式：一条 PeerConnection 上把 --file / --watch 的文件挨个发完，全部 ack 后返回"""
+    pc, channels = early or new_peer(args, ice_servers)
+    pcs[None] = pc
+    flow = FlowControl(channels, args.window_kb * 1024 or None)
+    session = SendSession(args, channels, flow, queued_files(args.file or [], args.watch))
+    done_fut = asyncio.get_event_loop().create_future()
+    channels[0].on("message", session.on_message)
+    opened = set()
+
+    def watch_open(ch):
+        @ch.on("open")
+        def on_open():
+            opened.add(ch.label)
+            if len(opened) < len(channels):
+                return
+            phases.mark("channels_open")
+            logger.info("All %d DataChannels open, starting the session", len(channels))
+            telemetry.track("session", counters={
+                "bytes": lambda: session.sent,
+                "wire_bytes": lambda: flow.sent_bytes,
+                "stall_seconds": lambda: flow.stall_seconds / len(channels),
+                "paused_seconds": lambda: session.paused,
+                "files": lambda: session.acked,
+            }, gauges={
+                "buffered": flow.buffered,
+                "window": lambda: flow.window,
+            }, info={"ice_pair": lambda: candidate_pair(pc)})
+            task = asyncio.ensure_future(session.run())
+            task.add_done_callback(on_session_done)
+            done_fut.add_done_callback(lambda _: task.cancel())
+
+        if ch.readyState == "open":
+            asyncio.get_event_loop().call_soon(on_open)
+
+    def on_session_done(task):
+        if done_fut.done() or task.cancelled():
+            return
+        if task.exception() is not None:
+            done_fut.set_exception(task.exception())
+        else:
+            done_fut.set_result(True)
+
+    for ch in channels:
+        watch_open(ch)
+
+    @pc.on("iceconnectionstatechange")
+    def on_ice():
+        logger.info("ICE connection state changed: %s", pc.iceConnectionState)
+        if pc.iceConnectionState in ("connected", "completed"):
+            phases.mark("ice_connected")
+        if pc.iceConnectionState in ("failed", "disconnected", "closed") and not done_fut.done():
+            done_fut.set_exception(RuntimeError(f"ICE {pc.iceConnectionState}"))
+
+    if early is None:
+        await gather_offer(pc)
+        await send_offer(ws, pc, None)
+        logger.info("Sent local SDP offer")
+
+    try:
+        await done_fut
+    finally:
+        pcs.pop(None, None)
+        await pc.close()
+        session.close()
+        logger.info("Session closed: %s; flow control: %s", session.stats(), flow.stats())
+        telemetry.finish("session")
+
+
+async def run(args):
+    logger.info("Seeder started, preparing: %s", ", ".join(args.file or [args.watch]))
+    telemetry = Telemetry(args.trace, args.trace_interval)
+    phases = Phases(telemetry, "receiver")
+    if args.compress not in ("off", "auto") and args.compress not in compress.available():
+        logger.warning("%s is not available here, offering %s instead",
+                       args.compress, compress.offer(args.compress))
+
+    # ========= ICE 服务器配置 =========
+    ice_servers = []
+    # --stun auto：按缓存的 NAT 探测结果选最快的 STUN，或者不用 STUN（没 NAT / 对称 NAT 有 TURN / UDP 不通）
+    args.stun = await natprobe.resolve_stun(args.stun, bool(args.turn and args.turn_user and args.turn_pass))
+    if args.stun:
+        ice_servers.append(RTCIceServer(urls=[args.stun]))
+    if args.turn and args.turn_user and args.turn_pass:
+        ice_servers.append(RTCIceServer(
+            urls=[args.turn],
+            username=args.turn_user,
+            credential=args.turn_pass
+        ))
+
+    logger.debug("Using ICE servers: %s", ice_servers)
+
+    # ========== 快速启动 ==========
+    # 只服务一个接收端时，PeerConnection 和 offer 不依赖文件和信令：候选收集（STUN 来回）、
+    # 读文件建清单、连信令服务器三件事同时做，offer 一收集好就放进房间，接收端一进来就能回 answer
+    # --transport udp：换成同时收集打洞用的 UDP 候选（rudp.py），打不通再走 WebRTC
+    early = None
+    source = None
+    udp = None
+    if args.transport == "udp":
+        udp = rudp.Connection(args.udp_mss, args.udp_loss, args.udp_delay_ms / 1000)
+        gathering = asyncio.ensure_future(udp.gather(args.stun))
+        gathering.add_done_callback(lambda _: phases.mark("gathered"))
+    elif not args.multi and not args.swarm and not args.slow_start:
+        early = new_peer(args, ice_servers)
+        gathering = asyncio.ensure_future(gather_offer(early[0]))
+        gathering.add_done_callback(lambda _: phases.mark("gathered"))
+
+    # 给的是目录就按目录模式发，见 tree.py；会话模式的文件由 SendSession 一个个打开
+    opening = None
+    if not args.session:
+        source_cls = TreeSource if os.path.isdir(args.file[0]) else FileSource
+        opening = asyncio.ensure_future(asyncio.to_thread(
+            source_cls.open, args.file[0], not args.no_manifest,
+            args.cache_mb * 1024 * 1024, args.chunk_kb * 1024, not args.no_manifest_cache))
+        opening.add_done_callback(lambda _: phases.mark("source_ready"))
+
     # ========== 信令服务器 ==========
     async with websockets.connect(args.signaling) as ws:
+        phases.mark("connected")
         logger.info("Connected to signaling server: %s", args.signaling)
-        await ws.send(json.dumps(
-            {"type": "join", "room": args.room, "role": "sender"}
-        ))
+        await ws.send(json.dumps({
+            "type": "join", "room": args.room, "role": "sender",
+            "multi": args.swarm or args.multi,
+        }))
         logger.debug("Join request sent for room %s", args.room)
+        if early is not None:
+            # join 和 offer 按顺序到服务器，不用等 joined；接收端还没来就缓存在房间里
+            await gathering
+            await send_offer(ws, early[0], None)
+            logger.info("Parked SDP offer in room %s", args.room)
+        elif udp is not None:
+            await ws.send(json.dumps({"type": "udp", "data": await gathering}))
+            logger.info("Parked UDP candidates in room %s", args.room)
 
         joined = json.loads(await ws.recv())
+        phases.mark("joined")
         logger.info("Join ack: %s", joined)
-
-        offer = await pc.createOffer()
-        await pc.setLocalDescription(offer)
-        logger.debug("Created local SDP offer")
-
-        await ws.send(json.dumps({
-            "type": "sdp",
-            "data": {
-                "sdp": pc.localDescription.sdp,
-                "type": pc.localDescription.type
-            }
-        }))
-        logger.info("Sent local SDP offer")
+        if opening is not None:
+            source = await opening
+            if source.manifest is not None:
+                logger.info("Chunk manifest ready, merkle root=%s", source.manifest.root)
+
+        pcs = {}          # 接收端 id -> PeerConnection；普通模式只有一个，key 为 None
+        present = set(joined.get("peers", []))  # 房间里的接收端
+        arrivals = asyncio.Queue()
+        for rid in joined.get("peers", []):
+            arrivals.put_nowait(rid)
+        receiver_seen = asyncio.Event()
+        if present:
+            receiver_seen.set()
+        udp_answer = asyncio.get_event_loop().create_future()
 
         async def recv_task():
             async for raw in ws:
                 m = json.loads(raw)
-                if m["type"] == "sdp":
+                peer_id = m.get("from")
+                pc = pcs.get(peer_id) or pcs.get(None)
+                if m["type"] == "sdp" and pc is not None:
                     sdp = m["data"]
                     await pc.setRemoteDescription(
                         RTCSessionDescription(sdp=sdp["sdp"], type=sdp["type"])
                     )
                     logger.info("Received remote SDP and set description")
-                elif m["type"] == "ice":
+                elif m["type"] == "ice" and pc is not None:
                     cand = m["data"]
                     await pc.addIceCandidate(cand)
                     logger.debug("Added remote ICE candidate")
+                elif m["type"] == "udp" and not udp_answer.done():
+                    udp_answer.set_result(m["data"])
+                elif m["type"] == "peer" and m["role"] == "receiver":
+                    if m["event"] == "join":
+                        present.add(m["id"])
+                        receiver_seen.set()
+                        arrivals.put_nowait(m["id"])
+                    else:
+                        present.discard(m["id"])
+                        arrivals.put_nowait(None)  # 唤醒主循环检查是否该退出
 
         rt = asyncio.create_task(recv_task())
+        if udp is not None:
+            early = await try_udp(udp, udp_answer, receiver_seen, phases)
+
+        if args.session:
+            await serve_session(args, ice_servers, ws, pcs, telemetry, phases, early)
+        elif not args.multi:
+            # swarm 模式下房间里可能有多个发送端，offer 要点名发给接收端
+            target = None
+            if args.swarm:
+                while target is None:
+                    target = await arrivals.get()
+                logger.info("Serving receiver %s", target)
+            await serve_receiver(args, source, ice_servers, ws, target, pcs, telemetry, phases, early)
+        else:
+            # 一对多：每个进房间的接收端一条 PeerConnection，共用同一个 FileSource
+            served = 0
+            tasks = set()
+
+            async def serve_one(rid):
+                nonlocal served
+                try:
+                    await serve_receiver(args, source, ice_servers, ws, rid, pcs, telemetry,
+                                         Phases(telemetry, rid))
+                    served += 1
+                except Exception as e:
+                    logger.warning("Receiver %s dropped: %s", rid, e)
 
-        @pc.on("icecandidate")
-        async def on_candidate(c):
-            if c:
-                await ws.send(json.dumps({
-                    "type": "ice",
-                    "data": {
-                        "candidate": c.to_sdp(),
-                        "sdpMid": c.sdpMid,
-                        "sdpMLineIndex": c.sdpMLineIndex
-                    }
-                }))
-                logger.debug("Sent local ICE candidate")
-
-        # 等待传输完成
-        await done_fut
-        await ws.send(BYE)
-        logger.info("Sent BYE to signaling server")
+            while True:
+                if args.receivers and served >= args.receivers:
+                    break
+                if args.until_empty and not present and not tasks:
+                    break
+                waiter = asyncio.ensure_future(arrivals.get())
+                finished, _ = await asyncio.wait(
+                    tasks | {waiter}, return_when=asyncio.FIRST_COMPLETED)
+                tasks -= finished
+                if waiter not in finished:
+                    waiter.cancel()
+                    continue
+                rid = waiter.result()
+                if rid is not None and rid not in pcs:
+                    logger.info("Receiver %s joined, %d active", rid, len(pcs) + 1)
+                    tasks.add(asyncio.ensure_future(serve_one(rid)))
+            for t in tasks:
+                t.cancel()
+            logger.info("Served %d receivers", served)
+
+        await ws.send(json.dumps({"type": "leave"}))
+        logger.info("Sent leave to signaling server")
         rt.cancel()
-
-    await pc.close()
-    logger.info("PeerConnection closed")
+    if source is not None:
+        if source.cache is not None:
+            logger.info("Chunk cache: %s", source.cache.stats())
+        source.close()
+    telemetry.close()
 
 
 # ================= 主函数入口 =================
-if __name__ == "__main__":
+def build_parser() -> argparse.ArgumentParser:
+    """命令行参数；p2p_get --reseed 也用它拿默认值，不用自己再列一遍"""
     parser = argparse.ArgumentParser()
     parser.add_argument("--signaling", required=True, help="ws://your-vps-ip:8765")
     parser.add_argument("--room", required=True, help="room id (any string)")
-    parser.add_argument("--file", required=True, help="path of file to send")
-    parser.add_argument("--stun", default="stun:stun.l.google.com:19302", help="STUN url")
+    parser.add_argument("--file", nargs="+", metavar="PATH",
+                        help="path of file or directory to send (several with --session)")
+    parser.add_argument("--session", action="store_true",
+                        help="send every --file (and --watch arrival) over one connection, one after another")
+    parser.add_argument("--watch", metavar="DIR",
+                        help="with --session, keep sending files that appear in DIR")
+    parser.add_argument("--stun", default="auto",
+                        help="STUN url, '' for none, or auto: pick from a cached NAT probe (natprobe.py)")
     parser.add_argument("--turn", help="TURN url, e.g. turn:your-vps:2025?transport=udp")
     parser.add_argument("--turn-user", help="TURN username")
     parser.add_argument("--turn-pass", help="TURN password")
+    parser.add_argument("--channels", type=int, default=1,
+                        help="number of DataChannels to stripe chunks across")
+    parser.add_argument("--swarm", action="store_true",
+                        help="join as one of several seeders for a --swarm receiver")
+    parser.add_argument("--multi", action="store_true",
+                        help="serve every receiver that joins the room, one PeerConnection each")
+    parser.add_argument("--receivers", type=int, default=0,
+                        help="with --multi, exit after this many receivers finished (0 = keep serving)")
+    parser.add_argument("--until-empty", action="store_true",
+                        help="with --multi, exit once no receivers are left in the room")
+    parser.add_argument("--cache-mb", type=int, default=64,
+                        help="LRU cache of hot chunk frames shared by all receivers (0 = off)")
+    parser.add_argument("--chunk-kb", type=int, default=CHUNK_SIZE // 1024,
+                        help="chunk size for the manifest, resume bitmap and requests")
+    parser.add_argument("--compress", choices=["off", "auto", "zlib", "zstd"], default="off",
+                        help="compress chunks for receivers that support it (zstd needs zstandard)")
+    parser.add_argument("--window-kb", type=int, default=0,
+                        help="pin the flow-control window instead of sizing it from throughput x RTT (0 = adaptive)")
+    parser.add_argument("--transport", choices=["webrtc", "udp"], default="webrtc",
+                        help="udp: punch a plain UDP path and use the built-in reliable transport "
+                             "(one receiver, one stream), falling back to WebRTC if that fails")
+    parser.add_argument("--udp-mss", type=int, default=rudp.DEFAULT_MSS,
+                        help="UDP payload bytes per packet; raise on loopback/LAN with jumbo frames")
+    parser.add_argument("--udp-loss", type=float, default=0.0,
+                        help="drop this fraction of sent UDP packets (testing)")
+    parser.add_argument("--udp-delay-ms", type=float, default=0.0,
+                        help="delay sent UDP packets by this much (testing)")
+    parser.add_argument("--slow-start", action="store_true",
+                        help="create the offer only after joining and reading the file (the old sequential setup)")
+    parser.add_argument("--no-manifest", action="store_true",
+                        help="skip the per-chunk hash manifest (no upfront read pass)")
+    parser.add_argument("--no-manifest-cache", action="store_true",
+                        help="always rehash instead of reusing the manifest cached for an unchanged file")
+    parser.add_argument("--trace", metavar="PATH",
+                        help="write a JSON-lines telemetry trace (throughput, buffers, stalls, ...)")
+    parser.add_argument("--trace-interval", type=float, default=DEFAULT_INTERVAL,
+                        help="seconds between telemetry samples")
+    parser.add_argument("--log-level", default="INFO",
+                        choices=["DEBUG", "INFO", "WARNING", "ERROR"])
     parser.add_argument("--quiet", action="store_true", default=False)
+    return parser
+
+
+if __name__ == "__main__":
+    parser = build_parser()
     args = parser.parse_args()
+    logging.getLogger().setLevel(args.log_level)
+    if args.watch:
+        args.session = True
+    if not args.file and not args.watch:
+        parser.error("--file is required")
+    if args.session and (args.multi or args.swarm):
+        parser.error("--session serves a single receiver, it cannot be combined with --multi/--swarm")
+    if args.transport == "udp" and (args.multi or args.swarm):
+        parser.error("--transport udp serves a single receiver, it cannot be combined with --multi/--swarm")
+    if len(args.file or []) > 1 and not args.session:
+        parser.error("several --file paths need --session")
+    if not MIN_CHUNK_SIZE <= args.chunk_kb * 1024 <= MAX_CHUNK_SIZE:
+        parser.error(f"--chunk-kb must be between {MIN_CHUNK_SIZE // 1024} and {MAX_CHUNK_SIZE // 1024}")
 
     asyncio.run(run(args))
@@ -1,18 +1,89 @@
 import asyncio
 import json
+import logging
+import multiprocessing
+import os
+import time
+import uuid
 import websockets
-from collections import defaultdict, deque
 
-# 房间结构：存 sender/receiver websocket，以及消息缓存队列
-rooms = defaultdict(lambda: {
-    "sender": None,
-    "receiver": None,
-    "queue": deque(maxlen=100)  # 缓存最近 100 条消息（SDP/ICE）
-})
-LOCK = asyncio.Lock()
+import metrics
+from broker import LocalBroker, UnixBroker, serve_broker
+
+logging.basicConfig(
+    level=logging.INFO,
+    format="%(asctime)s [%(levelname)s] %(message)s",
+    handlers=[logging.StreamHandler()]
+)
+logger = logging.getLogger("signal")
+logging.getLogger("websockets").setLevel(logging.WARNING)  # 每个连接开关都打一行太吵
+
+SEND_QUEUE = 256   # 每个连接最多排多少条待发消息，满了说明对方读不动，断开它
+
+# 房间表在 broker 里（见 broker.py）：单进程时就在本进程，多 worker 时在主进程，
+# worker 之间通过它转发 SDP/ICE，发送端和接收端连到不同 worker 上也能配对
+broker = None
+conns = set()
+
+MESSAGES = metrics.counter("signal_messages_total", "Messages received from clients by type", "type")
+SEND_WAIT = metrics.histogram("signal_send_wait_seconds",
+                              "Time a message waits in a connection's send queue")
+SLOW_CLOSED = metrics.counter("signal_slow_consumers_closed_total",
+                              "Connections closed because their send queue filled up")
+metrics.gauge("signal_connections", "Open WebSocket connections", lambda: len(conns))
+metrics.gauge("signal_send_queue_messages", "Messages waiting in send queues, all connections",
+              lambda: sum(c.queue.qsize() for c in conns))
+metrics.gauge("signal_send_queue_max", "Deepest send queue of any connection",
+              lambda: max((c.queue.qsize() for c in conns), default=0))
+
+
+class Conn:
+    """一个 WebSocket 连接：有界发送队列 + 单独的写协程
+
+    往外发消息只是放进这个队列，一个读得慢的连接只会堵住它自己，不会拖住其它房间的信令。
+    """
+
+    def __init__(self, ws):
+        self.ws = ws
+        self.id = uuid.uuid4().hex[:8]
+        self.queue = asyncio.Queue(maxsize=SEND_QUEUE)
+        self.closed = False
+        self.writer = asyncio.ensure_future(self._write())
+
+    def post(self, text: str):
+        """不阻塞地排一条消息；队列满了就断开这个连接"""
+        if self.closed or self.writer.done():
+            return
+        try:
+            self.queue.put_nowait((time.perf_counter(), text))
+        except asyncio.QueueFull:
+            logger.warning("Peer %s is not reading, %d messages queued, closing it",
+                           self.id, SEND_QUEUE)
+            SLOW_CLOSED.inc()
+            self.close()
+
+    def close(self):
+        self.closed = True
+        self.writer.cancel()
+        asyncio.ensure_future(self.ws.close(1008, "send queue full"))
+
+    def kick(self):
+        # 同角色的新连接进了房间
+        asyncio.ensure_future(self.ws.close())
+
+    async def _write(self):
+        try:
+            while True:
+                ts, text = await self.queue.get()
+                await self.ws.send(text)
+                SEND_WAIT.observe(time.perf_counter() - ts)
+        except websockets.ConnectionClosed:
+            pass
 
 
 async def handler(ws):
+    conn = Conn(ws)
+    conns.add(conn)
     room_name = None
     role = None
     try:
@@ -20,85 +91,118 @@ async def handler(ws):
             try:
                 msg = json.loads(raw)
             except Exception:
-                await ws.send(json.dumps({"type": "error", "error": "invalid_json"}))
+                conn.post(json.dumps({"type": "error", "error": "invalid_json"}))
                 continue
 
             t = msg.get("type")
+            MESSAGES.inc(value=t if t in ("join", "sdp", "ice", "udp", "leave") else "other")
 
             if t == "join":
-                # {type:"join", room:"abc", role:"sender"/"receiver"}
+                # {type:"join", room:"abc", role:"sender"/"receiver", multi:false, batch:false}
+                if room_name and role:
+                    broker.leave(conn, room_name, role)
                 room_name = msg.get("room")
                 role = msg.get("role")
                 if not room_name or role not in ("sender", "receiver"):
-                    await ws.send(json.dumps({"type": "error", "error": "bad_join"}))
+                    room_name = role = None
+                    conn.post(json.dumps({"type": "error", "error": "bad_join"}))
                     continue
+                broker.join(conn, room_name, role, msg.get("multi"), msg.get("batch"))
 
-                async with LOCK:
-                    r = rooms[room_name]
-                    # 如果已有同角色，挤掉旧的
-                    old = r.get(role)
-                    if old and old.open:
-                        try:
-                            await old.close()
-                        except:
-                            pass
-                    r[role] = ws
-                    # 回确认
-                    await ws.send(json.dumps({
-                        "type": "joined",
-                        "room": room_name,
-                        "role": role
-                    }))
-                    # 回放缓存消息（只给新加入的另一方发过的消息）
-                    for who, m in list(r["queue"]):
-                        if who != role:
-                            await ws.send(m)
-
-            elif t in ("sdp", "ice"):
+            elif t in ("sdp", "ice", "udp"):  # udp：rudp.py 打洞用的候选地址
                 if not room_name or not role:
-                    await ws.send(json.dumps({"type": "error", "error": "join_first"}))
+                    conn.post(json.dumps({"type": "error", "error": "join_first"}))
                     continue
-
-                other = "receiver" if role == "sender" else "sender"
-                msg_str = json.dumps(msg)
-
-                async with LOCK:
-                    r = rooms[room_name]
-                    peer = r.get(other)
-                    if peer and peer.open:
-                        await peer.send(msg_str)
-                    else:
-                        # 对方还没来，先缓存
-                        r["queue"].append((role, msg_str))
+                broker.route(conn, room_name, role, msg)
 
             elif t == "leave":
                 break
 
             else:
-                await ws.send(json.dumps({"type": "error", "error": "unknown_type"}))
+                conn.post(json.dumps({"type": "error", "error": "unknown_type"}))
 
     except websockets.ConnectionClosed:
         pass
     finally:
         if room_name and role:
-            async with LOCK:
-                r = rooms.get(room_name)
-                if r and r.get(role) is ws:
-                    r[role] = None
-                if r and not r["sender"] and not r["receiver"]:
-                    del rooms[room_name]
+            broker.leave(conn, room_name, role)
+        conn.writer.cancel()
+        conns.discard(conn)
+
+
+async def serve(host, port, reuse_port=False):
+    async with websockets.serve(handler, host, port, max_size=2**22, reuse_port=reuse_port):
+        # worker 和 broker 断了就退出，房间状态已经不可信
+        await (broker.closed or asyncio.Future())
+
+
+def worker_main(host, port, path, reuse_port, metrics_port):
+    """worker 进程入口：连上主进程的 broker，在 port 上收 WebSocket"""
+    global broker
+    broker = UnixBroker(path)
+
+    async def go():
+        await broker.start()
+        if metrics_port:
+            await metrics.serve(host, metrics_port)
+        logger.info("Worker %d listening on ws://%s:%d", os.getpid(), host, port)
+        await serve(host, port, reuse_port)
+
+    asyncio.run(go())
 
 
 async def main():
+    global broker
     import argparse
     p = argparse.ArgumentParser()
     p.add_argument("--host", default="0.0.0.0")
     p.add_argument("--port", type=int, default=8765)
+    p.add_argument("--workers", type=int, default=1,
+                   help="worker processes; with more than one, rooms are shared through a broker")
+    p.add_argument("--separate-ports", action="store_true",
+                   help="worker k listens on port+k instead of all sharing port via SO_REUSEPORT")
+    p.add_argument("--broker-socket", help="Unix socket for the room broker (default: /tmp/p2pshare-broker-<port>.sock)")
+    p.add_argument("--metrics-port", type=int,
+                   help="serve Prometheus metrics on this port (worker k of --workers uses port+1+k)")
     args = p.parse_args()
 
-    async with websockets.serve(handler, args.host, args.port, max_size=2**22):
+    if args.workers <= 1:
+        broker = LocalBroker()
+        if args.metrics_port:
+            await metrics.serve(args.host, args.metrics_port)
         print(f"Signal server listening on ws://{args.host}:{args.port}")
-        await asyncio.Future()
+        await serve(args.host, args.port)
+        return
+
+    # ========== 多进程：本进程只跑 broker，连接都在 worker 里 ==========
+    path = args.broker_socket or f"/tmp/p2pshare-broker-{args.port}.sock"
+    if os.path.exists(path):
+        os.unlink(path)
+    server = await serve_broker(path)
+    if args.metrics_port:
+        await metrics.serve(args.host, args.metrics_port)  # 房间表的指标在 broker 进程里
+    ctx = multiprocessing.get_context("spawn")
+    procs = []
+    for k in range(args.workers):
+        port = args.port + k if args.separate_ports else args.port
+        worker_metrics = args.metrics_port + 1 + k if args.metrics_port else None
+        proc = ctx.Process(target=worker_main, name=f"worker-{k}", daemon=True,
+                           args=(args.host, port, path, not args.separate_ports, worker_metrics))
+        proc.start()
+        procs.append(proc)
+    ports = (f"{args.port}-{args.port + args.workers - 1}" if args.separate_ports
+             else str(args.port))
+    print(f"Signal server listening on ws://{args.host}:{ports} with {args.workers} workers")
+    try:
+        # 哪个 worker 挂了就整个退出，交给外面的进程管理重启
+        while all(proc.is_alive() for proc in procs):
+            await asyncio.sleep(1)
+        logger.error("A worker exited, shutting down")
+    finally:
+        server.close()
+        for proc in procs:
+            proc.terminate()
+        os.unlink(path)
 
 
 if __name__ == "__main__":
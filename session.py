@@ -0,0 +1,466 @@
+# session.py - 会话模式：一条 PeerConnection 上按顺序传一串文件（seeder.py / p2p_get.py --session）
+#
+# 只协商一次 ICE，之后每个文件一个传输编号 xfer：
+#   发送端 meta{xfer, base, ...}（+ files / manifest）-> 接收端 have{xfer} -> 分片 -> eof{xfer}
+#   接收端收尾（落盘、fsync、整文件校验）后回 ack{xfer, ok}
+# 发送端发完一个文件的分片就开始下一个文件的 meta，不等 ack；接收端的收尾在线程里做，
+# 和下一个文件的接收同时进行。队列发完发 end{files}，接收端全部 ack 完就结束。
+#
+# 帧头不变：每个文件的分片在整个会话里连续编号，帧里发 base + 序号（见 FileSource.base），
+# 接收端按 base 找到是哪个文件。会话模式只有一个发送端、不压缩、不做增量。
+
+import asyncio
+import bisect
+import json
+import logging
+import os
+from collections import deque
+
+from common import RECV_MAX_MESSAGE, ChunkBitmap, human, max_message_size, piece_limit, unpack_frame
+from download import Download
+from flow import PING_INTERVAL, PieceSizer
+from source import FileSource
+from tree import TreeSource
+
+logger = logging.getLogger("session")
+
+WATCH_INTERVAL = 1.0  # --watch 扫目录的间隔
+
+
+async def queued_files(paths, watch_dir=None, interval=WATCH_INTERVAL):
+    """先给命令行上的路径；给了 watch_dir 就一直等目录里新出现、已经写完的文件"""
+    for path in paths:
+        yield path
+    if watch_dir is None:
+        return
+    seen = {}    # 路径 -> (大小, mtime)，连着两次扫到一样才算写完
+    sent = set(os.path.abspath(p) for p in paths)
+    logger.info("Watching %s for new files", watch_dir)
+    while True:
+        for name in sorted(os.listdir(watch_dir)):
+            path = os.path.abspath(os.path.join(watch_dir, name))
+            if name.startswith(".") or name.endswith((".chunks", ".part")) or path in sent:
+                continue
+            try:
+                st = os.stat(path)
+            except OSError:
+                continue
+            if not os.path.isfile(path):
+                continue
+            sig = (st.st_size, st.st_mtime_ns)
+            if seen.get(path) == sig:
+                sent.add(path)
+                del seen[path]
+                yield path
+            else:
+                seen[path] = sig
+        await asyncio.sleep(interval)
+
+
+# ====== 发送端 ======
+
+class Outgoing:
+    def __init__(self, xfer, source):
+        self.xfer = xfer
+        self.source = source
+        self.have = asyncio.get_event_loop().create_future()
+        self.unsent = 0                # 排进队列、还没发出去的分片数
+        self.drained = asyncio.Event()
+        self.drained.set()
+
+
+class SendSession:
+    """发送端：文件一个接一个排进所有通道共用的待发队列"""
+
+    def __init__(self, args, channels, flow, files):
+        self.args = args
+        self.channels = channels
+        self.control = channels[0]
+        self.flow = flow
+        self.files = files             # 异步迭代器，给出要发的路径
+        self.transfers = {}            # xfer -> Outgoing，收到 ack 前一直在
+        self.todo = deque()            # (Outgoing, 分片序号)
+        self.refill = asyncio.Event()
+        self.flowing = asyncio.Event()  # 接收端写盘跟不上时发 pause 清掉，resume 再置上
+        self.flowing.set()
+        self.sizer = None              # 第一个 have 回来才知道对端能收多大的消息
+        self.sent = 0
+        self.paused = 0.0
+        self.count = 0                 # 已经开始发的文件数
+        self.acked = 0
+        self.failed = 0
+        self.ended = False
+        self.done = asyncio.get_event_loop().create_future()
+
+    def send(self, kind, **fields):
+        self.control.send(json.dumps({"kind": kind, **fields}))
+
+    async def _open(self, path):
+        """下一个文件的 FileSource（要建清单时会把文件读一遍）；打不开返回 None"""
+        cls = TreeSource if os.path.isdir(path) else FileSource
+        try:
+            return await asyncio.to_thread(
+                cls.open, path, not self.args.no_manifest,
+                self.args.cache_mb * 1024 * 1024, self.args.chunk_kb * 1024,
+                not self.args.no_manifest_cache)
+        except OSError as e:
+            logger.warning("Skipping %s: %s", path, e)
+            return None
+
+    async def _next_source(self):
+        async for path in self.files:
+            source = await self._open(path)
+            if source is not None:
+                return source
+        return None
+
+    async def run(self):
+        pumps = [asyncio.ensure_future(self._pump(ch)) for ch in self.channels]
+        pinger = asyncio.ensure_future(self._ping_loop())
+        base = 0
+        prev = None
+        try:
+            # 下一个文件在当前文件发送时就打开、建清单
+            opening = asyncio.ensure_future(self._next_source())
+            while True:
+                source = await opening
+                if source is None:
+                    break
+                opening = asyncio.ensure_future(self._next_source())
+                source.base = base
+                base += source.meta["chunks"]
+                t = await self._start(source)
+                if t is not None and prev is not None:
+                    # 最多领先一个文件：上一个发完了再去准备下一个的 meta
+                    await prev.drained.wait()
+                prev = t or prev
+            self.ended = True
+            self.send("end", files=self.count)
+            logger.info("Queue done, %d files sent, waiting for the last acks", self.count)
+            if not self.transfers:
+                self.done.set_result(True)
+            await self.done
+        finally:
+            for task in pumps + [pinger]:
+                task.cancel()
+
+    async def _start(self, source):
+        """发 meta、等 have，把缺的分片排上；分片发完的 eof 交给单独的协程"""
+        t = Outgoing(self.count, source)
+        self.count += 1
+        self.transfers[t.xfer] = t
+        meta = source.meta
+        self.send("meta", xfer=t.xfer, base=source.base, **meta)
+        for part in source.file_list:
+            self.control.send(json.dumps({**part, "xfer": t.xfer}))
+        if source.manifest is not None:
+            for part in source.manifest.messages():
+                self.control.send(json.dumps({**part, "xfer": t.xfer}))
+        logger.info("Sending #%d %s (%s)", t.xfer, meta["name"], human(meta["size"]))
+        j = await t.have
+        if j is None:
+            return None  # 接收端不要这个文件（清单对不上之类），已经回了 ack
+        if self.sizer is None:
+            limit = piece_limit(j.get("max_message") or max_message_size(None))
+            self.sizer = PieceSizer(self.flow, min(limit, meta["chunk_size"]))
+            logger.info("Sending pieces of up to %s", human(self.sizer.high))
+        missing = ChunkBitmap.decode(meta["chunks"], j["bitmap"]).missing()
+        self._queue(t, missing)
+        asyncio.ensure_future(self._eof(t))
+        return t
+
+    def _queue(self, t, chunks):
+        if not chunks:
+            return
+        t.unsent += len(chunks)
+        t.drained.clear()
+        self.todo.extend((t, i) for i in chunks)
+        self.refill.set()
+
+    async def _eof(self, t):
+        await t.drained.wait()
+        digest = await t.source.digest()
+        if t.xfer in self.transfers:
+            self.send("eof", xfer=t.xfer, sha256=digest)
+
+    async def _pump(self, ch):
+        loop = asyncio.get_event_loop()
+        while True:
+            if not self.flowing.is_set():
+                t0 = loop.time()
+                await self.flowing.wait()
+                self.paused += loop.time() - t0
+            await self.flow.wait(ch)
+            if not self.todo:
+                self.refill.clear()
+                await self.refill.wait()
+                continue
+            t, index = self.todo.popleft()
+            source = t.source
+            piece = self.sizer.current()
+            for k, offset in enumerate(range(0, source.chunk_len(index), piece)):
+                if k:
+                    await self.flow.wait(ch)
+                frame = source.frame(index, offset, piece)
+                ch.send(frame)
+                self.flow.sent(len(frame))
+            self.sent += source.chunk_len(index)
+            t.unsent -= 1
+            if not t.unsent:
+                t.drained.set()
+
+    async def _ping_loop(self):
+        while self.control.readyState == "open":
+            self.control.send(json.dumps(self.flow.ping()))
+            await asyncio.sleep(PING_INTERVAL)
+
+    def on_message(self, msg):
+        try:
+            j = json.loads(msg) if isinstance(msg, str) else None
+        except ValueError:
+            j = None
+        if not isinstance(j, dict):
+            return
+        kind = j.get("kind")
+        t = self.transfers.get(j.get("xfer"))
+        if kind == "have" and t is not None:
+            if not t.have.done():
+                t.have.set_result(j)
+        elif kind == "need" and t is not None:
+            logger.warning("Receiver asked to resend chunks %s of #%d", j["chunks"][:10], t.xfer)
+            self._queue(t, j["chunks"])
+        elif kind == "ack" and t is not None:
+            self._acked(t, j.get("ok"))
+        elif kind == "pong":
+            self.flow.on_pong(j)
+        elif kind in ("pause", "resume"):
+            logger.debug("Receiver asked to %s", kind)
+            if kind == "pause":
+                self.flowing.clear()
+            else:
+                self.flowing.set()
+
+    def _acked(self, t, ok):
+        del self.transfers[t.xfer]
+        if not t.have.done():
+            t.have.set_result(None)
+        # 还排着的分片（接收端中途放弃的文件）不用再发
+        if t.unsent:
+            self.todo = deque(item for item in self.todo if item[0] is not t)
+            t.unsent = 0
+            t.drained.set()
+        if ok:
+            self.acked += 1
+            logger.info("#%d %s confirmed", t.xfer, t.source.meta["name"])
+        else:
+            self.failed += 1
+            logger.warning("#%d %s failed on the receiver", t.xfer, t.source.meta["name"])
+        t.source.close()
+        if self.ended and not self.transfers and not self.done.done():
+            self.done.set_result(True)
+
+    def close(self):
+        for t in self.transfers.values():
+            t.source.close()
+        self.transfers.clear()
+
+    def stats(self) -> str:
+        return f"{self.acked} files confirmed, {self.failed} failed, {human(self.sent)} sent"
+
+
+# ====== 接收端 ======
+
+class ReceiveSession:
+    """接收端：每个文件一个 Download，收尾和下一个文件的接收同时进行"""
+
+    def __init__(self, args, phases, done_evt):
+        self.args = args
+        self.outdir = args.output or "."
+        self.phases = phases
+        self.done_evt = done_evt
+        self.control = None
+        self.transfers = {}      # xfer -> Download（收尾完成前）
+        self.bases = []          # 进行中的文件的 base，升序，和 xfers 一一对应
+        self.xfers = []
+        self.finishing = set()
+        self.paused = set()      # 写缓冲满了的文件，都恢复了才让发送端继续
+        self.deferred = {}       # 写缓冲满时丢掉的分片，xfer -> [序号]
+        self.expected = None     # end 里说的文件总数
+        self.finished = 0
+        self.failed = 0
+        self.recv_bytes = 0      # 已经校验通过的字节数，所有文件加起来
+        self.wire_bytes = 0
+        os.makedirs(self.outdir, exist_ok=True)
+
+    def attach(self, ch):
+        self.control = ch
+
+        @ch.on("message")
+        def _msg(msg):
+            if isinstance(msg, bytes):
+                self.on_chunk(msg)
+                return
+            try:
+                j = json.loads(msg)
+            except ValueError:
+                logger.error("Invalid text message: %s", msg)
+                return
+            self.on_control(j)
+
+    def attach_data(self, ch):
+        @ch.on("message")
+        def _msg(msg):
+            if isinstance(msg, bytes):
+                self.on_chunk(msg)
+
+    def send(self, kind, **fields):
+        if self.control is not None and self.control.readyState == "open":
+            self.control.send(json.dumps({"kind": kind, **fields}))
+
+    def queued(self) -> int:
+        return sum(dl.queued for dl in self.transfers.values())
+
+    # ---------- 控制消息 ----------
+
+    def on_control(self, j):
+        kind = j.get("kind")
+        xfer = j.get("xfer")
+        dl = self.transfers.get(xfer)
+        if kind == "meta":
+            self.phases.mark("meta")
+            self._start(xfer, j)
+        elif kind == "files" and dl is not None:
+            dl.add_file_list_part(j)
+            self._check_ready(xfer)
+        elif kind == "manifest" and dl is not None:
+            dl.add_manifest_part(j)
+            self._check_ready(xfer)
+        elif kind == "eof" and dl is not None:
+            dl.remote_digest = j["sha256"]
+            if dl.complete():
+                asyncio.ensure_future(self._finish(xfer))
+        elif kind == "end":
+            self.expected = j["files"]
+            logger.info("Seeder queued %d files in this session", self.expected)
+            self._check_end()
+        elif kind == "ping":
+            self.send("pong", seq=j.get("seq"))
+
+    def _start(self, xfer, meta):
+        name = os.path.basename(meta["name"])  # 不让对端往输出目录外面写
+        dl = Download(os.path.join(self.outdir, name), self.args.overwrite,
+                      not self.args.no_resume, self.args.quiet, self.args.max_buffer_mb * 1024 * 1024,
+                      self.args.durability, self.args.sync_mb * 1024 * 1024, self.args.sync_interval)
+        dl.base = meta["base"]
+        dl.on_result = lambda index, ok, tag, nbytes: self._on_result(xfer, index, ok, nbytes)
+        dl.on_pressure = lambda paused: self._on_pressure(xfer, paused)
+        dl.on_failed = lambda exc: self._on_failed(xfer, exc)
+        self.transfers[xfer] = dl
+        k = bisect.bisect(self.bases, dl.base)
+        self.bases.insert(k, dl.base)
+        self.xfers.insert(k, xfer)
+        dl.start(meta)
+        self._check_ready(xfer)
+
+    def _check_ready(self, xfer):
+        dl = self.transfers[xfer]
+        try:
+            if not dl.ready():
+                return
+        except ValueError as e:
+            logger.error("#%d %s: file list / manifest check failed: %s", xfer, dl.out_path, e)
+            self._drop(xfer)
+            self.failed += 1
+            self.send("ack", xfer=xfer, ok=False)
+            self._check_end()
+            return
+        self.send("have", xfer=xfer, bitmap=dl.received.encode(), max_message=RECV_MAX_MESSAGE)
+        if dl.complete():
+            asyncio.ensure_future(self._finish(xfer))
+
+    def _drop(self, xfer):
+        dl = self.transfers.pop(xfer)
+        k = self.xfers.index(xfer)
+        del self.bases[k]
+        del self.xfers[k]
+        self.deferred.pop(xfer, None)
+        if xfer in self.paused:
+            self._on_pressure(xfer, False)
+        return dl
+
+    async def _finish(self, xfer):
+        if xfer in self.finishing:
+            return
+        self.finishing.add(xfer)
+        dl = self.transfers[xfer]
+        ok = await dl.finish()
+        self._drop(xfer)
+        self.finishing.discard(xfer)
+        self.finished += 1
+        if not ok:
+            self.failed += 1
+        self.send("ack", xfer=xfer, ok=ok)
+        self._check_end()
+
+    def _check_end(self):
+        if self.expected is not None and not self.transfers and self.finished + self.failed >= self.expected:
+            logger.info("Session done: %d files, %d failed, %s",
+                        self.expected, self.failed, human(self.recv_bytes))
+            self.done_evt.set()
+
+    # ---------- 数据 ----------
+
+    def on_chunk(self, msg):
+        if not self.wire_bytes:
+            self.phases.mark("first_byte")
+            self.phases.report()
+        self.wire_bytes += len(msg)
+        index, offset, codec, data = unpack_frame(msg)
+        k = bisect.bisect(self.bases, index) - 1
+        if k < 0:
+            return
+        xfer = self.xfers[k]
+        dl = self.transfers[xfer]
+        index -= dl.base
+        if dl.file is None or codec != 0 or index >= len(dl.received):
+            return  # 已经在收尾的文件的重复分片
+        data = dl.assemble(index, offset, data)
+        if data is None:
+            return
+        if dl.accept(index, data) == "busy":
+            self.deferred.setdefault(xfer, []).append(index)
+
+    def _on_result(self, xfer, index, ok, nbytes):
+        dl = self.transfers.get(xfer)
+        if dl is None:
+            return
+        if not ok:
+            logger.warning("Chunk %d of #%d failed hash check, asking for it again", index, xfer)
+            self.send("need", xfer=xfer, chunks=[index])
+            return
+        self.recv_bytes += nbytes
+        if dl.complete():
+            asyncio.ensure_future(self._finish(xfer))
+
+    def _on_pressure(self, xfer, paused):
+        was_paused = bool(self.paused)
+        if paused:
+            self.paused.add(xfer)
+        else:
+            self.paused.discard(xfer)
+        if bool(self.paused) == was_paused:
+            return
+        self.send("pause" if paused else "resume")
+        if not paused:
+            for x, chunks in self.deferred.items():
+                self.send("need", xfer=x, chunks=chunks)
+            self.deferred.clear()
+
+    def _on_failed(self, xfer, exc):
+        logger.error("Writing #%d failed: %s", xfer, exc)
+        self.done_evt.set()
+
+    async def suspend(self):
+        """连接断了：正在收的文件都存好位图，下次续传"""
+        for dl in self.transfers.values():
+            await dl.suspend()
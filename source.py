@@ -0,0 +1,160 @@
+# source.py - 发送端的文件源：meta、分片清单、共享的只读映射
+# 同一个进程里服务多个接收端时只读一次清单、只映射一次文件；
+# 最近发过的分片帧放在一个按字节数限额的 LRU 里，几个接收端要同一片时直接复用
+
+import asyncio
+import logging
+import mmap
+import os
+import threading
+from collections import OrderedDict
+
+import manifest
+from common import CHUNK_SIZE, file_meta, file_sha256, pack_frame
+from manifest import Manifest
+
+DEFAULT_CACHE_BYTES = 64 * 1024 * 1024
+
+logger = logging.getLogger("seeder")
+
+
+class ChunkCache:
+    """分片帧的 LRU，按字节数淘汰；压缩模式下会在线程池里用，加了锁"""
+
+    def __init__(self, max_bytes: int):
+        self.max_bytes = max_bytes
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+        self._items = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            item = self._items.get(key)
+            if item is None:
+                self.misses += 1
+                return None
+            self._items.move_to_end(key)
+            self.hits += 1
+            return item
+
+    def put(self, key, value: bytes):
+        if len(value) > self.max_bytes:
+            return
+        with self._lock:
+            old = self._items.pop(key, None)
+            if old is not None:
+                self.size -= len(old)
+            self._items[key] = value
+            self.size += len(value)
+            while self.size > self.max_bytes:
+                _, evicted = self._items.popitem(last=False)
+                self.size -= len(evicted)
+
+    def clear(self):
+        with self._lock:
+            self._items.clear()
+            self.size = 0
+
+    def stats(self) -> str:
+        total = self.hits + self.misses
+        ratio = self.hits / total * 100 if total else 0.0
+        return (f"{self.hits} hits / {self.misses} misses ({ratio:.1f}%), "
+                f"{len(self._items)} chunks, {self.size} bytes cached")
+
+
+class FileSource:
+    file_list = ()  # 目录模式下跟在 meta 后面的 files 消息，见 tree.TreeSource
+    base = 0        # 会话模式（session.py）下这个文件的分片在整个会话里从几号开始，帧里发 base + 序号
+
+    def __init__(self, path: str, cache_bytes: int = DEFAULT_CACHE_BYTES,
+                 chunk_size: int = CHUNK_SIZE):
+        self.path = path
+        self.meta = file_meta(path, chunk_size=chunk_size)
+        self.manifest = None
+        self.cache = ChunkCache(cache_bytes) if cache_bytes > 0 else None
+        self._digest_task = None
+        with open(path, "rb") as f:
+            # 空文件没法 mmap
+            self._map = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) if self.meta["size"] else None
+
+    @classmethod
+    def open(cls, path: str, with_manifest=True, cache_bytes: int = DEFAULT_CACHE_BYTES,
+             chunk_size: int = CHUNK_SIZE, cached=True):
+        """阻塞：要建清单时会把整个文件读一遍，放到线程里调
+
+        cached 时先查清单缓存（见 manifest.load_cached），文件没改过就不用读；
+        缓存里有的清单即使 with_manifest=False 也带上，反正不花时间。
+        """
+        src = cls(path, cache_bytes, chunk_size)
+        key = src.cache_key() if cached else None
+        src.manifest = manifest.load_cached(key) if key else None
+        if src.manifest is not None:
+            logger.info("Using cached chunk manifest for %s", path)
+        elif with_manifest:
+            src.manifest = src.build_manifest()
+            if key and src.cache_key() == key:  # 算的时候文件被改了就不存
+                manifest.save_cached(key, src.manifest)
+        if src.manifest is not None:
+            src.meta["sha256"] = src.manifest.sha256
+            src.meta["root"] = src.manifest.root
+        return src
+
+    def cache_key(self):
+        st = os.stat(self.path)
+        return ["file", st.st_dev, st.st_ino, st.st_size, st.st_mtime_ns, self.meta["chunk_size"]]
+
+    def build_manifest(self) -> Manifest:
+        return Manifest.build_parallel(self.view, self.meta["chunks"], self.meta["chunk_size"])
+
+    def sha256(self) -> str:
+        return file_sha256(self.path)
+
+    def view(self, index: int) -> memoryview:
+        """分片数据的零拷贝切片，用完尽快 release（或者 with 包起来）"""
+        if self._map is None:
+            return memoryview(b"")
+        cs = self.meta["chunk_size"]
+        start = index * cs
+        return memoryview(self._map)[start:start + cs]
+
+    def chunk_len(self, index: int) -> int:
+        cs = self.meta["chunk_size"]
+        return min(cs, self.meta["size"] - index * cs)
+
+    def frame(self, index: int, offset: int = 0, length: int = None, compressor=None) -> bytes:
+        """分片里 [offset, offset+length) 这一片的发送帧；从映射直接拷进帧里，只拷一次
+
+        给了 compressor 时会压缩（阻塞，放到 compress.workers() 里调）。
+        """
+        key = (index, offset, length, compressor and compressor.name)
+        if self.cache is not None:
+            cached = self.cache.get(key)
+            if cached is not None:
+                return cached
+        with self.view(index) as v:
+            end = len(v) if length is None else offset + length
+            with v[offset:end] as part:
+                if compressor is None:
+                    data = pack_frame(self.base + index, part, offset)
+                else:
+                    codec, payload = compressor.encode(part)
+                    data = pack_frame(self.base + index, payload, offset, codec)
+        if self.cache is not None:
+            self.cache.put(key, data)
+        return data
+
+    async def digest(self) -> str:
+        """整文件 sha256；没有清单时第一次调用起线程算，之后共用结果"""
+        if self.manifest is not None:
+            return self.manifest.sha256
+        if self._digest_task is None:
+            self._digest_task = asyncio.ensure_future(asyncio.to_thread(self.sha256))
+        return await self._digest_task
+
+    def close(self):
+        if self.cache is not None:
+            self.cache.clear()
+        if self._map is not None:
+            self._map.close()
@@ -0,0 +1,110 @@
+# stunmsg.py - STUN（RFC 5389）消息的编解码，只做 Binding 用得到的部分
+#
+# checkturn.py 用它探 STUN/TURN 服务器是否可达，rudp.py 用它在打洞用的 socket 上拿公网地址，
+# natprobe.py 用它并发探测 NAT 类型（还有它的本地 STUN 替身）。
+
+import socket
+import struct
+
+MAGIC_COOKIE = 0x2112A442
+HEADER = struct.Struct("!HHI12s")   # 类型, 属性总长, magic cookie, transaction id
+ATTR = struct.Struct("!HH")
+
+BINDING_REQUEST = 0x0001
+BINDING_RESPONSE = 0x0101
+BINDING_ERROR = 0x0111
+
+MAPPED_ADDRESS = 0x0001
+CHANGE_REQUEST = 0x0003
+XOR_MAPPED_ADDRESS = 0x0020
+OTHER_ADDRESS = 0x802C
+CHANGED_ADDRESS = 0x0005  # RFC 3489 里的名字，老服务器还在用
+
+DEFAULT_PORT = 3478
+
+
+def binding_request(tid: bytes, attrs: bytes = b"") -> bytes:
+    return HEADER.pack(BINDING_REQUEST, len(attrs), MAGIC_COOKIE, tid) + attrs
+
+
+def binding_response(tid: bytes, attrs: bytes = b"") -> bytes:
+    return HEADER.pack(BINDING_RESPONSE, len(attrs), MAGIC_COOKIE, tid) + attrs
+
+
+def address_attr(kind: int, ip: str, port: int) -> bytes:
+    """地址属性；XOR-MAPPED-ADDRESS 按规范和 magic cookie 异或"""
+    raw = socket.inet_aton(ip)
+    if kind == XOR_MAPPED_ADDRESS:
+        port ^= MAGIC_COOKIE >> 16
+        raw = bytes(b ^ m for b, m in zip(raw, struct.pack("!I", MAGIC_COOKIE)))
+    return attr(kind, struct.pack("!BBH", 0, 0x01, port) + raw)
+
+
+def attr(kind: int, value: bytes) -> bytes:
+    """一个属性，按 4 字节对齐补零"""
+    pad = -len(value) % 4
+    return ATTR.pack(kind, len(value)) + value + b"\0" * pad
+
+
+def is_stun(data) -> bool:
+    """STUN 消息开头两位是 0，第 4~8 字节是 magic cookie；用来和同一个 socket 上的其它包分开"""
+    return (len(data) >= HEADER.size and data[0] < 0x40
+            and struct.unpack_from("!I", data, 4)[0] == MAGIC_COOKIE)
+
+
+def parse(data):
+    """拆成 (类型, transaction id, {属性类型: 值})；不是 STUN 返回 None"""
+    if not is_stun(data):
+        return None
+    kind, length, _, tid = HEADER.unpack_from(data)
+    attrs = {}
+    i = HEADER.size
+    end = min(len(data), HEADER.size + length)
+    while i + ATTR.size <= end:
+        a, n = ATTR.unpack_from(data, i)
+        attrs.setdefault(a, bytes(data[i + ATTR.size:i + ATTR.size + n]))
+        i += ATTR.size + n + (-n % 4)
+    return kind, tid, attrs
+
+
+def _address(value, xor):
+    if len(value) < 8 or value[1] != 0x01:  # 只认 IPv4
+        return None
+    port, = struct.unpack_from("!H", value, 2)
+    ip = bytes(value[4:8])
+    if xor:
+        port ^= MAGIC_COOKIE >> 16
+        ip = bytes(b ^ m for b, m in zip(ip, struct.pack("!I", MAGIC_COOKIE)))
+    return socket.inet_ntoa(ip), port
+
+
+def mapped_address(data, tid=None):
+    """Binding 响应里的 (公网 IP, 端口)；tid 对不上或者没有地址返回 None"""
+    msg = parse(data)
+    if msg is None or msg[0] != BINDING_RESPONSE or (tid is not None and msg[1] != tid):
+        return None
+    attrs = msg[2]
+    if XOR_MAPPED_ADDRESS in attrs:
+        return _address(attrs[XOR_MAPPED_ADDRESS], True)
+    if MAPPED_ADDRESS in attrs:
+        return _address(attrs[MAPPED_ADDRESS], False)
+    return None
+
+
+def other_address(data):
+    """服务器的另一个 IP:端口（OTHER-ADDRESS / CHANGED-ADDRESS），没有返回 None"""
+    msg = parse(data)
+    if msg is None:
+        return None
+    for kind in (OTHER_ADDRESS, CHANGED_ADDRESS):
+        if kind in msg[2]:
+            return _address(msg[2][kind], False)
+    return None
+
+
+def parse_url(url: str):
+    """stun:host[:port]（也接受 turn:/不带前缀、带 ?transport=）-> (host, port)"""
+    rest = url.split(":", 1)[1] if url.startswith(("stun:", "turn:", "stuns:", "turns:")) else url
+    rest = rest.split("?", 1)[0]
+    host, _, port = rest.rpartition(":") if ":" in rest else (rest, "", "")
+    return host, int(port) if port else DEFAULT_PORT
@@ -0,0 +1,131 @@
+# swarm.py - 多发送端下载：接收端按各发送端的实际速度分配分片请求
+#
+# 每个发送端一条 PeerConnection，接收端用 need 消息主动拉分片（have 里带 pull）。
+# 分片到一个补一个，快的发送端自然拿到更多请求；窗口再按测到的速度放大。
+# 剩下的分片都已经派出去以后进入 endgame：空闲的发送端重复请求别人还没交付的分片，
+# 谁先到用谁，其余的发 cancel。
+
+import json
+import logging
+import time
+from collections import deque
+
+logger = logging.getLogger("fetch")
+
+MIN_WINDOW = 2
+MAX_WINDOW = 64
+WINDOW_SECONDS = 0.5  # 每个发送端保持大约 0.5 秒的数据在路上
+ENDGAME_COPIES = 2    # endgame 时一个分片最多同时向几个发送端要
+
+
+class SeederPeer:
+    def __init__(self, peer_id, channel, chunk_size):
+        self.peer_id = peer_id
+        self.channel = channel
+        self.chunk_size = chunk_size
+        self.inflight = set()
+        self.window = MIN_WINDOW * 2
+        self.rate = 0.0           # 字节/秒，指数平均
+        self.delivered = 0
+        self._sample_bytes = 0
+        self._sample_ts = time.monotonic()
+
+    def send(self, kind, chunks):
+        if chunks and self.channel.readyState == "open":
+            self.channel.send(json.dumps({"kind": kind, "chunks": chunks}))
+
+    def on_delivered(self, nbytes):
+        self.delivered += nbytes
+        self._sample_bytes += nbytes
+        now = time.monotonic()
+        dt = now - self._sample_ts
+        if dt >= 0.2:
+            sample = self._sample_bytes / dt
+            self.rate = sample if not self.rate else 0.7 * self.rate + 0.3 * sample
+            self._sample_bytes = 0
+            self._sample_ts = now
+            want = int(self.rate * WINDOW_SECONDS / self.chunk_size)
+            self.window = max(MIN_WINDOW, min(MAX_WINDOW, want))
+
+
+class Swarm:
+    def __init__(self, download):
+        self.download = download
+        self.peers = {}
+        self.unrequested = None
+
+    def _init_queue(self):
+        if self.unrequested is None:
+            self.unrequested = deque(self.download.received.missing())
+
+    def add(self, peer):
+        self._init_queue()
+        self.peers[peer.peer_id] = peer
+        logger.info("Seeder %s joined the swarm (%d seeders)", peer.peer_id, len(self.peers))
+        self.fill(peer)
+
+    def remove(self, peer_id):
+        peer = self.peers.pop(peer_id, None)
+        if peer is None:
+            return
+        # 它手上没交付的分片放回队首，别的发送端接着要
+        lost = [i for i in peer.inflight
+                if i not in self.download.received and not self._requested_elsewhere(i, peer)]
+        self.unrequested.extendleft(sorted(lost, reverse=True))
+        logger.info("Seeder %s left the swarm, %d chunks re-queued", peer_id, len(lost))
+        self.kick()
+
+    def _requested_elsewhere(self, index, peer):
+        return any(index in p.inflight for p in self.peers.values() if p is not peer)
+
+    def kick(self):
+        for peer in self.peers.values():
+            self.fill(peer)
+
+    def fill(self, peer):
+        """把 peer 的窗口补满：先拿没派出去的，拿完了就重复别人在途的（endgame）"""
+        if self.download.paused:
+            return  # 写盘跟不上，等恢复后 kick
+        want = peer.window - len(peer.inflight)
+        batch = []
+        while want > 0 and self.unrequested:
+            index = self.unrequested.popleft()
+            if index in self.download.received:
+                continue
+            batch.append(index)
+            want -= 1
+        if want > 0 and not self.unrequested:
+            for other in self.peers.values():
+                if other is peer:
+                    continue
+                for index in sorted(other.inflight):
+                    if want <= 0:
+                        break
+                    if index in peer.inflight or index in batch:
+                        continue
+                    copies = sum(1 for p in self.peers.values() if index in p.inflight)
+                    if copies < ENDGAME_COPIES:
+                        batch.append(index)
+                        want -= 1
+        peer.inflight.update(batch)
+        peer.send("need", batch)
+
+    def on_chunk(self, peer_id, index, status, nbytes):
+        peer = self.peers.get(peer_id)
+        if peer is None:
+            return
+        peer.inflight.discard(index)
+        if status == "ok":
+            peer.on_delivered(nbytes)
+            # endgame 里别人也在发这个分片，让它们别发了
+            for other in self.peers.values():
+                if other is not peer and index in other.inflight:
+                    other.inflight.discard(index)
+                    other.send("cancel", [index])
+                    self.fill(other)
+        elif status in ("bad", "busy") and not self._requested_elsewhere(index, peer):
+            self.unrequested.appendleft(index)
+        self.fill(peer)
+
+    def stats(self):
+        return {pid: (p.delivered, p.rate) for pid, p in self.peers.items()}
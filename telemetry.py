@@ -0,0 +1,237 @@
+# telemetry.py - 传输过程的采样：固定间隔记一次吞吐、缓冲、卡顿、写盘延迟等，写成 JSON lines，结束时打汇总
+#
+# 每个被跟踪的会话（发送端的一个接收端 / 接收端的一次下载）注册一组探针（返回数值的函数），
+# 采样协程每隔 interval 秒调一遍；累计量（字节数、卡顿秒数）记成这一段的增量/速率。
+# 热路径上只做累加，采样频率和传输速度无关。
+#
+# 进度行也在这里限频：以前每个分片刷一次，大文件高速传输时光打印就要占不少 CPU。
+
+import asyncio
+import json
+import logging
+import sys
+import time
+
+from common import human
+
+logger = logging.getLogger("telemetry")
+
+DEFAULT_INTERVAL = 1.0
+PROGRESS_INTERVAL = 0.5
+
+
+def candidate_pair(pc):
+    """选中的 ICE 候选对类型，比如 host->srflx、relay->host；拿不到返回 None
+
+    aiortc 没有公开这个，从 aioice 的连接里取；rudp.Connection 自己记着。
+    """
+    if getattr(pc, "pair", None):
+        return pc.pair
+    try:
+        ice = pc.sctp.transport.transport
+        pair = ice._connection._nominated.get(1)
+        return f"{pair.local_candidate.type}->{pair.remote_candidate.type}"
+    except AttributeError:
+        return None
+
+
+def percentile(sorted_values, p):
+    if not sorted_values:
+        return None
+    k = min(len(sorted_values) - 1, int(round(p / 100 * (len(sorted_values) - 1))))
+    return sorted_values[k]
+
+
+class Session:
+    """一个被跟踪的会话：gauges 取当前值，counters 是累计量（采样时算增量和速率）"""
+
+    def __init__(self, name, gauges, counters, info):
+        self.name = name
+        self.gauges = gauges
+        self.counters = counters
+        self.info = info           # 不常变的信息（比如候选对类型），变了才记
+        self.start = time.monotonic()
+        self.last = {k: fn() for k, fn in counters.items()}
+        self.last_ts = self.start
+        self.first = dict(self.last)
+        self.peaks = {}            # 速率的峰值
+        self.gauge_stats = {}      # gauge -> [最小, 总和, 最大, 次数]
+        self.seen_info = {}
+        self.latencies = []        # 接收端写盘延迟，汇总时取分位数
+
+    def sample(self, now):
+        rec = {"t": round(now - self.start, 3), "session": self.name}
+        dt = max(now - self.last_ts, 1e-6)
+        for k, fn in self.counters.items():
+            value = fn()
+            delta = value - self.last[k]
+            self.last[k] = value
+            rec[k] = round(value, 3) if isinstance(value, float) else value
+            rec[k + "_rate"] = round(delta / dt, 3)
+            self.peaks[k] = max(self.peaks.get(k, 0), delta / dt)
+        for k, fn in self.gauges.items():
+            value = fn()
+            if value is None:
+                continue
+            if isinstance(value, list):
+                # 一段时间里的多个观测值（写盘延迟），记最大和平均
+                self.latencies.extend(value)
+                if value:
+                    rec[k + "_max"] = round(max(value), 6)
+                    rec[k + "_avg"] = round(sum(value) / len(value), 6)
+                continue
+            rec[k] = value
+            s = self.gauge_stats.setdefault(k, [value, 0, value, 0])
+            s[0] = min(s[0], value)
+            s[1] += value
+            s[2] = max(s[2], value)
+            s[3] += 1
+        for k, fn in self.info.items():
+            value = fn()
+            if value is not None and self.seen_info.get(k) != value:
+                self.seen_info[k] = value
+                rec[k] = value
+        self.last_ts = now
+        return rec
+
+    def summary(self, now):
+        elapsed = now - self.start
+        out = {"session": self.name, "event": "summary", "seconds": round(elapsed, 3)}
+        for k in self.counters:
+            total = self.last[k] - self.first[k]
+            out[k] = round(total, 3) if isinstance(total, float) else total
+            out[k + "_avg_rate"] = round(total / max(elapsed, 1e-6), 3)
+            out[k + "_peak_rate"] = round(self.peaks.get(k, 0), 3)
+        for k, (lo, total, hi, n) in self.gauge_stats.items():
+            out[k] = {"min": lo, "avg": round(total / n, 3), "max": hi}
+        if self.latencies:
+            lat = sorted(self.latencies)
+            out["write_latency"] = {f"p{p}": round(percentile(lat, p), 6) for p in (50, 90, 99)}
+            out["write_latency"]["max"] = round(lat[-1], 6)
+        out.update(self.seen_info)
+        return out
+
+
+class Telemetry:
+    """整个进程一个：定时采样所有会话，写 trace 文件"""
+
+    def __init__(self, path=None, interval=DEFAULT_INTERVAL):
+        self.interval = interval
+        self.file = open(path, "w") if path else None
+        self.sessions = {}
+        self._task = None
+
+    def track(self, name, gauges=None, counters=None, info=None):
+        self.sessions[name] = Session(name, gauges or {}, counters or {}, info or {})
+        if self._task is None:
+            self._task = asyncio.ensure_future(self._loop())
+
+    def finish(self, name):
+        """会话结束：最后采一次，写汇总、打日志，返回汇总"""
+        session = self.sessions.pop(name, None)
+        if session is None:
+            return None
+        now = time.monotonic()
+        self._write(session.sample(now))
+        summary = session.summary(now)
+        self._write(summary)
+        log_summary(summary)
+        return summary
+
+    def event(self, name, kind, **fields):
+        """记一个时间点（比如收到第一个字节），带墙上时间，方便和别的进程对时"""
+        session = self.sessions.get(name)
+        t = time.monotonic() - session.start if session else None
+        self._write({"t": t and round(t, 3), "session": name, "event": kind, "wall": time.time(),
+                     **fields})
+
+    async def _loop(self):
+        while True:
+            await asyncio.sleep(self.interval)
+            now = time.monotonic()
+            for session in list(self.sessions.values()):
+                self._write(session.sample(now))
+
+    def _write(self, rec):
+        if self.file is not None:
+            self.file.write(json.dumps(rec, separators=(",", ":")) + "\n")
+            self.file.flush()
+
+    def close(self):
+        for name in list(self.sessions):
+            self.finish(name)
+        if self._task is not None:
+            self._task.cancel()
+        if self.file is not None:
+            self.file.close()
+
+
+def log_summary(s):
+    parts = [f"{s['seconds']:.1f}s"]
+    for k in ("bytes", "wire_bytes"):
+        if k in s:
+            parts.append(f"{k.replace('_', ' ')} {human(s[k])} "
+                         f"(avg {human(s[k + '_avg_rate'])}/s, peak {human(s[k + '_peak_rate'])}/s)")
+    if "stall_seconds" in s:
+        parts.append(f"stalled {s['stall_seconds']:.2f}s "
+                     f"({s['stall_seconds'] / max(s['seconds'], 1e-6) * 100:.0f}%)")
+    if "paused_seconds" in s:
+        parts.append(f"paused {s['paused_seconds']:.2f}s")
+    if "buffered" in s:
+        parts.append(f"buffered avg {human(s['buffered']['avg'])}, max {human(s['buffered']['max'])}")
+    if "write_latency" in s:
+        w = s["write_latency"]
+        parts.append(f"write latency p50 {w['p50'] * 1000:.1f}ms, p99 {w['p99'] * 1000:.1f}ms")
+    if "ice_pair" in s:
+        parts.append(f"ICE {s['ice_pair']}")
+    logger.info("Summary %s: %s", s["session"], "; ".join(parts))
+
+
+class Phases:
+    """连接建立各阶段的时间点：mark(name) 记下离开始过了多久（同名只记第一次），report() 打一行
+
+    每个阶段也作为 event 写进 trace，since_start 是秒数。
+    """
+
+    def __init__(self, telemetry, session):
+        self.telemetry = telemetry
+        self.session = session
+        self.start = time.monotonic()
+        self.marks = {}
+        self.reported = False
+
+    def mark(self, name):
+        if name in self.marks:
+            return
+        t = time.monotonic() - self.start
+        self.marks[name] = t
+        self.telemetry.event(self.session, name, since_start=round(t, 4))
+
+    def report(self):
+        if self.reported or not self.marks:
+            return
+        self.reported = True
+        parts = []
+        prev = 0.0
+        for name, t in sorted(self.marks.items(), key=lambda kv: kv[1]):
+            parts.append(f"{name} +{(t - prev) * 1000:.0f}ms")
+            prev = t
+        logger.info("Setup %s: %s (%.0fms total)", self.session, ", ".join(parts), prev * 1000)
+
+
+class Progress:
+    """进度行限频：最多每 PROGRESS_INTERVAL 秒刷一次，最后一次（done=True）一定刷"""
+
+    def __init__(self, quiet=False):
+        self.quiet = quiet
+        self._last = 0.0
+
+    def update(self, text, done=False):
+        if self.quiet:
+            return
+        now = time.monotonic()
+        if not done and now - self._last < PROGRESS_INTERVAL:
+            return
+        self._last = now
+        sys.stdout.write("\r" + text)
+        sys.stdout.flush()
@@ -0,0 +1,80 @@
+import hashlib
+import os
+
+from cas import ChunkStore
+
+CHUNK = 1000
+
+
+def _leaf(data):
+    return hashlib.sha256(data).digest()
+
+
+def _download(n):
+    data = b"".join(bytes([i]) * CHUNK for i in range(n))
+    leaves = [_leaf(data[i * CHUNK:(i + 1) * CHUNK]) for i in range(n)]
+    return data, leaves, lambda off, size: data[off:off + size]
+
+
+def test_put_get(tmp_path):
+    store = ChunkStore(str(tmp_path))
+    data = b"hello" * 100
+    assert store.put(_leaf(data), data)
+    assert not store.put(_leaf(data), data)
+    assert _leaf(data) in store
+    assert store.get(_leaf(data)) == data
+    assert store.get(_leaf(b"missing")) is None
+
+
+def test_corrupt_object_removed(tmp_path):
+    store = ChunkStore(str(tmp_path))
+    data = b"x" * CHUNK
+    store.put(_leaf(data), data)
+    with open(store.path_of(_leaf(data)), "wb") as f:
+        f.write(b"y" * CHUNK)
+    assert store.get(_leaf(data)) is None
+    assert _leaf(data) not in store
+    assert store.size == 0
+
+
+def test_ingest_never_over_cap(tmp_path):
+    # 上限 5 片，仓库里先有 4 片旧的；收 3 片时边收边删，不会先涨到 7 片再删
+    store = ChunkStore(str(tmp_path), cap=5 * CHUNK)
+    old = [bytes([100 + i]) * CHUNK for i in range(4)]
+    for d in old:
+        store.put(_leaf(d), d)
+    sizes = []
+    put = store.put
+    store.put = lambda leaf, d: (put(leaf, d), sizes.append(store.size))[0]
+    _, leaves, read_at = _download(3)
+    assert store.ingest(read_at, leaves, CHUNK) == 3
+    assert max(sizes) <= store.cap
+    assert all(leaf in store for leaf in leaves)
+    assert _leaf(old[0]) not in store and _leaf(old[1]) not in store
+    assert _leaf(old[2]) in store
+
+
+def test_ingest_stops_instead_of_evicting_itself(tmp_path):
+    store = ChunkStore(str(tmp_path), cap=3 * CHUNK)
+    _, leaves, read_at = _download(5)
+    assert store.ingest(read_at, leaves, CHUNK) == 3
+    assert [leaf in store for leaf in leaves] == [True, True, True, False, False]
+    assert store.size == 3 * CHUNK
+
+
+def test_lru_order_and_rescan(tmp_path):
+    store = ChunkStore(str(tmp_path), cap=3 * CHUNK)
+    chunks = [bytes([i]) * CHUNK for i in range(3)]
+    for i, d in enumerate(chunks):
+        store.put(_leaf(d), d)
+        t = 1_000_000 + i
+        os.utime(store.path_of(_leaf(d)), (t, t))
+    # 重新打开按 mtime 排；get 过的算最近用过
+    store = ChunkStore(str(tmp_path), cap=3 * CHUNK)
+    assert len(store) == 3 and store.size == 3 * CHUNK
+    assert store.get(_leaf(chunks[0])) == chunks[0]
+    new = b"n" * CHUNK
+    assert store.evict(CHUNK) == 1
+    store.put(_leaf(new), new)
+    assert _leaf(chunks[1]) not in store
+    assert _leaf(chunks[0]) in store and _leaf(chunks[2]) in store
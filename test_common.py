@@ -0,0 +1,84 @@
+import hashlib
+
+from common import (DEFAULT_MAX_MESSAGE, FRAME_HDR, ChunkBitmap, OrderedHasher, max_message_size, pack_frame,
+                    piece_limit, unpack_frame)
+
+
+def _chunks(n=6, size=1000):
+    return [bytes([i]) * size for i in range(n)]
+
+
+def test_ordered_hasher_in_order():
+    chunks = _chunks()
+    h = OrderedHasher(lambda i: chunks[i])
+    for i, c in enumerate(chunks):
+        h.feed(i, c)
+    assert h.hexdigest() == hashlib.sha256(b"".join(chunks)).hexdigest()
+
+
+def test_ordered_hasher_out_of_order_reads_back():
+    chunks = _chunks()
+    h = OrderedHasher(lambda i: chunks[i])
+    for i in (1, 2, 0, 4, 5, 3):
+        h.feed(i, chunks[i])
+    assert h.next_index == len(chunks)
+    assert h.hexdigest() == hashlib.sha256(b"".join(chunks)).hexdigest()
+
+
+def test_ordered_hasher_ignores_resent_chunks():
+    # 没有清单时发送端边发边算：接收端写缓冲满丢掉、再用 need 要回来的分片会排到后面再发一次
+    chunks = _chunks()
+    h = OrderedHasher(lambda i: chunks[i])
+    for i in (0, 1, 2, 3, 4, 5, 2, 4):
+        h.feed(i, chunks[i])
+    assert h.hexdigest() == hashlib.sha256(b"".join(chunks)).hexdigest()
+
+
+def test_frame_round_trip():
+    frame = pack_frame(7, b"payload", 4096, 2)
+    assert len(frame) == FRAME_HDR.size + 7
+    index, offset, codec, data = unpack_frame(frame)
+    assert (index, offset, codec, bytes(data)) == (7, 4096, 2, b"payload")
+
+
+def test_frame_defaults():
+    assert unpack_frame(pack_frame(0, b""))[:3] == (0, 0, 0)
+
+
+def test_max_message_size():
+    assert max_message_size("v=0\r\na=max-message-size:65536\r\n") == 65536
+    assert piece_limit(65536) == 65536 - FRAME_HDR.size
+    assert max_message_size("v=0\r\n") == DEFAULT_MAX_MESSAGE
+    # 0 表示不限，按最大分片算
+    assert max_message_size("a=max-message-size:0\n") > 65536
+
+
+def test_bitmap_add_missing_encode():
+    b = ChunkBitmap(10)
+    for i in (0, 3, 9, 3):
+        b.add(i)
+    assert b.count == 3 and not b.complete()
+    assert b.missing() == [1, 2, 4, 5, 6, 7, 8]
+    c = ChunkBitmap.decode(10, b.encode())
+    assert [i for i in range(10) if i in c] == [0, 3, 9]
+    assert c.count == 3
+    c.discard(3)
+    c.discard(4)
+    assert c.missing() == [1, 2, 3, 4, 5, 6, 7, 8] and c.count == 2
+
+
+def test_bitmap_sidecar_needs_same_layout(tmp_path):
+    meta = {"name": "f", "size": 10000, "chunk_size": 1000, "chunks": 10}
+    path = str(tmp_path / "f.chunks")
+    b = ChunkBitmap(10)
+    b.add(4)
+    b.save(path, meta)
+    assert ChunkBitmap.load(path, meta).missing() == [i for i in range(10) if i != 4]
+    assert ChunkBitmap.load(path, dict(meta, size=10001)) is None
+    # 布局一样、内容换了
+    meta = dict(meta, sha256="a" * 64, root="b" * 64)
+    b.save(path, meta)
+    assert ChunkBitmap.load(path, meta) is not None
+    assert ChunkBitmap.load(path, dict(meta, sha256="c" * 64)) is None
+    assert ChunkBitmap.load(path, dict(meta, root="c" * 64)) is None
+    assert ChunkBitmap.load(str(tmp_path / "none"), meta) is None
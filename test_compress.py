@@ -0,0 +1,54 @@
+import os
+import zlib
+
+import pytest
+
+import compress
+
+ZLIB = compress.CODEC_IDS["zlib"]
+
+
+def test_round_trip():
+    c = compress.Compressor("zlib")
+    data = b"abcd" * 10000
+    codec, payload = c.encode(data)
+    assert codec == ZLIB
+    assert len(payload) < len(data)
+    assert compress.decompress(codec, payload, len(data)) == data
+
+
+def test_incompressible_sent_raw():
+    c = compress.Compressor("zlib")
+    data = os.urandom(64 * 1024)
+    assert c.encode(data) == (compress.RAW, data)
+
+
+def test_exact_limit_ok():
+    data = b"x" * 4096
+    assert compress.decompress(ZLIB, zlib.compress(data), 4096) == data
+
+
+def test_bomb_rejected():
+    # 几十 KB 的帧解出来 64MB，只允许解到分片末尾
+    bomb = zlib.compress(b"\0" * (64 * 1024 * 1024), 9)
+    with pytest.raises(ValueError):
+        compress.decompress(ZLIB, bomb, 128 * 1024)
+
+
+def test_truncated_rejected():
+    payload = zlib.compress(os.urandom(1000))
+    with pytest.raises(ValueError):
+        compress.decompress(ZLIB, payload[:-10], 1000)
+
+
+def test_unknown_codec():
+    with pytest.raises(ValueError):
+        compress.decompress(99, b"", 10)
+
+
+@pytest.mark.parametrize("offset", [128 * 1024, 128 * 1024 + 1])
+def test_frame_at_chunk_end_rejected(offset):
+    # 偏移到了分片末尾，limit 是 0 或负数；zlib 的 max_length=0 是不限，不能交给它
+    bomb = zlib.compress(b"\0" * (8 * 1024 * 1024), 9)
+    with pytest.raises(ValueError):
+        compress.decompress(ZLIB, bomb, 128 * 1024 - offset)
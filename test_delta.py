@@ -0,0 +1,72 @@
+import os
+
+import pytest
+
+import delta
+from common import unpack_frame
+
+BLOCK = 2048
+
+
+def _setup(tmp_path, old: bytes):
+    path = tmp_path / "old.bin"
+    path.write_bytes(old)
+    sigs = delta.signatures(str(path), BLOCK)
+    index = delta.BlockIndex(BLOCK, [p["data"] for p in delta.encode_signatures(sigs)])
+    return delta.Basis(str(path), BLOCK), index
+
+
+def _decode(basis, frames, size):
+    out = bytearray(size)
+    for frame in frames:
+        _, offset, codec, payload = unpack_frame(frame)
+        assert codec == delta.DELTA
+        data = basis.apply(payload, size - offset)
+        out[offset:offset + len(data)] = data
+    return bytes(out)
+
+
+def test_match_unchanged_is_one_copy(tmp_path):
+    old = os.urandom(BLOCK * 16)
+    _, index = _setup(tmp_path, old)
+    assert index.match(old) == [("copy", 0, 16)]
+
+
+def test_round_trip_with_insert_and_edit(tmp_path):
+    old = os.urandom(BLOCK * 32)
+    new = old[:5000] + b"inserted" + old[5000:20000] + os.urandom(300) + old[20300:]
+    basis, index = _setup(tmp_path, old)
+    frames = index.frames(0, new, 16 * 1024)
+    assert frames is not None
+    assert sum(len(f) for f in frames) < len(new) // 2
+    assert _decode(basis, frames, len(new)) == new
+    basis.close()
+
+
+def test_unrelated_data_not_sent_as_delta(tmp_path):
+    _, index = _setup(tmp_path, os.urandom(BLOCK * 8))
+    assert index.frames(0, os.urandom(BLOCK * 8), 16 * 1024) is None
+
+
+def test_apply_rejects_bad_ops(tmp_path):
+    basis, _ = _setup(tmp_path, os.urandom(BLOCK * 4))
+    with pytest.raises(ValueError):
+        basis.apply(delta.OP_COPY.pack(0, 3, 2), BLOCK * 8)      # 超出旧文件
+    with pytest.raises(ValueError):
+        basis.apply(b"\x07", BLOCK)                              # 不认识的操作
+    with pytest.raises(ValueError):
+        basis.apply(delta.OP_COPY.pack(0, 0, 1)[:4], BLOCK)      # 操作被截断
+    with pytest.raises(ValueError):
+        basis.apply(delta.OP_LIT.pack(1, 100) + b"x" * 10, BLOCK)  # 字面数据不够
+    basis.close()
+
+
+def test_apply_stops_at_chunk_end(tmp_path):
+    basis, _ = _setup(tmp_path, os.urandom(BLOCK * 4))
+    ops = delta.OP_COPY.pack(0, 0, 4) * 1000   # 一帧引用几千个块，远超分片
+    with pytest.raises(ValueError):
+        basis.apply(ops, 128 * 1024)
+    assert len(basis.apply(delta.OP_COPY.pack(0, 0, 4), BLOCK * 4)) == BLOCK * 4
+    with pytest.raises(ValueError):
+        basis.apply(delta.OP_LIT.pack(1, 0), 0)  # 帧偏移在分片末尾
+    basis.close()
@@ -0,0 +1,109 @@
+import asyncio
+import hashlib
+import os
+
+from common import ChunkBitmap
+from download import PART_SUFFIX, Download
+from manifest import Manifest
+
+CHUNK = 4096
+
+
+def _meta(data, name, sha256=None, root=False):
+    chunks = (len(data) + CHUNK - 1) // CHUNK
+    meta = {"name": name, "size": len(data), "chunk_size": CHUNK, "chunks": chunks,
+            "sha256": sha256 or hashlib.sha256(data).hexdigest()}
+    if root:
+        leaves = [hashlib.sha256(data[i * CHUNK:(i + 1) * CHUNK]).digest() for i in range(chunks)]
+        meta["root"] = Manifest(CHUNK, leaves).root
+    return meta
+
+
+async def _receive(dl, data, order):
+    assert dl.ready()
+    for i in order:
+        assert dl.accept(i, data[i * CHUNK:(i + 1) * CHUNK]) == "queued"
+    while not dl.received.complete():
+        await asyncio.sleep(0.01)
+    return await dl.finish()
+
+
+def test_receive_out_of_order(tmp_path):
+    data = os.urandom(CHUNK * 5 + 100)
+    out = str(tmp_path / "f.bin")
+    dl = Download(out, quiet=True)
+    dl.start(_meta(data, "f.bin"))
+    assert asyncio.run(_receive(dl, data, [2, 0, 5, 1, 4, 3]))
+    with open(out, "rb") as f:
+        assert f.read() == data
+    assert not os.path.exists(out + PART_SUFFIX)
+    assert not os.path.exists(out + ".chunks")
+
+
+def test_mismatch_keeps_part_and_sidecar(tmp_path):
+    data = os.urandom(CHUNK * 3)
+    out = str(tmp_path / "f.bin")
+    dl = Download(out, quiet=True)
+    dl.start(_meta(data, "f.bin", sha256="0" * 64))
+    assert not asyncio.run(_receive(dl, data, range(3)))
+    assert not os.path.exists(out)
+    assert os.path.exists(out + PART_SUFFIX)
+    assert os.path.exists(out + ".chunks")
+
+
+def test_resume_from_sidecar(tmp_path):
+    data = os.urandom(CHUNK * 4)
+    out = str(tmp_path / "f.bin")
+    meta = _meta(data, "f.bin", root=True)
+    with open(out + PART_SUFFIX, "wb") as f:
+        f.write(data[:CHUNK * 2] + bytes(CHUNK * 2))
+    bitmap = ChunkBitmap(4)
+    bitmap.add(0)
+    bitmap.add(1)
+    bitmap.save(out + ".chunks", meta)
+
+    dl = Download(out, quiet=True)
+    dl.start(meta)
+    assert dl.received.missing() == [2, 3]
+    assert dl.resumed_size == CHUNK * 2
+    dl.leaves = [hashlib.sha256(data[i * CHUNK:(i + 1) * CHUNK]).digest() for i in range(4)]
+    assert asyncio.run(_receive(dl, data, [3, 2]))
+    with open(out, "rb") as f:
+        assert f.read() == data
+
+
+def test_sidecar_for_other_layout_not_resumed(tmp_path):
+    data = os.urandom(CHUNK * 4)
+    out = str(tmp_path / "f.bin")
+    open(out + PART_SUFFIX, "wb").close()
+    ChunkBitmap(4).save(out + ".chunks", _meta(data, "f.bin"))
+    other = dict(_meta(data, "f.bin"), chunk_size=CHUNK * 2, chunks=2)
+    assert Download(out).pick_output(other) == (out, None)
+
+
+def test_resumed_chunks_checked_against_manifest(tmp_path):
+    # .part 里是旧内容（或者被改坏了），sidecar 却说前两片已经有了：按清单重新校验，对不上的重新要
+    old, new = os.urandom(CHUNK * 4), os.urandom(CHUNK * 4)
+    out = str(tmp_path / "f.bin")
+    meta = _meta(new, "f.bin", root=True)
+    with open(out + PART_SUFFIX, "wb") as f:
+        f.write(new[:CHUNK] + old[CHUNK:])
+    bitmap = ChunkBitmap(4)
+    bitmap.add(0)
+    bitmap.add(1)
+    bitmap.save(out + ".chunks", meta)
+
+    dl = Download(out, quiet=True)
+    dl.start(meta)
+    dl.leaves = [hashlib.sha256(new[i * CHUNK:(i + 1) * CHUNK]).digest() for i in range(4)]
+
+    async def main():
+        assert dl.ready()
+        assert dl.received.missing() == [1, 2, 3]
+        assert dl.resumed_size == CHUNK
+        assert ChunkBitmap.load(out + ".chunks", meta).missing() == [1, 2, 3]
+        return await _receive(dl, new, [3, 1, 2])
+
+    assert asyncio.run(main())
+    with open(out, "rb") as f:
+        assert f.read() == new
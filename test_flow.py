@@ -0,0 +1,123 @@
+from collections import Counter
+
+import pytest
+from pyee import EventEmitter
+
+import flow
+from common import MIN_PIECE
+from flow import GAIN, MAX_WINDOW, MIN_WINDOW, FlowControl, PieceSizer, WindowedFilter
+
+
+class FakeChannel(EventEmitter):
+    readyState = "open"
+    bufferedAmount = 0
+    bufferedAmountLowThreshold = 0
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    now = [1000.0]
+    monkeypatch.setattr(flow.time, "monotonic", lambda: now[0])
+    return now
+
+
+def test_windowed_filter_expires_old_samples():
+    f = WindowedFilter(lambda old, new: old > new)
+    f.update(5, now=0)
+    f.update(3, now=1)
+    assert f.value == 5
+    f.update(4, now=flow.FILTER_SECONDS + 0.5)  # 5 过期了，3 也被更大的 4 挤掉
+    assert f.value == 4
+
+
+def test_window_is_rate_times_rtt(clock):
+    chs = [FakeChannel(), FakeChannel()]
+    fc = FlowControl(chs)
+    fc.max_rate.update(4 * 1024 * 1024)   # 4MB/s
+    fc.min_rtt.update(0.1)
+    fc._update_window()
+    assert fc.window == int(4 * 1024 * 1024 * 0.1 * GAIN)
+    # 每条通道的低水位是它那份窗口的一半
+    assert all(ch.bufferedAmountLowThreshold == fc.window // 2 // 2 for ch in chs)
+
+
+@pytest.mark.parametrize("rate,rtt,expect", [
+    (1024, 0.01, MIN_WINDOW),                  # TURN 中继之类的慢路径
+    (1024 * 1024 * 1024, 0.2, MAX_WINDOW),
+])
+def test_window_clamped(clock, rate, rtt, expect):
+    fc = FlowControl([FakeChannel()])
+    fc.max_rate.update(rate)
+    fc.min_rtt.update(rtt)
+    fc._update_window()
+    assert fc.window == expect
+
+
+def test_fixed_window_not_adapted(clock):
+    fc = FlowControl([FakeChannel()], fixed_window=300 * 1024)
+    fc.max_rate.update(100 * 1024 * 1024)
+    fc._update_window()
+    assert fc.window == 300 * 1024
+
+
+def test_rate_sampled_from_drained_bytes(clock):
+    ch = FakeChannel()
+    fc = FlowControl([ch])
+    ch.bufferedAmount = 200 * 1024
+    clock[0] += 0.5
+    fc.sent(1024 * 1024)   # 0.5 秒里交出去 1MB，还有 200KB 在缓冲里
+    assert fc.max_rate.value == pytest.approx((1024 - 200) * 1024 / 0.5)
+
+
+def test_pong_rtt_discounts_queued_bytes(clock):
+    ch = FakeChannel()
+    fc = FlowControl([ch])
+    fc.max_rate.update(1024 * 1024)
+    ch.bufferedAmount = 100 * 1024       # ping 前面排着 100KB，按 1MB/s 要 ~0.1 秒
+    ping = fc.ping()
+    clock[0] += 0.15
+    fc.on_pong({"seq": ping["seq"]})
+    assert fc.min_rtt.value == pytest.approx(0.15 - 100 / 1024)
+    fc.on_pong({"seq": ping["seq"]})     # 重复的 pong 不算
+    assert fc.min_rtt.value == pytest.approx(0.15 - 100 / 1024)
+
+
+class FakeFlow:
+    def __init__(self):
+        self.bytes = 0
+
+    def drained(self):
+        return self.bytes
+
+
+def _climb(clock, limit, rate_of, epochs=60):
+    f = FakeFlow()
+    sizer = PieceSizer(f, limit)
+    sizes = []
+    for _ in range(epochs):
+        size = sizer.current()
+        sizes.append(size)
+        clock[0] += flow.PIECE_EPOCH
+        f.bytes += int(rate_of(size) * flow.PIECE_EPOCH)
+    return sizes
+
+
+def test_piece_sizer_finds_best_size_within_limit(clock):
+    limit = 256 * 1024
+    best = 32 * 1024
+    # 吞吐在 32KB 最高，离得越远越低
+    sizes = _climb(clock, limit, lambda s: 10e6 / (1 + abs((s.bit_length() - best.bit_length()))))
+    assert all(MIN_PIECE <= s <= limit for s in sizes)
+    assert Counter(sizes[-30:]).most_common(1)[0][0] == best
+
+
+def test_piece_sizer_prefers_large_when_flat(clock):
+    limit = 128 * 1024
+    sizes = _climb(clock, limit, lambda s: 10e6)
+    assert all(MIN_PIECE <= s <= limit for s in sizes)
+    assert Counter(sizes).most_common(1)[0][0] == limit
+
+
+def test_piece_sizer_limit_below_min_piece(clock):
+    sizes = _climb(clock, 8 * 1024, lambda s: s * 100.0)
+    assert set(sizes) == {8 * 1024}
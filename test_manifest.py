@@ -0,0 +1,90 @@
+import hashlib
+import os
+
+import pytest
+
+import manifest
+from manifest import Manifest, decode_hashes, load_cached, merkle_root, save_cached
+
+CHUNK = 1024
+
+
+def _h(x):
+    return hashlib.sha256(x).digest()
+
+
+@pytest.fixture
+def sample(tmp_path):
+    data = os.urandom(CHUNK * 9 + 100)
+    path = tmp_path / "f.bin"
+    path.write_bytes(data)
+    return str(path), data
+
+
+def test_merkle_root_shapes():
+    a, b, c = _h(b"a"), _h(b"b"), _h(b"c")
+    assert merkle_root([]) == hashlib.sha256(b"").hexdigest()
+    assert merkle_root([a]) == a.hex()
+    assert merkle_root([a, b]) == _h(a + b).hex()
+    # 奇数个：最后一个直接升上去
+    assert merkle_root([a, b, c]) == _h(_h(a + b) + c).hex()
+
+
+def test_build_and_verify(sample):
+    path, data = sample
+    m = Manifest.build(path, CHUNK)
+    assert len(m) == 10
+    assert m.sha256 == hashlib.sha256(data).hexdigest()
+    assert m.verify(9, data[CHUNK * 9:])
+    assert not m.verify(0, data[CHUNK:CHUNK * 2])
+
+
+def test_messages_round_trip(sample):
+    path, _ = sample
+    m = Manifest.build(path, CHUNK)
+    leaves = []
+    for msg in m.messages(batch=3):
+        assert msg["start"] == len(leaves)
+        leaves.extend(decode_hashes(msg["hashes"]))
+    assert Manifest(CHUNK, leaves).root == m.root
+
+
+def test_build_parallel_matches_build(sample, monkeypatch):
+    path, data = sample
+    monkeypatch.setattr(manifest, "REGION_CHUNKS", 3)  # 10 个分片分成好几段
+    m = Manifest.build_parallel(lambda i: data[i * CHUNK:(i + 1) * CHUNK], 10, CHUNK, workers=2)
+    ref = Manifest.build(path, CHUNK)
+    assert (m.leaves, m.sha256, m.root) == (ref.leaves, ref.sha256, ref.root)
+
+
+def test_cache_round_trip(sample, tmp_path, monkeypatch):
+    monkeypatch.setattr(manifest, "CACHE_DIR", str(tmp_path / "cache"))
+    path, _ = sample
+    m = Manifest.build(path, CHUNK)
+    key = [1, 2, os.path.getsize(path), 123]
+    assert load_cached(key) is None
+    save_cached(key, m)
+    got = load_cached(key)
+    assert (got.leaves, got.sha256, got.root, got.chunk_size) == (m.leaves, m.sha256, m.root, CHUNK)
+    assert load_cached(key[:3] + [124]) is None
+
+
+def test_cache_truncated_ignored(sample, tmp_path, monkeypatch):
+    monkeypatch.setattr(manifest, "CACHE_DIR", str(tmp_path / "cache"))
+    path, _ = sample
+    key = ["k"]
+    save_cached(key, Manifest.build(path, CHUNK))
+    cached = manifest._cache_path(key)
+    with open(cached, "r+b") as f:
+        f.truncate(os.path.getsize(cached) - 1)
+    assert load_cached(key) is None
+
+
+def test_cache_trimmed(sample, tmp_path, monkeypatch):
+    monkeypatch.setattr(manifest, "CACHE_DIR", str(tmp_path / "cache"))
+    monkeypatch.setattr(manifest, "CACHE_ENTRIES", 2)
+    path, _ = sample
+    m = Manifest.build(path, CHUNK)
+    for k in range(4):
+        save_cached([k], m)
+    assert len(os.listdir(manifest.CACHE_DIR)) == 2
@@ -0,0 +1,116 @@
+import asyncio
+import socket
+import time
+
+import pytest
+
+import natprobe
+from natprobe import StubServer, choose_stun, classify, load_cached, probe, save
+
+
+async def _stubs(*shifts, alt=False):
+    """本机起几个 STUN 替身，返回它们的 stun: url；alt=True 时每个再带一个换端口回应用的替身"""
+    loop = asyncio.get_running_loop()
+    urls = []
+    for shift in shifts:
+        other = None
+        if alt:
+            _, other = await loop.create_datagram_endpoint(lambda: StubServer(shift),
+                                                           local_addr=("127.0.0.1", 0))
+        transport, _ = await loop.create_datagram_endpoint(lambda: StubServer(shift, other),
+                                                           local_addr=("127.0.0.1", 0))
+        urls.append(f"stun:127.0.0.1:{transport.get_extra_info('sockname')[1]}")
+    return urls
+
+
+def _probe(*shifts, alt=False, timeout=0.3):
+    async def main():
+        return await probe(await _stubs(*shifts, alt=alt), timeout)
+    return asyncio.run(main())
+
+
+def _free_port():
+    with socket.socket(socket.AF_INET, socket.SOCK_DGRAM) as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+def test_open():
+    result = _probe(0, 0)
+    assert result["nat"] == "open"
+    assert result["public"][0] == "127.0.0.1"
+
+
+def test_symmetric_when_servers_see_different_ports():
+    # 两个替身报回去的端口偏移不同，等于同一个本地端口映射成了两个公网端口
+    assert _probe(0, 7)["nat"] == "symmetric"
+
+
+def test_cone_without_rfc5780():
+    result = _probe(7, 7)
+    assert result["nat"] == "cone"
+    assert all(r["mapped"] == result["public"] for r in result["servers"])
+
+
+def test_cone_refined_by_change_port():
+    # 替身只有一个 IP：换 IP+端口的请求不回，只换端口的从另一个端口回得来
+    assert _probe(7, alt=True)["nat"] == "restricted-cone"
+
+
+def test_blocked():
+    async def main():
+        return await probe([f"stun:127.0.0.1:{_free_port()}"], 0.2)
+    result = asyncio.run(main())
+    assert result["nat"] == "blocked" and result["public"] is None
+
+
+def test_classify():
+    local = ("192.168.1.2", 5000)
+    assert classify([], local) == "blocked"
+    assert classify([{"mapped": list(local)}], local) == "open"
+    assert classify([{"mapped": ["1.2.3.4", 7000]}, {"mapped": ["1.2.3.4", 7000]}], local) == "cone"
+    assert classify([{"mapped": ["1.2.3.4", 7000]}, {"mapped": ["1.2.3.4", 7001]}], local) == "symmetric"
+
+
+@pytest.mark.parametrize("nat,has_turn,url", [
+    ("blocked", False, None),
+    ("open", True, None),
+    ("symmetric", True, None),
+    ("symmetric", False, "stun:fast:3478"),
+    ("port-restricted-cone", True, "stun:fast:3478"),
+])
+def test_choose_stun(nat, has_turn, url):
+    result = {"nat": nat, "servers": [{"url": "stun:fast:3478", "rtt_ms": 5.0, "mapped": ["1.2.3.4", 1]},
+                                      {"url": "stun:slow:3478", "rtt_ms": None, "mapped": None}]}
+    assert choose_stun(result, has_turn)[0] == url
+
+
+def _cached_result(servers):
+    return {"nat": "cone", "public": ["1.2.3.4", 1], "servers": [], "probed": servers,
+            "local": sorted(natprobe.get_host_addresses(use_ipv4=True, use_ipv6=False)),
+            "checked": time.time(), "seconds": 0.1}
+
+
+def test_cache_hit_and_invalidation(tmp_path):
+    path = str(tmp_path / "nat.json")
+    servers = ["stun:a:3478"]
+    assert load_cached(servers, path=path) is None
+    save(_cached_result(servers), path)
+    assert load_cached(servers, path=path)["nat"] == "cone"
+    assert load_cached(["stun:b:3478"], path=path) is None          # 换了一批服务器
+    save(dict(_cached_result(servers), checked=time.time() - 700), path)
+    assert load_cached(servers, ttl=600, path=path) is None          # 过了 TTL
+    save(dict(_cached_result(servers), local=["10.9.8.7"]), path)
+    assert load_cached(servers, path=path) is None                   # 换了网络
+
+
+def test_detect_uses_cache(tmp_path, monkeypatch):
+    path = str(tmp_path / "nat.json")
+    servers = ["stun:a:3478"]
+    save(_cached_result(servers), path)
+
+    async def no_probe(*a, **kw):
+        raise AssertionError("should not probe")
+
+    monkeypatch.setattr(natprobe, "probe", no_probe)
+    assert asyncio.run(natprobe.detect(servers, path=path))["nat"] == "cone"
@@ -0,0 +1,129 @@
+import asyncio
+import os
+
+import rudp
+from rudp import ACK_HDR, DATA_HDR, MSG_HDR, RANGE, Connection
+
+
+def _conn(sent):
+    """没打洞的 Connection：发出去的包记到 sent 里"""
+    c = Connection()
+    c.addr = ("127.0.0.1", 9)
+    c._sendto = lambda packet, addr: sent.append(packet)
+    return c
+
+
+def _ack(cum, *ranges):
+    return ACK_HDR.pack(rudp.ACK, cum, len(ranges)) + b"".join(RANGE.pack(*r) for r in ranges)
+
+
+def _parse_ack(packet):
+    _, cum, n = ACK_HDR.unpack_from(packet)
+    return cum, [RANGE.unpack_from(packet, ACK_HDR.size + k * RANGE.size) for k in range(n)]
+
+
+def test_sack_ranges_and_in_order_delivery():
+    async def main():
+        sent = []
+        c = _conn(sent)
+        got = []
+        c.channel.on("message", got.append)
+        stream = MSG_HDR.pack(5, 0) + b"hello" + MSG_HDR.pack(3, 1) + b"abc"
+        segs = [stream[i:i + 3] for i in range(0, len(stream), 3)]  # 6 段
+        for seq in (0, 2, 3, 5):
+            c._on_data(seq, segs[seq])
+        c._send_ack()
+        assert _parse_ack(sent[-1]) == (1, [(2, 4), (5, 6)])
+        assert got == []
+        for seq in range(len(segs)):
+            c._on_data(seq, segs[seq])  # 重复的段不会重复交付
+        assert got == ["hello", b"abc"]
+        c._send_ack()
+        assert _parse_ack(sent[-1]) == (len(segs), [])
+        await c.close()
+
+    asyncio.run(main())
+
+
+def test_sack_truncated_keeps_newest():
+    async def main():
+        sent = []
+        c = _conn(sent)
+        for seq in range(2, 2 + 2 * (rudp.MAX_SACK + 10), 2):
+            c._on_data(seq, b"x")
+        c._send_ack()
+        cum, ranges = _parse_ack(sent[-1])
+        assert cum == 0 and len(ranges) == rudp.MAX_SACK
+        assert ranges[-1] == (2 * (rudp.MAX_SACK + 10), 2 * (rudp.MAX_SACK + 10) + 1)
+        await c.close()
+
+    asyncio.run(main())
+
+
+def test_loss_detected_by_later_acks():
+    async def main():
+        c = _conn([])
+        c.channel.readyState = "open"
+        c.channel.send(os.urandom(c.mss * 8))
+        now = rudp.time.monotonic()
+        packets = [c._next_packet(now) for _ in range(8)]
+        assert all(DATA_HDR.unpack_from(p)[1] == i for i, p in enumerate(packets))
+        # 段 1 丢了，2..7 经 SACK 确认：比它晚发的确认了 REORDER 个以上，判丢重传
+        c._on_ack(_ack(1, (2, 8)))
+        assert c.snd_una == 1 and list(c.unacked) == [1]
+        assert list(c.retx) == [1]
+        assert c._next_packet(now) == packets[1]
+        assert c.retransmits == 1
+        c._on_ack(_ack(8))
+        assert not c.unacked and c.inflight == 0
+        await c.close()
+
+    asyncio.run(main())
+
+
+def test_no_loss_within_reorder_window():
+    async def main():
+        c = _conn([])
+        c.channel.readyState = "open"
+        c.channel.send(os.urandom(c.mss * 4))
+        now = rudp.time.monotonic()
+        for _ in range(4):
+            c._next_packet(now)
+        c._on_ack(_ack(1, (2, 4)))  # 晚发的只确认了两个，还可能只是乱序
+        assert not c.retx
+        await c.close()
+
+    asyncio.run(main())
+
+
+def test_loopback_transfer_with_loss():
+    # 两端在本机打洞，打通就发，发送方向 10% 丢包：靠 SACK 判丢和 RTO 重传全部按顺序收到
+    async def main():
+        a, b = Connection(loss=0.1), Connection(loss=0.1)
+        da, db = await a.gather(), await b.gather()
+        got = []
+        done = asyncio.Event()
+
+        def on_channel(ch):
+            @ch.on("message")
+            def on_message(msg):
+                got.append(msg)
+                if len(got) == 50:
+                    done.set()
+
+        b.on("datachannel", on_channel)
+        msgs = [os.urandom(5000 + i) for i in range(50)]
+
+        async def send():
+            assert await a.connect(db)
+            for m in msgs:
+                a.channel.send(m)
+
+        ok = await asyncio.gather(send(), b.connect(da))
+        assert ok[1]
+        await asyncio.wait_for(done.wait(), 20)
+        assert got == msgs
+        await a.close(linger=0.1)
+        await b.close(linger=0.1)
+
+    asyncio.run(main())
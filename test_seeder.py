@@ -0,0 +1,12 @@
+import seeder
+
+
+def test_parser_defaults_cover_reseed():
+    # p2p_get --reseed 只给这几个参数，其它全用 seeder 自己的默认值
+    args = seeder.build_parser().parse_args([
+        "--signaling=ws://127.0.0.1:8765", "--room=-r", "--file=out.bin",
+        "--multi", "--until-empty", "--chunk-kb=256",
+    ])
+    assert args.room == "-r" and args.file == ["out.bin"]
+    assert args.multi and args.until_empty and args.chunk_kb == 256
+    assert not args.session and not args.swarm and args.transport == "webrtc"
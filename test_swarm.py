@@ -0,0 +1,97 @@
+import json
+
+import swarm
+from common import ChunkBitmap
+from swarm import ENDGAME_COPIES, SeederPeer, Swarm
+
+CHUNK = 1024
+
+
+class FakeChannel:
+    readyState = "open"
+
+    def __init__(self):
+        self.sent = []
+
+    def send(self, text):
+        self.sent.append(json.loads(text))
+
+    def requests(self, kind="need"):
+        return [i for m in self.sent if m["kind"] == kind for i in m["chunks"]]
+
+
+class FakeDownload:
+    def __init__(self, chunks):
+        self.received = ChunkBitmap(chunks)
+        self.paused = False
+
+
+def _swarm(chunks, *names, window=4):
+    s = Swarm(FakeDownload(chunks))
+    peers = {}
+    for name in names:
+        peer = SeederPeer(name, FakeChannel(), CHUNK)
+        peer.window = window
+        peers[name] = peer
+        s.add(peer)
+    return s, peers
+
+
+def _deliver(s, peer, index):
+    s.download.received.add(index)
+    s.on_chunk(peer.peer_id, index, "ok", CHUNK)
+
+
+def test_requests_split_between_seeders():
+    s, p = _swarm(20, "a", "b")
+    assert p["a"].channel.requests() == [0, 1, 2, 3]
+    assert p["b"].channel.requests() == [4, 5, 6, 7]
+    _deliver(s, p["a"], 0)
+    assert p["a"].channel.requests()[-1] == 8  # 到一个补一个
+
+
+def test_endgame_duplicates_and_cancels():
+    s, p = _swarm(6, "a", "b")
+    # 0..3 给了 a，b 拿到剩下的 4、5 之后重复要 a 还没交付的
+    assert p["b"].channel.requests() == [4, 5, 0, 1]
+    assert p["b"].inflight == {0, 1, 4, 5}
+    _deliver(s, p["b"], 0)
+    assert p["a"].channel.requests("cancel") == [0]
+    assert 0 not in p["a"].inflight and 0 not in p["b"].inflight
+
+
+def test_endgame_copies_capped():
+    s, p = _swarm(2, "a", "b", "c", window=2)
+    copies = {i: sum(i in peer.inflight for peer in p.values()) for i in range(2)}
+    assert copies == {0: ENDGAME_COPIES, 1: ENDGAME_COPIES}
+    assert not p["c"].inflight
+
+
+def test_bad_chunk_and_departed_seeder_requeued():
+    s, p = _swarm(20, "a", "b")
+    s.on_chunk("a", 2, "bad", 0)
+    assert p["a"].channel.requests()[-1] == 2  # 放回队首，马上重新要
+    s.remove("b")
+    assert list(s.unrequested)[:4] == [4, 5, 6, 7]  # b 手上没交付的回到队首
+    _deliver(s, p["a"], 1)
+    assert p["a"].channel.requests()[-1] == 4
+
+
+def test_paused_download_sends_nothing():
+    s, p = _swarm(20, "a")
+    s.download.paused = True
+    _deliver(s, p["a"], 0)
+    assert p["a"].channel.requests() == [0, 1, 2, 3]
+
+
+def test_window_follows_rate(monkeypatch):
+    now = [100.0]
+    monkeypatch.setattr(swarm.time, "monotonic", lambda: now[0])
+    peer = SeederPeer("a", FakeChannel(), CHUNK)
+    # 0.5 秒内到了 40 片：40 片 / 0.5 秒 * WINDOW_SECONDS
+    now[0] += 0.5
+    peer.on_delivered(40 * CHUNK)
+    assert peer.window == int(80 * CHUNK * swarm.WINDOW_SECONDS / CHUNK)
+    now[0] += 0.5
+    peer.on_delivered(10_000 * CHUNK)
+    assert peer.window == swarm.MAX_WINDOW
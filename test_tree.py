@@ -0,0 +1,79 @@
+import os
+import stat
+
+import pytest
+
+import tree
+
+
+def _entries():
+    return [
+        ["a.bin", 5000, 0o4755, 1_600_000_000_000_000_000],
+        ["ro/", 0, 0o555, 1_600_000_000_000_000_000],
+        ["ro/b.bin", 3000, 0o2644, 1_600_000_000_000_000_000],
+        ["ro/empty", 0, 0o1600, 1_600_000_000_000_000_000],
+    ]
+
+
+def _receive(root, entries, data):
+    f = tree.TreeFile(str(root), entries)
+    f.allocate(len(data))
+    f.writev_at(0, [data[:4000], data[4000:]])   # 跨两个文件
+    f.sync()
+    f.finalize()
+    f.close()
+    return f
+
+
+def test_layout_round_trip(tmp_path):
+    data = os.urandom(8000)
+    f = _receive(tmp_path / "out", _entries(), data)
+    assert f.read_at(0, 8000) == data
+    assert (tmp_path / "out" / "a.bin").read_bytes() == data[:5000]
+    assert (tmp_path / "out" / "ro" / "b.bin").read_bytes() == data[5000:]
+    assert (tmp_path / "out" / "ro" / "empty").stat().st_size == 0
+
+
+def test_finalize_drops_special_bits(tmp_path):
+    _receive(tmp_path / "out", _entries(), os.urandom(8000))
+    for rel in ("a.bin", "ro/b.bin", "ro/empty"):
+        mode = os.stat(tmp_path / "out" / rel).st_mode
+        assert not mode & (stat.S_ISUID | stat.S_ISGID | stat.S_ISVTX), rel
+    assert stat.S_IMODE(os.stat(tmp_path / "out" / "a.bin").st_mode) == 0o755
+
+
+def test_read_only_dir_stays_writable(tmp_path):
+    _receive(tmp_path / "out", _entries(), os.urandom(8000))
+    assert stat.S_IMODE(os.stat(tmp_path / "out" / "ro").st_mode) == 0o755
+    # 再收一次覆盖同一个目录
+    _receive(tmp_path / "out", _entries(), os.urandom(8000))
+
+
+@pytest.mark.parametrize("entry", [
+    ["../x", 1, 0o644, 0],
+    ["/etc/passwd", 1, 0o644, 0],
+    ["a/./b", 1, 0o644, 0],
+    ["d/", 5, 0o755, 0],
+    ["x", -1, 0o644, 0],
+    ["x", 1, "rwx", 0],
+    ["x", 1],
+    ["x", "5", 0o644, 0],
+    ["x", None, 0o644, 0],
+    ["x", 5.5, 0o644, 0],
+    ["x", True, 0o644, 0],
+    ["x", 1, True, 0],
+    ["x", 1, 0o644, 1.5],
+    ["x", 1, 0o644, None],
+    ["x", 1, -1, 0],
+])
+def test_check_entries_rejects(entry):
+    with pytest.raises(ValueError):
+        tree.check_entries([entry])
+
+
+def test_file_list_round_trip():
+    entries = _entries() * 3
+    parts = list(tree.encode_file_list(entries))
+    decoded = [e for p in parts for e in tree.decode_file_list(p["data"])]
+    assert decoded == entries
+    assert tree.list_sha256(decoded) == tree.list_sha256(entries)
@@ -0,0 +1,109 @@
+import asyncio
+import hashlib
+import os
+import threading
+
+import writer
+from common import ChunkBitmap
+from manifest import Manifest
+from writer import DiskFile, WritePipeline
+
+CHUNK = 1024
+
+
+class CountingFile(DiskFile):
+    def __init__(self, path):
+        super().__init__(path, create=True)
+        self.syncs = 0
+
+    def sync(self):
+        self.syncs += 1
+        super().sync()
+
+
+def _chunks(n):
+    return [os.urandom(CHUNK) for _ in range(n)]
+
+
+def _run(tmp_path, chunks, order, manifest=None, bad=(), **kw):
+    """按 order 把分片交给流水线，返回 (文件, 位图, 校验结果, sidecar 路径)"""
+    meta = {"name": "f", "size": CHUNK * len(chunks), "chunk_size": CHUNK, "chunks": len(chunks)}
+    file = CountingFile(str(tmp_path / "f.part"))
+    file.allocate(meta["size"])
+    durable = ChunkBitmap(len(chunks))
+    sidecar = str(tmp_path / "f.chunks")
+    results = {}
+
+    async def main():
+        p = WritePipeline(asyncio.get_running_loop(), file, meta, manifest, None, durable, sidecar,
+                          lambda i, ok, tag, n: results.__setitem__(i, ok),
+                          lambda n: None, lambda e: results.__setitem__("error", e), **kw)
+        for i in order:
+            p.submit(i, b"x" * CHUNK if i in bad else chunks[i])
+        await asyncio.to_thread(p.close)
+        await asyncio.sleep(0)
+
+    asyncio.run(main())
+    return file, durable, results, sidecar
+
+
+def test_writev_at_splits_at_iov_max(tmp_path, monkeypatch):
+    monkeypatch.setattr(writer, "IOV_MAX", 3)
+    f = DiskFile(str(tmp_path / "f"), create=True)
+    bufs = [bytes([i]) * (100 + i) for i in range(10)]
+    f.writev_at(50, bufs)
+    assert f.read_at(50, sum(map(len, bufs))) == b"".join(bufs)
+    f.close()
+
+
+def test_pipeline_writes_out_of_order(tmp_path):
+    chunks = _chunks(8)
+    file, durable, results, sidecar = _run(tmp_path, chunks, [3, 4, 5, 0, 7, 1, 2, 6])
+    assert file.read_at(0, CHUNK * 8) == b"".join(chunks)
+    assert durable.complete() and all(results[i] for i in range(8))
+    assert ChunkBitmap.load(sidecar, {"name": "f", "size": CHUNK * 8, "chunk_size": CHUNK,
+                                      "chunks": 8}).complete()
+    file.close()
+
+
+def test_pipeline_rejects_bad_chunk(tmp_path):
+    chunks = _chunks(4)
+    m = Manifest(CHUNK, [hashlib.sha256(c).digest() for c in chunks])
+    file, durable, results, _ = _run(tmp_path, chunks, range(4), manifest=m, bad={2})
+    assert results == {0: True, 1: True, 2: False, 3: True}
+    assert durable.missing() == [2]
+    assert file.read_at(2 * CHUNK, CHUNK) == bytes(CHUNK)  # 没写
+    file.close()
+
+
+def test_durability_eof_syncs_once(tmp_path):
+    file, _, _, sidecar = _run(tmp_path, _chunks(8), range(8), durability="eof", sync_bytes=CHUNK)
+    assert file.syncs == 1
+    assert os.path.exists(sidecar)
+    file.close()
+
+
+def test_durability_none_never_syncs(tmp_path):
+    file, _, _, sidecar = _run(tmp_path, _chunks(8), range(8), durability="none", sync_bytes=CHUNK)
+    assert file.syncs == 0
+    assert os.path.exists(sidecar)  # 位图照样存，进程崩了能续传
+    file.close()
+
+
+def test_hash_stage_failure_still_closes(tmp_path):
+    # 清单比分片少，verify 抛 IndexError：报 on_failed，close() 也得能返回
+    chunks = _chunks(4)
+    m = Manifest(CHUNK, [hashlib.sha256(c).digest() for c in chunks[:2]])
+    closed = threading.Event()
+    results = {}
+
+    def run():
+        file, _, r, _ = _run(tmp_path, chunks, range(4), manifest=m)
+        file.close()
+        results.update(r)
+        closed.set()
+
+    threading.Thread(target=run, daemon=True).start()
+    assert closed.wait(10)
+    assert isinstance(results.get("error"), IndexError)
+    assert results[0] and results[1]
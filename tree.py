@@ -0,0 +1,295 @@
+# tree.py - 目录传输：把整个目录当成一个按路径排好序、首尾相接的虚拟文件
+#
+# 分片、清单、位图、续传、swarm、压缩都照旧按这个虚拟文件算。一个分片里可能装着几十个小文件，
+# 每条 DataChannel 消息的开销摊到很多文件上；大文件照常切成很多分片。
+# 文件列表（路径、大小、权限、修改时间）压缩后分几条 files 消息跟在 meta 后面发，meta 里带它的 sha256。
+
+import base64
+import bisect
+import hashlib
+import json
+import logging
+import math
+import os
+import stat
+import threading
+import zlib
+from concurrent.futures import ThreadPoolExecutor
+
+from common import CHUNK_SIZE
+from source import DEFAULT_CACHE_BYTES, ChunkCache, FileSource
+from writer import allocate
+
+logger = logging.getLogger("tree")
+
+FILE_LIST_BATCH = 4096  # 每条 files 消息带多少个条目
+WRITE_WORKERS = 8       # 接收端写小文件的线程数
+SYNC_ALL_OVER = 16      # 一次要 fsync 的文件比这个多时直接 os.sync()，省得一个个 fsync
+
+
+def scan(root: str):
+    """列出目录下的文件和子目录：[相对路径, 大小, 权限, 修改时间(ns)]，目录的路径以 / 结尾
+
+    按路径排序，目录排在它的内容前面；符号链接和特殊文件跳过。
+    """
+    entries = []
+    skipped = 0
+
+    def walk(rel):
+        nonlocal skipped
+        with os.scandir(os.path.join(root, rel) if rel else root) as it:
+            items = sorted(it, key=lambda e: e.name)
+        for e in items:
+            path = f"{rel}/{e.name}" if rel else e.name
+            if e.is_symlink():
+                skipped += 1
+                continue
+            st = e.stat()
+            if e.is_dir():
+                entries.append([path + "/", 0, stat.S_IMODE(st.st_mode), st.st_mtime_ns])
+                walk(path)
+            elif e.is_file():
+                entries.append([path, st.st_size, stat.S_IMODE(st.st_mode), st.st_mtime_ns])
+            else:
+                skipped += 1
+
+    walk("")
+    if skipped:
+        logger.warning("Skipped %d symlinks / special files under %s", skipped, root)
+    return entries
+
+
+def list_sha256(entries) -> str:
+    raw = json.dumps(entries, separators=(",", ":")).encode()
+    return hashlib.sha256(raw).hexdigest()
+
+
+def encode_file_list(entries):
+    for start in range(0, len(entries), FILE_LIST_BATCH):
+        raw = json.dumps(entries[start:start + FILE_LIST_BATCH], separators=(",", ":")).encode()
+        yield {"kind": "files", "start": start,
+               "data": base64.b64encode(zlib.compress(raw, 9)).decode()}
+
+
+def decode_file_list(text: str):
+    return json.loads(zlib.decompress(base64.b64decode(text)))
+
+
+def check_entries(entries):
+    """接收端用：路径只能落在输出目录里面，不对抛 ValueError"""
+    for entry in entries:
+        if not isinstance(entry, list) or len(entry) != 4 or not isinstance(entry[0], str):
+            raise ValueError(f"malformed file list entry: {entry!r}")
+        path = entry[0].rstrip("/")
+        parts = path.split("/")
+        if (not path or path.startswith("/") or "\\" in path
+                or any(p in ("", ".", "..") for p in parts)):
+            raise ValueError(f"unsafe path in file list: {entry[0]!r}")
+        # 先看类型再比大小：JSON 里的 null/字符串/小数/true 都不能当整数用（bool 是 int 的子类）
+        if type(entry[1]) is not int or entry[1] < 0 or (entry[0].endswith("/") and entry[1]):
+            raise ValueError(f"bad size for {entry[0]!r}")
+        if type(entry[2]) is not int or type(entry[3]) is not int or entry[2] < 0:
+            raise ValueError(f"bad mode or mtime for {entry[0]!r}")
+
+
+def file_mode(mode: int) -> int:
+    """对端给的权限只取 rwx：setuid/setgid/sticky 位不能由发送端决定"""
+    return mode & 0o777
+
+
+def dir_mode(mode: int) -> int:
+    """目录另外保证自己可读写可进，不然下次覆盖、续传时删不掉也写不进去"""
+    return (mode & 0o777) | 0o700
+
+
+def tree_meta(root: str, entries, chunk_size: int = CHUNK_SIZE):
+    size = sum(e[1] for e in entries)
+    return {
+        "name": os.path.basename(os.path.normpath(root)),
+        "size": size,
+        "chunk_size": chunk_size,
+        "chunks": math.ceil(size / chunk_size),
+        "files": len(entries),
+        "files_sha256": list_sha256(entries),
+    }
+
+
+class TreeLayout:
+    """虚拟偏移 -> (第几个条目, 文件内偏移, 长度)"""
+
+    def __init__(self, entries):
+        self.entries = entries
+        self.starts = []
+        pos = 0
+        for e in entries:
+            self.starts.append(pos)
+            pos += e[1]
+        self.size = pos
+
+    def segments(self, offset: int, length: int):
+        i = bisect.bisect_right(self.starts, offset) - 1
+        while length > 0 and i < len(self.entries):
+            inner = offset - self.starts[i]
+            n = min(self.entries[i][1] - inner, length)
+            if n > 0:
+                yield i, inner, n
+                offset += n
+                length -= n
+            i += 1
+
+    def path(self, root: str, i: int) -> str:
+        return os.path.join(root, *self.entries[i][0].rstrip("/").split("/"))
+
+
+def _pread_segments(layout, root, offset, n) -> bytes:
+    parts = []
+    for i, inner, length in layout.segments(offset, n):
+        fd = os.open(layout.path(root, i), os.O_RDONLY)
+        try:
+            parts.append(os.pread(fd, length, inner))
+        finally:
+            os.close(fd)
+    return b"".join(parts)
+
+
+class TreeSource(FileSource):
+    """发送端的目录源，接口和 FileSource 一样；分片每次从各个文件拼出来（没法 mmap 成一块）"""
+
+    def __init__(self, root: str, cache_bytes: int = DEFAULT_CACHE_BYTES,
+                 chunk_size: int = CHUNK_SIZE):
+        self.path = root
+        self.entries = scan(root)
+        self.layout = TreeLayout(self.entries)
+        self.meta = tree_meta(root, self.entries, chunk_size)
+        self.file_list = list(encode_file_list(self.entries))
+        self.manifest = None
+        self.cache = ChunkCache(cache_bytes) if cache_bytes > 0 else None
+        self._digest_task = None
+        logger.info("Directory %s: %d entries, %d bytes, file list in %d messages",
+                    root, len(self.entries), self.meta["size"], len(self.file_list))
+
+    def _chunks(self):
+        for index in range(self.meta["chunks"]):
+            with self.view(index) as v:
+                yield v
+
+    def cache_key(self):
+        # 文件列表里有每个文件的大小和 mtime(ns)，哪个文件动过 key 就变
+        st = os.stat(self.path)
+        return ["tree", st.st_dev, st.st_ino, self.meta["files_sha256"], self.meta["chunk_size"]]
+
+    def sha256(self) -> str:
+        h = hashlib.sha256()
+        for v in self._chunks():
+            h.update(v)
+        return h.hexdigest()
+
+    def view(self, index: int) -> memoryview:
+        cs = self.meta["chunk_size"]
+        return memoryview(_pread_segments(self.layout, self.path, index * cs, self.chunk_len(index)))
+
+    def close(self):
+        if self.cache is not None:
+            self.cache.clear()
+
+
+class TreeFile:
+    """接收端的输出目录，接口和 writer.DiskFile 一样（按虚拟偏移读写）
+
+    文件在第一次写到时才建（建的时候按列表里的大小预分配）；一次写跨好几个文件时用线程池并行写。
+    空文件、空目录、最终大小、权限和修改时间在 finalize 里补上。
+    """
+
+    def __init__(self, root: str, entries):
+        self.root = root
+        self.layout = TreeLayout(entries)
+        self._dirty = set()
+        self._allocated = set()
+        self._lock = threading.Lock()
+        self._pool = ThreadPoolExecutor(max_workers=WRITE_WORKERS, thread_name_prefix="tree-write")
+        os.makedirs(root, exist_ok=True)
+
+    def write_at(self, offset: int, data):
+        view = memoryview(data)
+        jobs = []
+        pos = 0
+        for i, inner, n in self.layout.segments(offset, len(view)):
+            jobs.append((i, inner, view[pos:pos + n]))
+            pos += n
+        if len(jobs) == 1:
+            self._write(*jobs[0])
+        else:
+            list(self._pool.map(lambda job: self._write(*job), jobs))
+
+    def _write(self, i, inner, data):
+        path = self.layout.path(self.root, i)
+        flags = os.O_WRONLY | os.O_CREAT
+        try:
+            fd = os.open(path, flags, 0o644)
+        except FileNotFoundError:
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            fd = os.open(path, flags, 0o644)
+        try:
+            if i not in self._allocated:
+                # 同一个文件只会在一个线程里写（一次写里每段是不同的文件）
+                self._allocated.add(i)
+                allocate(fd, self.layout.entries[i][1])
+            while data:
+                n = os.pwrite(fd, data, inner)
+                data = data[n:]
+                inner += n
+        finally:
+            os.close(fd)
+        with self._lock:
+            self._dirty.add(i)
+
+    def writev_at(self, offset: int, bufs):
+        self.write_at(offset, b"".join(bufs))  # 要按文件边界切开，拼起来再切省事
+
+    def read_at(self, offset: int, n: int) -> bytes:
+        return _pread_segments(self.layout, self.root, offset, n)
+
+    def allocate(self, size: int):
+        pass  # 文件按需创建，第一次写到时预分配
+
+    def sync(self):
+        with self._lock:
+            dirty, self._dirty = self._dirty, set()
+        if len(dirty) > SYNC_ALL_OVER:
+            os.sync()
+            return
+        for i in dirty:
+            fd = os.open(self.layout.path(self.root, i), os.O_RDONLY)
+            try:
+                os.fsync(fd)
+            finally:
+                os.close(fd)
+
+    def close(self):
+        self._pool.shutdown()
+
+    def digest(self) -> str:
+        h = hashlib.sha256()
+        for offset in range(0, self.layout.size, 1024 * 1024):
+            h.update(self.read_at(offset, 1024 * 1024))
+        return h.hexdigest()
+
+    def finalize(self):
+        """补齐空文件和空目录，按列表设大小、权限、修改时间"""
+        dirs = []
+        for i, (path, size, mode, mtime) in enumerate(self.layout.entries):
+            full = self.layout.path(self.root, i)
+            if path.endswith("/"):
+                os.makedirs(full, exist_ok=True)
+                dirs.append((full, mode, mtime))
+                continue
+            if not os.path.exists(full):
+                os.makedirs(os.path.dirname(full), exist_ok=True)
+                open(full, "ab").close()
+            os.truncate(full, size)  # 覆盖旧目录时旧文件可能更长
+            os.chmod(full, file_mode(mode))
+            os.utime(full, ns=(mtime, mtime))
+        # 目录最后设，里面建文件会改目录的修改时间；深的先设
+        for full, mode, mtime in reversed(dirs):
+            os.chmod(full, dir_mode(mode))
+            os.utime(full, ns=(mtime, mtime))
@@ -0,0 +1,239 @@
+# writer.py - 接收端的落盘流水线，不占 asyncio 事件循环
+#
+#   DataChannel 回调 --submit--> [哈希线程: 按清单校验分片] --> [写线程: 相邻分片一次 pwritev、按策略 fsync]
+#
+# 校验结果和写完的字节数通过 call_soon_threadsafe 回到事件循环；
+# fsync 之后由写线程自己更新 sidecar 位图，位图里的分片一定已经落盘。
+# 排队中的字节数由事件循环一侧统计，超过上限时让发送端暂停（见 Download）。
+#
+# 什么时候 fsync（--durability）：
+#   periodic  每写 sync_bytes 字节或者每 sync_interval 秒，哪个先到算哪个（默认）
+#   eof       只在收完（或者连接断了要续传）时 fsync 一次；中途进程崩了从头收
+#   none      从不 fsync，sidecar 照样定期存：进程崩了能续传，断电不保证
+
+import logging
+import os
+import queue
+import threading
+import time
+from collections import deque
+
+from common import file_sha256
+
+logger = logging.getLogger("fetch")
+
+_STOP = object()
+MAX_COALESCE = 8 * 1024 * 1024  # 写线程一次最多合并这么多字节
+IOV_MAX = os.sysconf("SC_IOV_MAX") if hasattr(os, "sysconf") else 1024
+DURABILITY = ("periodic", "eof", "none")
+SYNC_BYTES = 4 * 1024 * 1024
+SYNC_INTERVAL = 5.0
+
+
+def allocate(fd, size: int):
+    """把文件撑到 size 并预先分配好块，写的时候不用边写边分配、也不容易碎；文件系统不支持就只 ftruncate"""
+    os.ftruncate(fd, size)
+    if size and hasattr(os, "posix_fallocate"):
+        try:
+            os.posix_fallocate(fd, 0, size)
+        except OSError as e:
+            logger.debug("posix_fallocate not supported here (%s), leaving the file sparse", e)
+
+
+def sync_dir(path: str):
+    """rename 之后 fsync 所在目录，新名字才算落盘"""
+    fd = os.open(os.path.dirname(os.path.abspath(path)), os.O_RDONLY)
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+
+class DiskFile:
+    """单个输出文件，按偏移读写（pwrite/pread，不经过 Python 的缓冲）；目录模式用 tree.TreeFile"""
+
+    def __init__(self, path: str, create: bool):
+        self.path = path
+        flags = os.O_RDWR | (os.O_CREAT | os.O_TRUNC if create else 0)
+        self.fd = os.open(path, flags, 0o644)
+
+    def write_at(self, offset: int, data):
+        view = memoryview(data)
+        while view:
+            n = os.pwrite(self.fd, view, offset)
+            view = view[n:]
+            offset += n
+
+    def writev_at(self, offset: int, bufs):
+        """几段连续的数据一次 pwritev 写下去，不用先拼成一块"""
+        views = [memoryview(b) for b in bufs]
+        while views:
+            n = os.pwritev(self.fd, views[:IOV_MAX], offset)
+            offset += n
+            while views and n >= len(views[0]):
+                n -= len(views.pop(0))
+            if n:
+                views[0] = views[0][n:]
+
+    def read_at(self, offset: int, n: int) -> bytes:
+        return os.pread(self.fd, n, offset)
+
+    def allocate(self, size: int):
+        allocate(self.fd, size)
+
+    def sync(self):
+        os.fsync(self.fd)
+
+    def close(self):
+        os.close(self.fd)
+
+    def digest(self) -> str:
+        return file_sha256(self.path)
+
+    def finalize(self):
+        pass
+
+
+class WritePipeline:
+    def __init__(self, loop, file, meta, manifest, hasher, durable, sidecar,
+                 on_verified, on_written, on_failed, durability="periodic",
+                 sync_bytes=SYNC_BYTES, sync_interval=SYNC_INTERVAL):
+        self.loop = loop
+        self.file = file
+        self.meta = meta
+        self.manifest = manifest
+        self.hasher = hasher
+        self.durable = durable        # 只有写线程碰，fsync 后存成 sidecar
+        self.sidecar = sidecar
+        self.on_verified = on_verified    # (index, ok, tag, nbytes)，在事件循环里调用
+        self.on_written = on_written      # (nbytes)，在事件循环里调用
+        self.on_failed = on_failed        # (exc)，写盘出错，流水线已经停了
+        self.durability = durability
+        self.sync_bytes = sync_bytes
+        self.sync_interval = sync_interval
+        self._hash_q = queue.SimpleQueue()
+        self._write_q = queue.SimpleQueue()
+        self._unsynced = 0
+        self._last_sync = time.monotonic()
+        self.latencies = deque()      # 每批写盘（含 fsync）用的秒数，telemetry 定时取走
+        self._threads = [
+            threading.Thread(target=self._hash_loop, name="chunk-hash", daemon=True),
+            threading.Thread(target=self._write_loop, name="chunk-write", daemon=True),
+        ]
+        for t in self._threads:
+            t.start()
+
+    def submit(self, index, data, tag=None):
+        self._hash_q.put((index, data, tag))
+
+    def close(self):
+        """阻塞到队列里的分片都写完并 fsync（none 策略下不 fsync），放到线程里调"""
+        self._hash_q.put(_STOP)
+        for t in self._threads:
+            t.join()
+
+    def _guarded(self, fn):
+        try:
+            fn()
+        except Exception as e:
+            logger.exception("Write pipeline stage %s failed", threading.current_thread().name)
+            self.loop.call_soon_threadsafe(self.on_failed, e)
+
+    # ---------- 哈希线程 ----------
+    def _hash_loop(self):
+        try:
+            self._guarded(self._hash_stage)
+        finally:
+            self._write_q.put(_STOP)  # 哈希这步出错退出也要让写线程收尾，不然 close() 一直等
+
+    def _hash_stage(self):
+        while True:
+            item = self._hash_q.get()
+            if item is _STOP:
+                return
+            index, data, tag = item
+            ok = self.manifest is None or self.manifest.verify(index, data)
+            if ok:
+                self._write_q.put(item)
+            else:
+                self.loop.call_soon_threadsafe(self.on_verified, index, False, tag, len(data))
+
+    # ---------- 写线程 ----------
+    def _write_loop(self):
+        self._guarded(self._write_stage)
+
+    def _write_stage(self):
+        cs = self.meta["chunk_size"]
+        stop = False
+        while not stop:
+            try:
+                batch = [self._write_q.get(timeout=self._idle_timeout())]
+            except queue.Empty:
+                self._checkpoint()  # 闲下来了，到点的 fsync 别拖到下一批
+                continue
+            size = 0 if batch[0] is _STOP else len(batch[0][1])
+            # 把已经排着的都拿出来，一起写
+            while size < MAX_COALESCE:
+                try:
+                    item = self._write_q.get_nowait()
+                except queue.Empty:
+                    break
+                batch.append(item)
+                if item is not _STOP:
+                    size += len(item[1])
+            if any(b is _STOP for b in batch):
+                stop = True
+                batch = [b for b in batch if b is not _STOP]
+            batch.sort(key=lambda b: b[0])
+            t0 = time.monotonic()
+
+            # 序号连续的分片拼成一段，一次 pwritev 写下去
+            run = []
+            for item in batch:
+                if run and item[0] != run[-1][0] + 1:
+                    self._write_run(run, cs)
+                    run = []
+                run.append(item)
+            if run:
+                self._write_run(run, cs)
+
+            for index, data, tag in batch:
+                if self.hasher is not None:
+                    self.hasher.feed(index, data)
+                self.durable.add(index)
+                self.loop.call_soon_threadsafe(self.on_verified, index, True, tag, len(data))
+            if batch:
+                self.loop.call_soon_threadsafe(self.on_written, size)
+            if stop:
+                self._checkpoint(final=True)
+            elif self._due():
+                self._checkpoint()
+            if batch:
+                self.latencies.append(time.monotonic() - t0)
+
+    def _write_run(self, run, cs):
+        if len(run) == 1:
+            self.file.write_at(run[0][0] * cs, run[0][1])
+        else:
+            self.file.writev_at(run[0][0] * cs, [item[1] for item in run])
+        self._unsynced += sum(len(item[1]) for item in run)
+
+    def _due(self) -> bool:
+        if self.durability == "eof" or not self._unsynced:
+            return False
+        return (self._unsynced >= self.sync_bytes
+                or time.monotonic() - self._last_sync >= self.sync_interval)
+
+    def _idle_timeout(self):
+        if self.durability == "eof" or not self._unsynced:
+            return None
+        return max(0.0, self._last_sync + self.sync_interval - time.monotonic())
+
+    def _checkpoint(self, final=False):
+        """按策略 fsync 数据，再存 sidecar 位图"""
+        if self.durability != "none" and (self._unsynced or final):
+            self.file.sync()
+        if self.durability != "eof" or final:
+            self.durable.save(self.sidecar, self.meta)
+        self._unsynced = 0
+        self._last_sync = time.monotonic()